@@ -1,20 +1,121 @@
+import os
+import argparse
+
 from modules.io        import read_from_json, save_to_json
 from modules.data      import get_tags, print_failure_distribution, print_hashtag_distribution
 from modules.loaders.csv_loader import CSVConvoLoader
-from modules.sampling import sample_demonstrations
-from modules.runner    import run_tests
-from modules.metrics   import evaluator_metrics, chatbot_metrics, print_evaluator_metrics, print_chatbot_metrics
+from modules.sampling import SAMPLING_STRATEGIES, demonstration_setup
+from modules.shortlist import TagShortlister
+from modules.runner    import run_tests, run_metrics, load_error_items, load_results, RUN_MODES, PIPELINES, DEFAULT_CONCURRENCY
+from modules.shard     import select_shard, shard_dir, launch_shards, merge_shards
+from modules.batch     import run_batch, make_batch_backend
+from modules.cascade   import CONFIDENCE_SIGNALS, load_cascade
+from modules.dedup     import DEDUP_MODES, load_deduplicator, print_dedup_summary
+from modules.profiling import TRACE_FORMATS, span, start_profiling, stop_profiling, print_profile
+from modules.clients.registry import BACKENDS, set_backend, load_config
+from modules.metrics   import (agreement_metrics, tier_metrics, print_evaluator_metrics, print_chatbot_metrics,
+                              print_agreement_metrics, print_tier_metrics)
 
-def main():
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate the LLM evaluator on the test set.")
+    parser.add_argument("--mode", choices=RUN_MODES, default="async",
+                        help="How test examples are dispatched to the model (default: async)")
+    parser.add_argument("--backend", choices=tuple(BACKENDS),
+                        help="LLM backend, overriding [llm] backend in config.ini (default: azure)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Max examples in flight for async/threads modes (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--sampling", choices=SAMPLING_STRATEGIES, default="random",
+                        help="random: one shared random sample of k demonstrations, "
+                             "relevant_hashtags_last: k demonstrations chosen and ordered per test example, "
+                             "knn: the k demonstrations most similar to each test example (default: random)")
+    parser.add_argument("--k", type=int, default=16, help="Number of demonstrations per prompt (default: 16)")
+    parser.add_argument("--seed", type=int,
+                        help="Seed of the demonstration sampling (default: random, 0 when sharded so all shards agree)")
+    parser.add_argument("--shortlist", type=int, default=0,
+                        help="Only offer the N likeliest hashtags per conversation in the prompt, 0 for all (default: 0)")
+    parser.add_argument("--limit", type=int, default=10,
+                        help="Number of test examples to evaluate, 0 for all (default: 10)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run, skipping examples already in results.jsonl")
+    parser.add_argument("--retry-errors", action="store_true",
+                        help="Only re-evaluate the examples in errors.json, keeping the other results of that run")
+    parser.add_argument("--pipeline", choices=PIPELINES, default="two_step",
+                        help="two_step: separate pass/fail and tagging calls, structured: one JSON call (default: two_step)")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="Completions per call (one request), voted on for self-consistency (default: 1)")
+    parser.add_argument("--tag-threshold", type=float, default=0.5,
+                        help="With --samples, share of the samples that must choose a hashtag (default: 0.5)")
+    parser.add_argument("--cascade", action="store_true",
+                        help="Escalate the conversations the model is not confident about to [cascade] strong_model")
+    parser.add_argument("--cascade-threshold", type=float,
+                        help="With --cascade, confidence below which a conversation is escalated (default: [cascade] threshold)")
+    parser.add_argument("--cascade-signal", choices=CONFIDENCE_SIGNALS,
+                        help="With --cascade, logprobs: probability of the pass/fail token, agreement: share of "
+                             "agreeing samples (default: [cascade] signal)")
+    parser.add_argument("--dedup", choices=DEDUP_MODES,
+                        help="Evaluate one conversation per cluster of exact (exact) or also MinHash near-duplicates "
+                             "(near) and copy its prediction to the others (default: off)")
+    parser.add_argument("--dedup-threshold", type=float,
+                        help="With --dedup near, similarity from which conversations are duplicates (default: [dedup] threshold)")
+    parser.add_argument("--check-leakage", action="store_true",
+                        help="Report the test conversations that duplicate a conversation of the demonstration pool")
+    parser.add_argument("--progress-every", type=float, default=10.0,
+                        help="Seconds between progress lines with throughput, ETA and running F-beta (default: 10)")
+    parser.add_argument("--stop-ci-width", type=float,
+                        help="Stop early once the 95%% confidence interval of the running F-beta is at most this wide")
+    parser.add_argument("--batch", choices=("azure", "openai", "local"),
+                        help="Send both stages through the Batch API instead (local = offline stand-in)")
+    parser.add_argument("--output-dir", default=".",
+                        help="Directory of the journal, results, errors and reports (default: current directory)")
+    parser.add_argument("--num-shards", type=int, default=1,
+                        help="Split the test set into N shards by a hash of each conversation, each with its own "
+                             "journal in --output-dir/shard-K-of-N (default: 1)")
+    parser.add_argument("--shard", type=int,
+                        help="With --num-shards, only run shard K (0-based) here, e.g. one per machine, then --merge")
+    parser.add_argument("--workers", type=int,
+                        help="With --num-shards, processes running shards at once (default: one per shard, up to the CPUs)")
+    parser.add_argument("--merge", action="store_true",
+                        help="Only merge the shards already in --output-dir into the final results and metrics")
+    parser.add_argument("--json-results", action="store_true",
+                        help="Also write results.json next to the columnar results store")
+    parser.add_argument("--profile", metavar="TRACE_FILE",
+                        help="Time the stages of the run, print the hot paths and save their trace to TRACE_FILE")
+    parser.add_argument("--profile-format", choices=TRACE_FORMATS, default="chrome",
+                        help="chrome: Chrome trace events (chrome://tracing, Perfetto), otlp: OpenTelemetry "
+                             "OTLP/JSON (default: chrome)")
+    parser.add_argument("--detailed-metrics", action="store_true",
+                        help="Also report per-tag, micro-averaged and bootstrap CI metrics (requires numpy)")
+    return parser.parse_args()
+
+def evaluate(args, output_dir, shard=None):
+    """
+    Loads the data, sets up the demonstrations and runs the evaluator over the test set,
+    or over one of its --num-shards shards, writing the outputs to output_dir.
+    """
     # Load data
     loader = CSVConvoLoader()
-    demos = loader.load("demo.csv")
-    test_data = loader.load("test.csv")
+    pool = loader.load("demo.csv")
+    # Streamed from disk as the run consumes it, stopping after --limit rows
+    test_data = loader.stream("test.csv", limit=args.limit or None)
+    indices = None
+    if args.retry_errors:
+        # Only the examples that errored last time, under their original idx
+        test_data, indices = load_error_items(os.path.join(output_dir, "errors.json"))
+    elif shard is not None:
+        test_data, indices = select_shard(test_data, shard, args.num_shards)
+        print(f"Shard {shard} of {args.num_shards}: {len(test_data)} test examples.")
 
     # Setup
-    demos = sample_demonstrations(demos)
-    test_data = test_data[:10]
-    print(f"Loaded {len(demos)} demonstrations and {len(test_data)} test examples.")
+    knn_index = None
+    if args.sampling == "knn":
+        # numpy is only needed for the retrieval index
+        from modules.retrieval import KNNIndex
+        knn_index = KNNIndex.from_loader(loader, "demo.csv")
+    # relevant_hashtags_last and knn choose k demos per example from the whole pool
+    seed = args.seed if args.seed is not None or shard is None else 0
+    with span("setup.demonstrations"):
+        demos, selector = demonstration_setup(args.sampling, pool, args.k, seed=seed, knn_index=knn_index)
+    print(f"Loaded {len(demos)} demonstrations; streaming {args.limit or 'all'} test examples.")
     print(f"Example: {demos[0]}\n")
     
     tags = get_tags()
@@ -25,16 +126,133 @@ def main():
     print_hashtag_distribution(demos, tags)
     print()
 
+    # Narrows the hashtag options per conversation, fitted on the whole demonstration pool
+    shortlister = TagShortlister(pool, tags, top_n=args.shortlist) if args.shortlist else None
+    cascade = load_cascade(load_config(), threshold=args.cascade_threshold,
+                           signal=args.cascade_signal) if args.cascade else None
+    with span("setup.dedup"):
+        duplicates = find_duplicates(args, test_data, indices, pool)
+
     # Test evaluator
-    run_tests(test_data, demos, tags)
+    if args.batch:
+        workdir = os.path.join(output_dir, "batch")
+        run_batch(test_data, demos, tags, make_batch_backend(args.batch, workdir), workdir=workdir,
+                  output_dir=output_dir, export_json=args.json_results, selector=selector, indices=indices,
+                  resume=args.resume or args.retry_errors)
+    else:
+        run_tests(test_data, demos, tags, mode=args.mode, concurrency=args.concurrency,
+                  resume=args.resume or args.retry_errors, pipeline=args.pipeline, selector=selector, indices=indices,
+                  shortlister=shortlister, samples=args.samples, tag_threshold=args.tag_threshold, cascade=cascade,
+                  output_dir=output_dir, progress_every=args.progress_every, stop_ci_width=args.stop_ci_width,
+                  export_json=args.json_results, duplicates=duplicates)
+
+def find_duplicates(args, test_data, indices, pool):
+    """
+    Clusters the duplicate conversations of the test set for --dedup, and checks it
+    against the demonstration pool with --check-leakage. None when neither is asked for.
+    """
+    if not args.dedup and not args.check_leakage:
+        return None
+    deduplicator = load_deduplicator(load_config(), mode=args.dedup, threshold=args.dedup_threshold)
+    duplicates = deduplicator.clusters(test_data, indices, pool if args.check_leakage else None)
+    print_dedup_summary(duplicates.summary())
+    print()
+    # Without --dedup the leakage is only reported
+    return duplicates if args.dedup else None
+
+def run_shard(shard, num_shards, directory, args, worker=False):
+    """
+    Evaluates one shard into `directory` (the worker of launch_shards when `worker`).
+    """
+    if args.backend:
+        # Worker processes may start without the parent's settings
+        set_backend(args.backend)
+    if worker and args.profile:
+        # Each worker process profiles its own shard, into the shard's directory
+        start_profiling()
+    evaluate(args, directory, shard)
+    if worker and args.profile:
+        save_profile(stop_profiling(), os.path.join(directory, os.path.basename(args.profile)), args.profile_format)
+    return read_from_json(os.path.join(directory, "run_report.json"))["total"]["calls"]
+
+def save_profile(profiler, filename, format="chrome"):
+    profiler.export(filename, format)
+    print()
+    print_profile(profiler.summary())
+    print(f"Trace of {len(profiler.spans)} spans saved to '{filename}'.")
+
+def main():
+    args = parse_args()
+    if args.profile:
+        start_profiling()
+    try:
+        run(args)
+    finally:
+        # Also on CTRL-C, to see where an interrupted run spent its time
+        profiler = stop_profiling()
+        if profiler:
+            save_profile(profiler, args.profile, args.profile_format)
+
+def run(args):
+    if args.backend:
+        set_backend(args.backend)
+    if args.num_shards < 1:
+        raise ValueError(f"--num-shards must be at least 1, got {args.num_shards}")
+    if args.batch and args.num_shards > 1:
+        raise ValueError("--batch runs cannot be sharded, the Batch API already parallelizes them")
+    if args.batch and args.dedup:
+        raise ValueError("--dedup is not supported with --batch")
+    if args.batch and args.pipeline != "two_step":
+        raise ValueError("--batch only runs the two_step pipeline, not --pipeline structured")
+    if args.batch and args.shortlist:
+        raise ValueError("--shortlist is not supported with --batch")
+    if args.batch and args.samples > 1:
+        raise ValueError("--samples is not supported with --batch")
+    if args.batch and args.cascade:
+        raise ValueError("--cascade is not supported with --batch")
+    if args.batch and args.stop_ci_width is not None:
+        raise ValueError("--stop-ci-width is not supported with --batch, whose batches are submitted whole")
+    sharded = args.num_shards > 1 or args.merge
+
+    if args.shard is not None and not args.merge:
+        run_shard(args.shard, args.num_shards, shard_dir(args.output_dir, args.shard, args.num_shards), args)
+        print(f"Shard {args.shard} of {args.num_shards} completed; run --merge once all shards are done.")
+        return
+    if sharded:
+        if not args.merge:
+            launch_shards(run_shard, args.num_shards, args.output_dir, args.workers, (args, True))
+        n_results, n_errors, metrics, chatbot_met, _ = merge_shards(args.output_dir, args.num_shards, get_tags(),
+                                                                    export_json=args.json_results)
+        print(f"Merged {args.num_shards} shards: {n_results} results ({n_errors} errors) in '{args.output_dir}'.")
+    else:
+        evaluate(args, args.output_dir)
 
     # Report evaluator metrics
-    results = read_from_json("results.json")
-    metrics = evaluator_metrics(results)
+    if not sharded:
+        # merge_shards computes those of sharded runs
+        with span("metrics"):
+            metrics, chatbot_met = run_metrics(args.output_dir)
     print_evaluator_metrics(metrics)
     print()
-    chatbot_met = chatbot_metrics(results)
     print_chatbot_metrics(chatbot_met)
 
+    if not (args.samples > 1 or args.cascade or args.detailed_metrics):
+        return
+    # Only these need the result dicts
+    results = load_results(args.output_dir)
+    if any(r.get("agreement") for r in results):
+        print()
+        print_agreement_metrics(agreement_metrics(results))
+    if args.cascade:
+        print()
+        print_tier_metrics(tier_metrics(results))
+
+    if args.detailed_metrics:
+        # numpy is only needed for the detailed report
+        from modules.metrics_vectorized import detailed_evaluator_metrics, print_detailed_metrics
+        print()
+        detailed_file = os.path.join(args.output_dir, "metrics_evaluator_detailed.json")
+        print_detailed_metrics(detailed_evaluator_metrics(results, get_tags(), filename=detailed_file))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+
+from modules.journal import ResultJournal
+from modules.clients.usage import usage_log, response_from_usage
+from modules.clients.registry import client_backend
+from modules.report import build_run_report, save_run_report, print_run_report
+from modules.runner import export_results
+from modules.prompting import (linearize_demonstrations_pass_fail, linearize_demonstrations_tagging,
+                               construct_prompt_pass_fail, construct_prompt_tagging,
+                               extract_valid_hashtags, parse_pass_fail, build_result, build_error)
+
+# Batch statuses after which polling stops
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+class OpenAIBatchBackend:
+    """
+    Submits batch files through the OpenAI/Azure OpenAI Batch API.
+
+    Parameters:
+        client: An OpenAI or AzureOpenAI client.
+        model (str): Model name (or Azure *global batch* deployment name) used in every request.
+        endpoint (str): Request URL inside the batch file, "/v1/chat/completions" for OpenAI
+                        and "/chat/completions" for Azure.
+    """
+    def __init__(self, client, model, endpoint="/v1/chat/completions"):
+        self.client = client
+        self.model = model
+        self.endpoint = endpoint
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=self.endpoint,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id, output_path):
+        """
+        Writes the batch's output lines (and error lines, if any) to `output_path`.
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        with open(output_path, "w", encoding="utf-8") as f:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(self.client.files.content(file_id).text)
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Batch API, so the batch flow can run offline.
+
+    Submitted files are copied into `workdir`; each request is answered by
+    `respond(body) -> str` when the batch is first polled, and the output file uses
+    the same line format as the Batch API.
+    """
+    def __init__(self, workdir="batch", model="local", respond=None):
+        self.workdir = workdir
+        self.model = model
+        self.endpoint = "/v1/chat/completions"
+        self.respond = respond or offline_response
+        self._done = set()
+
+    def submit(self, input_path):
+        os.makedirs(self.workdir, exist_ok=True)
+        batch_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        shutil.copyfile(input_path, os.path.join(self.workdir, f"{batch_id}.input.jsonl"))
+        return batch_id
+
+    def status(self, batch_id):
+        if batch_id not in self._done:
+            self._process(batch_id)
+            self._done.add(batch_id)
+        return "completed"
+
+    def download(self, batch_id, output_path):
+        shutil.copyfile(os.path.join(self.workdir, f"{batch_id}.output.jsonl"), output_path)
+
+    def _process(self, batch_id):
+        input_path = os.path.join(self.workdir, f"{batch_id}.input.jsonl")
+        output_path = os.path.join(self.workdir, f"{batch_id}.output.jsonl")
+        with open(input_path, "r", encoding="utf-8") as fin, open(output_path, "w", encoding="utf-8") as fout:
+            for n, line in enumerate(fin):
+                request = json.loads(line)
+                try:
+                    content = self.respond(request["body"])
+                    response, error = {
+                        "status_code": 200,
+                        "body": {"choices": [{"message": {"role": "assistant", "content": content}}]},
+                    }, None
+                except Exception as e:
+                    response, error = None, {"code": "local_error", "message": str(e)}
+                fout.write(json.dumps({
+                    "id": f"{batch_id}_req_{n}",
+                    "custom_id": request["custom_id"],
+                    "response": response,
+                    "error": error,
+                }) + "\n")
+
+def offline_response(body):
+    """
+    Deterministic placeholder answer for LocalBatchBackend: "Pass"/"Fail" for pass/fail
+    prompts and the first listed option for tagging prompts.
+    """
+    prompt = "\n".join(message["content"] for message in body["messages"])
+    if "Options:" in prompt:
+        options = [line[2:] for line in prompt.split("Options:")[-1].splitlines() if line.startswith("- ")]
+        return options[0] if options else ""
+    digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+    return "Fail" if digest[0] % 2 else "Pass"
+
+def write_batch_file(path, requests, model, endpoint, temp=1.0):
+    """
+    Writes (custom_id, messages) pairs as a Batch API input file.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, messages in requests:
+            f.write(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": endpoint,
+                "body": {
+                    "model": model,
+                    "temperature": temp,
+                    "messages": messages,
+                },
+            }) + "\n")
+
+def read_batch_output(path, stage=None):
+    """
+    Parses a Batch API output file, recording each response's token usage under `stage`.
+
+    Returns:
+        dict: {custom_id: (content, None)} for successful requests and
+              {custom_id: (None, error message)} for failed ones.
+    """
+    outputs = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response")
+            if response and response.get("status_code") == 200:
+                body = response["body"]
+                content = body["choices"][0]["message"]["content"]
+                usage_log.record(stage, response_from_usage(content, body.get("model", ""), body.get("usage")))
+                outputs[record["custom_id"]] = (content, None)
+            else:
+                error = record.get("error") or (response or {}).get("body", {}).get("error") or {}
+                outputs[record["custom_id"]] = (None, error.get("message", "batch request failed"))
+    return outputs
+
+def run_batch_stage(backend, stage, requests, workdir, temp=1.0, poll_interval=30):
+    """
+    Runs one stage (pass_fail or tagging) through the backend: writes the input file,
+    submits it, polls until the batch finishes and returns the parsed outputs.
+    """
+    input_path = os.path.join(workdir, f"{stage}_input.jsonl")
+    output_path = os.path.join(workdir, f"{stage}_output.jsonl")
+    write_batch_file(input_path, requests, backend.model, backend.endpoint, temp)
+
+    batch_id = backend.submit(input_path)
+    print(f"Submitted {len(requests)} {stage} requests as batch {batch_id}.")
+    status = backend.status(batch_id)
+    while status not in TERMINAL_STATUSES:
+        time.sleep(poll_interval)
+        status = backend.status(batch_id)
+    print(f"Batch {batch_id} finished with status '{status}'.")
+    if status != "completed":
+        raise RuntimeError(f"Batch {batch_id} for stage '{stage}' ended with status '{status}'")
+
+    backend.download(batch_id, output_path)
+    return read_batch_output(output_path, stage)
+
+def run_batch(data_test, demos, tags, backend, workdir=None, temp=1.0, poll_interval=30,
+              journal_path="results.jsonl", output_dir=".", export_json=False, selector=None,
+              indices=None, resume=False):
+    """
+    Batch API counterpart of runner.run_tests.
+
+    Stage 1 sends the pass/fail prompt for every example in one batch; stage 2 sends the
+    tagging prompt for the examples predicted "Fail". Outcomes use the same schema as
+    process_example and are written to the journal, then exported to a results store and
+    errors.json (plus results.json with `export_json`), all in output_dir as with run_tests.
+    The batch input and output files go to `workdir`, by default output_dir/batch.
+
+    With a `selector` (item -> list of demos, see runner.run_tests), each prompt shows the
+    demonstrations selected for its example instead of `demos`. `indices` and `resume`
+    work as in run_tests, e.g. to re-run the examples of errors.json (--retry-errors)
+    while keeping the other results of the journal.
+    """
+    if workdir is None:
+        workdir = os.path.join(output_dir, "batch")
+    os.makedirs(workdir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    journal = ResultJournal(os.path.join(output_dir, journal_path))
+    done = journal.completed_indices() if resume else set()
+    if done:
+        print(f"Resuming from '{journal.path}': skipping {len(done)} completed examples.")
+    pairs = zip(indices, data_test) if indices is not None else enumerate(data_test)
+    # idx -> example, for the examples still to evaluate
+    data_test = {idx: item for idx, item in pairs if idx not in done}
+    usage_log.reset()
+    start = time.perf_counter()
+    if selector is None:
+        # Shared by every example, so linearized once
+        pass_fail_demos_text = linearize_demonstrations_pass_fail(demos)
+        tagging_demos_text = linearize_demonstrations_tagging(demos)
+        selected = None
+    else:
+        pairs = data_test.items()
+        if hasattr(selector, "prefetch"):
+            pairs = selector.prefetch(pairs)
+        selected = {idx: selector(item) for idx, item in pairs}
+
+    def pass_fail_prompt(idx, item):
+        demos_text = pass_fail_demos_text if selected is None else linearize_demonstrations_pass_fail(selected[idx])
+        return construct_prompt_pass_fail(demos_text, item.text)
+
+    def tagging_prompt(idx, item):
+        demos_text = tagging_demos_text if selected is None else linearize_demonstrations_tagging(selected[idx])
+        return construct_prompt_tagging(demos_text, item.text, tags)
+
+    # Stage 1: pass/fail for everything
+    pass_fail_outputs = {}
+    if data_test:
+        pass_fail_outputs = run_batch_stage(
+            backend, "pass_fail",
+            [(f"pass_fail-{idx}", pass_fail_prompt(idx, item)) for idx, item in data_test.items()],
+            workdir, temp, poll_interval,
+        )
+
+    predicted, errors = {}, {}
+    for idx in data_test:
+        content, error = pass_fail_outputs.get(f"pass_fail-{idx}", (None, "missing from batch output"))
+        if error:
+            errors[idx] = error
+        else:
+            predicted[idx] = parse_pass_fail(content)
+
+    # Stage 2: tagging only for the predicted failures
+    failed = [idx for idx, pass_fail in predicted.items() if pass_fail == "Fail"]
+    tagging_outputs = {}
+    if failed:
+        tagging_outputs = run_batch_stage(
+            backend, "tagging",
+            [(f"tagging-{idx}", tagging_prompt(idx, data_test[idx])) for idx in failed],
+            workdir, temp, poll_interval,
+        )
+
+    with journal.open(resume=resume):
+        for idx, item in data_test.items():
+            if idx in errors:
+                journal.append(idx, error=build_error(item, errors[idx]))
+                continue
+            predicted_tags = []
+            if predicted[idx] == "Fail":
+                content, error = tagging_outputs.get(f"tagging-{idx}", (None, "missing from batch output"))
+                if error:
+                    journal.append(idx, error=build_error(item, error))
+                    continue
+                predicted_tags = extract_valid_hashtags(content, tags)
+            journal.append(idx, result=build_result(item, predicted[idx], predicted_tags))
+
+    results_path, n_results, n_errors = export_results(journal, tags, output_dir, export_json)
+    print(f"\nBatch experiment completed. {n_results} results saved to '{results_path}' ({n_errors} errors).")
+    usage_log.save(os.path.join(output_dir, "usage.json"))
+    # Batch calls have no per-request latency; cost uses regular (non-batch) prices
+    report = build_run_report(usage_log.snapshot(), time.perf_counter() - start)
+    save_run_report(report, os.path.join(output_dir, "run_report.json"))
+    print_run_report(report)
+    print()
+
+def make_batch_backend(name, workdir="batch"):
+    """
+    Builds a batch backend by name: "azure", "openai" or "local", the latter keeping
+    its files in workdir/local.
+    The SDK clients are only imported (see clients/registry.py) for the remote backends.
+    """
+    if name == "azure":
+        backend = client_backend("azure")
+        return OpenAIBatchBackend(backend.get_client(), backend.model_name(), endpoint="/chat/completions")
+    if name == "openai":
+        backend = client_backend("openai")
+        return OpenAIBatchBackend(backend.get_client(), backend.model_name())
+    if name == "local":
+        return LocalBatchBackend(os.path.join(workdir, "local"))
+    raise ValueError(f"Unknown batch backend '{name}', expected 'azure', 'openai' or 'local'")
@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+
+from modules.io import read_from_json, save_to_json
+from modules.data import ConvoItem
+from modules.report import percentile
+from modules.runner import run_tests, RUN_MODES, PIPELINES
+from modules.clients.usage import usage_log
+from modules.clients.registry import set_backend
+
+# End-to-end throughput benchmark of run_tests against the mock backend (clients/mock_client.py):
+# no API calls, so it can run in CI. Every size runs in a fresh process so peak memory is per size.
+#
+#   python -m modules.benchmark --sizes 1000 10000 --min-throughput 500 --max-peak-mb 300
+#
+# exits with status 1 if a threshold (or the --baseline comparison) is not met.
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+
+# Mock settings for the benchmark: short simulated latency, so the pipeline itself is measured
+BENCHMARK_MOCK_SETTINGS = {"latency": "lognormal", "latency_mean": 0.01, "latency_sigma": 0.5}
+
+WORDS = ("order refund shipping delivery payment card address cancel broken item agent reply "
+         "account password login coupon discount tracking warehouse customs invoice").split()
+
+def synthetic_tags(n=24):
+    return [f"#tag{i:02d}" for i in range(n)]
+
+def synthetic_items(n, tags, seed=0, words_per_item=60):
+    """
+    Lazily yields `n` reproducible ConvoItem with random text, pass/fail and tags.
+    """
+    rng = random.Random(seed)
+    for i in range(n):
+        text = f"[{i}] " + " ".join(rng.choices(WORDS, k=words_per_item))
+        if rng.random() < 0.3:
+            yield ConvoItem(text=text, pass_fail="Fail", expected=rng.sample(tags, rng.randint(1, 2)))
+        else:
+            yield ConvoItem(text=text, pass_fail="Pass", expected=[])
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux (bytes on macOS)
+    scale = 1 << 20 if sys.platform == "darwin" else 1 << 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def run_size(n, mode="async", concurrency=64, pipeline="two_step", mock_settings=None):
+    """
+    Runs `n` synthetic conversations through run_tests on the mock backend, in a
+    temporary directory and with the per-example output silenced.
+
+    Returns:
+        dict: conversations/sec, wall time, peak RSS (and its growth during the run),
+              and p50/p95/p99 call latency as seen by the pipeline.
+    """
+    from modules.clients.mock_client import configure_mock
+    set_backend("mock")
+    configure_mock(**(mock_settings or BENCHMARK_MOCK_SETTINGS))
+    tags = synthetic_tags()
+    demos = list(synthetic_items(16, tags, seed=-1))
+
+    cwd = os.getcwd()
+    rss_before = _peak_rss_mb()
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, "w") as devnull:
+        os.chdir(workdir)
+        try:
+            with contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                n_results, n_errors = run_tests(synthetic_items(n, tags), demos, tags, mode=mode,
+                                                concurrency=concurrency, pipeline=pipeline)
+                wall_time = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+    latencies = [call["latency"] for call in usage_log.snapshot()]
+    return {
+        "size": n,
+        "results": n_results,
+        "errors": n_errors,
+        "wall_time_s": wall_time,
+        "conversations_per_sec": n / wall_time if wall_time else None,
+        "calls": len(latencies),
+        "peak_rss_mb": _peak_rss_mb(),
+        "rss_growth_mb": _peak_rss_mb() - rss_before,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+    }
+
+def run_benchmark(sizes=DEFAULT_SIZES, mode="async", concurrency=64, pipeline="two_step", mock_settings=None):
+    """
+    Runs every size in its own (spawned) process and returns their measurements.
+    """
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for n in sizes:
+        with context.Pool(1) as pool:
+            row = pool.apply(run_size, (n, mode, concurrency, pipeline, mock_settings))
+        print_benchmark_row(row)
+        rows.append(row)
+    return rows
+
+def check_thresholds(rows, min_throughput=None, max_peak_mb=None, max_p99=None, baseline=None, tolerance=0.2):
+    """
+    Returns a list of human-readable failures, empty if every size is within limits.
+    With a baseline (a previous benchmark.json), throughput may not drop and peak memory
+    may not grow by more than `tolerance` for any size present in both.
+    """
+    failures = []
+    baseline_rows = {row["size"]: row for row in (baseline or {}).get("rows", [])}
+    for row in rows:
+        n = row["size"]
+        if row["results"] + row["errors"] != n:
+            failures.append(f"{n}: {row['results'] + row['errors']} outcomes recorded")
+        if min_throughput is not None and row["conversations_per_sec"] < min_throughput:
+            failures.append(f"{n}: {row['conversations_per_sec']:.0f} conversations/sec < {min_throughput}")
+        if max_peak_mb is not None and row["peak_rss_mb"] > max_peak_mb:
+            failures.append(f"{n}: peak RSS {row['peak_rss_mb']:.0f} MB > {max_peak_mb} MB")
+        if max_p99 is not None and row["latency_p99"] is not None and row["latency_p99"] > max_p99:
+            failures.append(f"{n}: p99 latency {row['latency_p99']:.3f}s > {max_p99}s")
+        if n in baseline_rows:
+            before = baseline_rows[n]
+            if row["conversations_per_sec"] < before["conversations_per_sec"] * (1 - tolerance):
+                failures.append(f"{n}: throughput {row['conversations_per_sec']:.0f}/s regressed from "
+                                f"{before['conversations_per_sec']:.0f}/s")
+            if row["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+                failures.append(f"{n}: peak RSS {row['peak_rss_mb']:.0f} MB regressed from {before['peak_rss_mb']:.0f} MB")
+    return failures
+
+def print_benchmark_row(row):
+    print(f"{row['size']:>8} conversations: {row['conversations_per_sec']:>8.0f}/s in {row['wall_time_s']:.1f}s, "
+          f"{row['errors']} errors, peak RSS {row['peak_rss_mb']:.0f} MB (+{row['rss_growth_mb']:.0f}), "
+          f"call latency p50/p95/p99 {row['latency_p50']:.3f}/{row['latency_p95']:.3f}/{row['latency_p99']:.3f}s")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark run_tests end to end against the mock LLM backend.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Numbers of synthetic conversations (default: 1000 10000 100000)")
+    parser.add_argument("--mode", choices=RUN_MODES, default="async")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--pipeline", choices=PIPELINES, default="two_step")
+    parser.add_argument("--latency-mean", type=float, default=BENCHMARK_MOCK_SETTINGS["latency_mean"],
+                        help="Mean simulated call latency in seconds")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of calls answered with a 429")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Share of calls that time out")
+    parser.add_argument("--output", default="benchmark.json", help="Where to save the measurements")
+    parser.add_argument("--baseline", help="Previous benchmark.json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression vs the baseline")
+    parser.add_argument("--min-throughput", type=float, help="Fail below this many conversations/sec")
+    parser.add_argument("--max-peak-mb", type=float, help="Fail above this peak RSS")
+    parser.add_argument("--max-p99", type=float, help="Fail above this p99 call latency (seconds)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    mock_settings = dict(BENCHMARK_MOCK_SETTINGS, latency_mean=args.latency_mean,
+                         rate_limit_rate=args.rate_limit_rate, timeout_rate=args.timeout_rate, timeout=1.0)
+    rows = run_benchmark(args.sizes, args.mode, args.concurrency, args.pipeline, mock_settings)
+    baseline = read_from_json(args.baseline) if args.baseline else None
+    save_to_json(args.output, {"mode": args.mode, "concurrency": args.concurrency, "pipeline": args.pipeline,
+                               "mock": mock_settings, "rows": rows})
+
+    failures = check_thresholds(rows, args.min_throughput, args.max_peak_mb, args.max_p99, baseline, args.tolerance)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
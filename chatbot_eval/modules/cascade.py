@@ -0,0 +1,105 @@
+import math
+
+# Where the confidence of the first tier's pass/fail answer comes from
+CONFIDENCE_SIGNALS = ("logprobs", "agreement")
+
+class Cascade:
+    """
+    Two-tier model cascade: every conversation is evaluated by the configured (cheap)
+    model first, and only those whose pass/fail answer is less confident than
+    `threshold` are evaluated again, from scratch, by `strong_model`.
+
+    The confidence is either the probability of the chosen label in the answer's token
+    logprobs, relative to the other label ("logprobs"), or the share of `samples`
+    completions that voted for it ("agreement", see prompting.vote_pass_fail). Answers
+    without a confidence (e.g. no logprobs returned) are escalated.
+
+    Parameters:
+        strong_model (str): Model or Azure deployment of the second tier.
+        threshold (float): Answers below this confidence are escalated.
+        signal (str): One of CONFIDENCE_SIGNALS.
+        samples (int): Completions per call of the first tier for the "agreement" signal.
+    """
+    def __init__(self, strong_model="gpt-4.1", threshold=0.9, signal="logprobs", samples=5):
+        if signal not in CONFIDENCE_SIGNALS:
+            raise ValueError(f"Unknown confidence signal '{signal}', expected one of {CONFIDENCE_SIGNALS}")
+        if signal == "agreement" and samples < 2:
+            raise ValueError("The agreement signal needs at least 2 samples")
+        self.strong_model = strong_model
+        self.threshold = threshold
+        self.signal = signal
+        self.samples = samples
+
+    @property
+    def logprobs(self):
+        # Whether the first tier must request logprobs
+        return self.signal == "logprobs"
+
+    def confidence(self, response, label, agreement):
+        """
+        Confidence of the first tier's pass/fail `label`, from its LLMResponse or its vote agreement.
+        """
+        if self.signal == "logprobs":
+            return label_confidence(response.logprobs, label)
+        return agreement
+
+    def escalates(self, confidence):
+        return confidence is None or confidence < self.threshold
+
+    def kept(self, outcome, confidence):
+        """
+        Marks a (result, error) outcome of the first tier as final.
+        """
+        result, error = outcome
+        if result is not None:
+            result["tier"] = "base"
+            result["confidence"] = confidence
+        return result, error
+
+    def escalated(self, outcome, base_pass_fail, confidence):
+        """
+        Marks a (result, error) outcome of the strong tier, keeping the first tier's answer
+        so the report can tell what the escalation changed.
+        """
+        result, error = outcome
+        if result is not None:
+            result["tier"] = "strong"
+            result["confidence"] = confidence
+            result["base_pass_fail"] = base_pass_fail
+        return result, error
+
+def _label(token):
+    text = token.strip().strip('"').strip()
+    return next((label for label in ("Pass", "Fail") if text.startswith(label)), None)
+
+def label_confidence(logprobs, label):
+    """
+    P(label) / (P("Pass") + P("Fail")) at the first token of the answer that is a
+    pass/fail label, summing the alternatives that spell each label. None when the
+    logprobs hold no such token.
+    """
+    for token in logprobs or []:
+        if _label(token["token"]) is None:
+            continue
+        probabilities = {"Pass": 0.0, "Fail": 0.0}
+        for alternative, logprob in (token["top"] or {token["token"]: token["logprob"]}).items():
+            name = _label(alternative)
+            if name:
+                probabilities[name] += math.exp(logprob)
+        total = sum(probabilities.values())
+        return probabilities[label] / total if total else None
+    return None
+
+def load_cascade(config, **overrides):
+    """
+    Builds the Cascade described by the [cascade] section of config.ini, updated with `overrides`.
+    """
+    section = config["cascade"] if config.has_section("cascade") else {}
+    settings = {
+        "strong_model": section.get("strong_model", "gpt-4.1").strip(),
+        "threshold": float(section.get("threshold", 0.9)),
+        "signal": section.get("signal", "logprobs").strip(),
+        "samples": int(section.get("samples", 5)),
+    }
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    return Cascade(**settings)
@@ -0,0 +1,228 @@
+import os
+import json
+import asyncio
+import time
+import sqlite3
+import hashlib
+import threading
+
+from modules.clients.usage import LLMResponse
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+CACHE_MODES = ("readwrite", "replay", "off")
+
+class CacheMiss(KeyError):
+    """
+    Raised in replay mode when a prompt has no cached response.
+    """
+
+class ResponseCache:
+    """
+    Persistent LLM response cache backed by a SQLite file.
+
+    Entries are keyed on a hash of (prompt, model/deployment, temperature, number of
+    completions, whether logprobs were requested) and evicted
+    least-recently-used first once the cache holds more than `max_entries` responses.
+    In read-only (replay) mode nothing is written, and a miss raises CacheMiss instead
+    of falling through to the API.
+    """
+    def __init__(self, path, max_entries=100_000, read_only=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Shared between the runner's worker threads, guarded by self._lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON responses(last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(prompt, model, temp, n=1, logprobs=False):
+        """
+        Returns the cache key for a request. The prompt may be a string or a list of messages.
+        """
+        # n and logprobs are only part of the key when they differ from the defaults, so
+        # plain requests keep the keys they had before these options existed
+        extra = [n, logprobs] if n != 1 or logprobs else []
+        payload = json.dumps([prompt, model, temp] + extra, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response for `key`, or None on a miss.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        """
+        Stores a response, evicting the least recently used entries if the cache is full.
+        """
+        if self.read_only:
+            return
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+                (key, response, time.time())
+            )
+            # INSERT OR REPLACE reports 1 row either way, so recount only when we may be over
+            self._size += cursor.rowcount
+            if self._size > self.max_entries:
+                self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                excess = self._size - self.max_entries
+                if excess > 0:
+                    self._conn.execute(
+                        "DELETE FROM responses WHERE key IN "
+                        "(SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                        (excess,)
+                    )
+                    self._size -= excess
+            self._conn.commit()
+
+    def lookup(self, prompt, model, temp, n=1, logprobs=False):
+        """
+        Returns (key, cached_response). In replay mode a miss raises CacheMiss.
+        """
+        key = self.make_key(prompt, model, temp, n, logprobs)
+        response = self.get(key)
+        if response is None and self.read_only:
+            raise CacheMiss(f"No cached response for prompt (key {key[:12]}) in replay mode")
+        return key, response
+
+    def stats(self):
+        """
+        Returns hit/miss counters for this process.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self._size,
+        }
+
+# One cache instance per file, shared by every client in the process
+_caches = {}
+
+def load_cache(config):
+    """
+    Builds (or reuses) the response cache described by the [cache] section of config.ini.
+    Returns None when caching is disabled or the section is missing.
+    """
+    if not config.has_section("cache"):
+        return None
+    section = config["cache"]
+    mode = section.get("mode", "readwrite").strip()
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode '{mode}', expected one of {CACHE_MODES}")
+    if mode == "off":
+        return None
+
+    path = section.get("path", "cache/responses.sqlite").strip()
+    if not os.path.isabs(path):
+        path = os.path.join(PROJECT_ROOT, path)
+    if path not in _caches:
+        _caches[path] = ResponseCache(
+            path,
+            max_entries=section.getint("max_entries", 100_000),
+            read_only=(mode == "replay"),
+        )
+    return _caches[path]
+
+def _stored(response, plain):
+    # What the cache keeps of a response: its content, or a JSON object that also holds
+    # its samples and logprobs when those were requested
+    if plain:
+        return response.content
+    return json.dumps({"content": response.content, "samples": response.samples, "logprobs": response.logprobs},
+                      ensure_ascii=False)
+
+def _from_cache(stored, model, plain):
+    if plain:
+        return LLMResponse(content=stored, model=model, from_cache=True)
+    return LLMResponse(model=model, from_cache=True, **json.loads(stored))
+
+def cached_call(cache, prompt, model, temp, call, n=1, logprobs=False):
+    """
+    Returns the cached response for the request if there is one, otherwise runs
+    `call()` (which returns an LLMResponse) and stores its content (with all `n`
+    samples and the logprobs, when requested).
+    Cache hits come back as an LLMResponse with from_cache=True and no token usage.
+    """
+    if cache is None:
+        return call()
+    plain = n == 1 and not logprobs
+    key, stored = cache.lookup(prompt, model, temp, n, logprobs)
+    if stored is not None:
+        return _from_cache(stored, model, plain)
+    response = call()
+    cache.put(key, _stored(response, plain))
+    return response
+
+# Requests awaiting the API right now, so identical concurrent prompts share one call
+_in_flight = {}
+
+async def acached_call(cache, prompt, model, temp, call, n=1, logprobs=False):
+    """
+    Async version of cached_call, `call()` must return an awaitable.
+    An identical request already in flight on the event loop is awaited instead of
+    being sent again (its answer also comes back with from_cache=True), so concurrent
+    duplicates cost one call even before the first response reaches the cache.
+    """
+    plain = n == 1 and not logprobs
+    key = ResponseCache.make_key(prompt, model, temp, n, logprobs)
+    if key in _in_flight:
+        stored = await asyncio.shield(_in_flight[key])
+        if stored is not None:
+            return _from_cache(stored, model, plain)
+        # The shared call failed: make our own, so errors are reported per request
+
+    if cache is not None:
+        key, stored = cache.lookup(prompt, model, temp, n, logprobs)
+        if stored is not None:
+            return _from_cache(stored, model, plain)
+
+    shared = _in_flight.setdefault(key, asyncio.get_running_loop().create_future())
+    stored = None
+    try:
+        response = await call()
+        stored = _stored(response, plain)
+        if cache is not None:
+            cache.put(key, stored)
+        return response
+    finally:
+        if _in_flight.get(key) is shared:
+            del _in_flight[key]
+        if not shared.done():
+            shared.set_result(stored)
+
+def print_cache_stats():
+    """
+    Prints hit/miss counters for every cache opened in this process.
+    """
+    for path, cache in _caches.items():
+        stats = cache.stats()
+        mode = "replay" if cache.read_only else "readwrite"
+        print(f"Response cache ({mode}, {os.path.relpath(path, PROJECT_ROOT)}): "
+              f"{stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries")
@@ -0,0 +1,65 @@
+import weakref
+import asyncio
+import importlib.util
+
+# Connection pool settings shared by every backend, overridable in the [http] section of config.ini.
+# keepalive_expiry keeps idle connections (and their TLS sessions) around between bursts of calls.
+DEFAULT_HTTP_SETTINGS = {
+    "max_connections": 64,
+    "max_keepalive_connections": 32,
+    "keepalive_expiry": 30.0,
+    "timeout": 60.0,
+    "connect_timeout": 10.0,
+}
+
+_settings = dict(DEFAULT_HTTP_SETTINGS)
+_client = None
+# httpx.AsyncClient connections belong to the event loop that opened them, so there is one pool per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+def configure_http(config):
+    """
+    Applies the [http] section of config.ini (max_connections, max_keepalive_connections,
+    keepalive_expiry, timeout, connect_timeout) to pools created from now on.
+    """
+    if config.has_section("http"):
+        for key, default in DEFAULT_HTTP_SETTINGS.items():
+            _settings[key] = type(default)(config["http"].get(key, default))
+
+def http2_available():
+    """
+    HTTP/2 multiplexes concurrent requests over few connections; httpx needs the `h2` package for it.
+    """
+    return importlib.util.find_spec("h2") is not None
+
+def _client_kwargs():
+    import httpx
+    return {
+        "limits": httpx.Limits(max_connections=_settings["max_connections"],
+                               max_keepalive_connections=_settings["max_keepalive_connections"],
+                               keepalive_expiry=_settings["keepalive_expiry"]),
+        "timeout": httpx.Timeout(_settings["timeout"], connect=_settings["connect_timeout"]),
+        "http2": http2_available(),
+    }
+
+def get_http_client():
+    """
+    Returns the process-wide httpx.Client used by the sync SDK clients, created on first use.
+    """
+    global _client
+    if _client is None:
+        import httpx
+        _client = httpx.Client(**_client_kwargs())
+    return _client
+
+def get_async_http_client():
+    """
+    Returns the httpx.AsyncClient of the running event loop, created on first use.
+    Every async SDK client created on the same loop shares its connections.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        import httpx
+        client = _async_clients[loop] = httpx.AsyncClient(**_client_kwargs())
+    return client
@@ -0,0 +1,223 @@
+import math
+import time
+import json
+import types
+import random
+import asyncio
+import hashlib
+import threading
+
+from modules.clients.cache import ResponseCache, cached_call, acached_call
+from modules.clients.usage import usage_log, LLMResponse
+from modules.clients.ratelimit import load_rate_limits, call_with_retries, acall_with_retries
+from modules.clients.registry import load_config
+
+# In-process stand-in for the chat-completions backends, for load tests and offline runs.
+# Select it with `--backend mock` or `[llm] backend = mock`; it needs no SDK or credentials.
+# Answers are deterministic functions of the conversation, and so are the simulated
+# latency, 429s and timeouts (of the conversation and the attempt number), so runs are
+# reproducible regardless of scheduling. Responses are never stored in the response cache.
+DEFAULT_MOCK_SETTINGS = {
+    "model": "mock",
+    "latency": "lognormal",     # fixed | uniform | exponential | lognormal
+    "latency_mean": 0.2,        # seconds
+    "latency_sigma": 0.5,       # lognormal only
+    "rate_limit_rate": 0.0,     # share of attempts answered with a 429
+    "retry_after": 1.0,         # seconds, sent in the 429's Retry-After header
+    "timeout_rate": 0.0,        # share of attempts that hang and time out
+    "timeout": 10.0,            # seconds before a hanging attempt raises
+    "fail_rate": 0.3,           # share of conversations answered "Fail"
+    "max_tags": 2,
+    "sample_disagreement": 0.0, # share of the extra samples (n > 1) answered independently of the first
+    "seed": 0,
+}
+
+settings = None
+_rate_limits = None
+_attempts = {}
+_lock = threading.Lock()
+
+class MockAPIError(Exception):
+    """
+    HTTP error raised by the mock, shaped like the SDK's APIStatusError
+    (`status_code`, and `response.headers` for Retry-After).
+    """
+    def __init__(self, status_code, message, headers=None):
+        super().__init__(f"Error code: {status_code} - {message}")
+        self.status_code = status_code
+        self.response = types.SimpleNamespace(status_code=status_code, headers=headers or {})
+
+def configure_mock(**overrides):
+    """
+    Sets the mock's behaviour: DEFAULT_MOCK_SETTINGS updated with the [mock] section of
+    config.ini and then with `overrides` (e.g. configure_mock(latency_mean=0.01)).
+    """
+    global settings, _rate_limits
+    config = load_config()
+    settings = dict(DEFAULT_MOCK_SETTINGS)
+    if config.has_section("mock"):
+        for key, default in DEFAULT_MOCK_SETTINGS.items():
+            if key in config["mock"]:
+                settings[key] = type(default)(config["mock"][key])
+    settings.update(overrides)
+    # Same limiter and retries as the real backends ([ratelimit] in config.ini)
+    _rate_limits = load_rate_limits(config)
+    _attempts.clear()
+    return settings
+
+def _settings():
+    return settings if settings is not None else configure_mock()
+
+def model_name():
+    return _settings()["model"]
+
+def _messages(prompt):
+    return [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+
+def _rng(*parts):
+    digest = hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+def mock_answer(messages, json_mode=False, sample=0):
+    """
+    Deterministic answer to a prompt built by modules.prompting: pass/fail and the
+    hashtags (picked from the prompt's "Options:" list) only depend on the conversation
+    in the last message, so both stages of the two-step pipeline agree with each other
+    and with the structured pipeline. Extra samples of the same request (`sample` > 0)
+    repeat the first answer, except for a `sample_disagreement` share drawn on their own.
+    """
+    s = _settings()
+    conversation = messages[-1]["content"]
+    rng = _rng(s["seed"], conversation)
+    if sample and _rng(s["seed"], conversation, "disagree", sample).random() < s["sample_disagreement"]:
+        rng = _rng(s["seed"], conversation, sample)
+    pass_fail = "Fail" if rng.random() < s["fail_rate"] else "Pass"
+
+    prefix = "\n".join(message["content"] for message in messages[:-1])
+    options = []
+    if "Options:" in prefix:
+        options = [line[2:] for line in prefix.split("Options:")[-1].splitlines() if line.startswith("- ")]
+    tags = rng.sample(options, min(len(options), rng.randint(1, s["max_tags"]))) if options else []
+
+    if json_mode:
+        return json.dumps({"pass_fail": pass_fail, "tags": tags if pass_fail == "Fail" else []})
+    if options:
+        return ", ".join(tags)
+    return pass_fail
+
+def _count_tokens(text):
+    return math.ceil(len(text) / 4)
+
+def _plan(prompt):
+    """
+    Decides the outcome of this attempt: (latency, error or None).
+    """
+    s = _settings()
+    key = ResponseCache.make_key(prompt, s["model"], None)
+    attempt = 0
+    retried = bool(s["rate_limit_rate"] or s["timeout_rate"])
+    if retried:
+        # Retries of the same prompt are new attempts with their own outcome
+        with _lock:
+            attempt = _attempts.get(key, 0)
+            _attempts[key] = attempt + 1
+    rng = _rng(s["seed"], key, attempt)
+
+    mean = s["latency_mean"]
+    if s["latency"] == "fixed":
+        latency = mean
+    elif s["latency"] == "uniform":
+        latency = rng.uniform(0, 2 * mean)
+    elif s["latency"] == "exponential":
+        latency = rng.expovariate(1 / mean) if mean > 0 else 0.0
+    elif s["latency"] == "lognormal":
+        sigma = s["latency_sigma"]
+        latency = rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma) if mean > 0 else 0.0
+    else:
+        raise ValueError(f"Unknown mock latency distribution '{s['latency']}'")
+
+    draw = rng.random()
+    if draw < s["rate_limit_rate"]:
+        return latency, MockAPIError(429, "Rate limit exceeded (mock)", {"retry-after": str(s["retry_after"])})
+    if draw < s["rate_limit_rate"] + s["timeout_rate"]:
+        return s["timeout"], TimeoutError("Request timed out (mock)")
+    if retried:
+        # Not retried any more, so its count can go (it would otherwise grow with the test set)
+        with _lock:
+            _attempts.pop(key, None)
+    return latency, None
+
+def mock_logprobs(messages, content):
+    """
+    Simulated token logprobs of an answer: the "Pass"/"Fail" token (if any) gets a
+    deterministic probability between 0.5 and 1, the rest of the answer is certain.
+    """
+    label = next((label for label in ("Pass", "Fail") if label in content), None)
+    if label is None:
+        return [{"token": content, "logprob": 0.0, "top": {content: 0.0}}]
+    p = 0.5 + 0.5 * _rng(_settings()["seed"], messages[-1]["content"], "confidence").random()
+    other = "Fail" if label == "Pass" else "Pass"
+    before, after = content.split(label, 1)
+    tokens = [{"token": before, "logprob": 0.0, "top": {before: 0.0}}] if before else []
+    tokens.append({"token": label, "logprob": math.log(p), "top": {label: math.log(p), other: math.log(1 - p) if p < 1 else -100.0}})
+    if after:
+        tokens.append({"token": after, "logprob": 0.0, "top": {after: 0.0}})
+    return tokens
+
+def _response(prompt, json_mode, latency, n=1, model=None, logprobs=False):
+    messages = _messages(prompt)
+    samples = [mock_answer(messages, json_mode, sample) for sample in range(n)]
+    prefix_tokens = sum(_count_tokens(message["content"]) for message in messages[:-1])
+    return LLMResponse(
+        content=samples[0],
+        model=model or model_name(),
+        prompt_tokens=prefix_tokens + _count_tokens(messages[-1]["content"]),
+        # Providers cache prefixes of 1024+ tokens (see report.MIN_CACHEABLE_PREFIX)
+        cached_tokens=prefix_tokens if prefix_tokens >= 1024 else 0,
+        completion_tokens=sum(_count_tokens(content) for content in samples),
+        latency=latency,
+        samples=samples if n > 1 else None,
+        logprobs=mock_logprobs(messages, samples[0]) if logprobs else None,
+    )
+
+def prompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Mock counterpart of openai_client_azure.prompt_model: sleeps for the simulated
+    latency, then returns the deterministic answer or raises the simulated error.
+    """
+    def attempt():
+        latency, error = _plan(prompt)
+        start = time.perf_counter()
+        time.sleep(latency)
+        if error:
+            raise error
+        return _response(prompt, json_mode, time.perf_counter() - start, n, model, logprobs), {}
+
+    def call():
+        return call_with_retries(*_rate_limits, prompt, attempt)
+    llm_response = cached_call(None, prompt, model or model_name(), temp, call, n, logprobs)
+    usage_log.record(stage, llm_response)
+    return llm_response
+
+async def aprompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Async version of prompt_model.
+    """
+    async def attempt():
+        latency, error = _plan(prompt)
+        start = time.perf_counter()
+        await asyncio.sleep(latency)
+        if error:
+            raise error
+        return _response(prompt, json_mode, time.perf_counter() - start, n, model, logprobs), {}
+
+    async def call():
+        return await acall_with_retries(*_rate_limits, prompt, attempt)
+    llm_response = await acached_call(None, prompt, model or model_name(), temp, call, n, logprobs)
+    usage_log.record(stage, llm_response)
+    return llm_response
+
+if __name__ == "__main__":
+    configure_mock(latency_mean=0.01)
+    response = prompt_model("Say hello world back to me.")
+    print(response.content)
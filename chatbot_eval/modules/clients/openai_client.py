@@ -1,37 +1,143 @@
-import os
-import configparser
-from openai import OpenAI
+import time
+import weakref
+import asyncio
+from functools import lru_cache
+from openai import OpenAI, AsyncOpenAI
+from modules.clients.cache import load_cache, cached_call, acached_call
+from modules.clients.usage import usage_log, response_from_completion
+from modules.clients.ratelimit import load_rate_limits, call_with_retries, acall_with_retries
+from modules.clients.http import get_http_client, get_async_http_client
+from modules.clients.registry import load_config
 
-# Read API key from config file
-config = configparser.ConfigParser()
-config_file = os.path.join(os.path.dirname(__file__), "../../config/config.ini")
-config.read(config_file)
-api_key = config['openai']['api_key']
-model = config['openai']['model']
+# Settings and clients are only read/created on first use, see modules/clients/registry.py
 
-# Create a new OpenAI client
-client = OpenAI(api_key=api_key)
+def _settings():
+    # [openai] api_key, model
+    return load_config()["openai"]
 
-def prompt_model(prompt, temp=1.0):
+def model_name():
+    return _settings()["model"]
+
+@lru_cache(maxsize=None)
+def _cache():
+    # Optional on-disk response cache, see the [cache] section of config.ini
+    return load_cache(load_config())
+
+@lru_cache(maxsize=None)
+def _rate_limits():
+    # (RateLimiter, RetryPolicy) shared by every call of this backend
+    return load_rate_limits(load_config())
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    The OpenAI client, on the shared connection pool.
+    """
+    return OpenAI(api_key=_settings()["api_key"], http_client=get_http_client(), max_retries=0)
+
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    """
+    Async counterpart used by the concurrent runner, one per event loop (like its connection pool).
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = AsyncOpenAI(api_key=_settings()["api_key"], http_client=get_async_http_client(),
+                                           max_retries=0)
+    return _async_clients[loop]
+
+def _response_format(json_mode):
+    return {"response_format": {"type": "json_object"}} if json_mode else {}
+
+def _samples(n):
+    # Several completions of the same prompt in one request (billed once for the prompt)
+    return {"n": n} if n > 1 else {}
+
+def _logprobs(logprobs):
+    # Token logprobs of the answer with the likeliest alternatives, e.g. for confidence scores
+    return {"logprobs": True, "top_logprobs": 5} if logprobs else {}
+
+def _messages(prompt):
+    """
+    Accepts either a plain prompt string or a list of role-separated chat messages.
+    """
+    return [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+
+def prompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
     """
     Sends a prompt to the OpenAI model and returns the response.
     Args:
-        prompt (str): The prompt to send to the model.
+        prompt (str or list): The prompt, or a list of chat messages, to send to the model.
         temp (float): The temperature for the model's response.
+        json_mode (bool): Constrain the model to answer with a JSON object.
+        stage (str): Pipeline stage the call belongs to, used for usage telemetry.
+        n (int): Number of completions to sample, returned in LLMResponse.samples if > 1.
+        model (str): Model to use instead of the configured one (e.g. a stronger tier).
+        logprobs (bool): Also return the answer's token logprobs (LLMResponse.logprobs).
     Returns:
-        str: The model's response.
-    """
-    completion = client.chat.completions.create(
-        model=model,
-        store=True,
-        temperature=temp,
-        messages=[
-            {"role": "user", 'content': prompt}
-        ]
-    )
-    return completion.choices[0].message.content
+        LLMResponse: The model's response with token usage and latency, served from
+                     the response cache when it is enabled.
+    """
+    model = model or model_name()
+
+    def attempt():
+        start = time.perf_counter()
+        raw = get_client().chat.completions.with_raw_response.create(
+            model=model,
+            store=True,
+            temperature=temp,
+            messages=_messages(prompt),
+            **_response_format(json_mode),
+            **_samples(n),
+            **_logprobs(logprobs)
+        )
+        return response_from_completion(raw.parse(), model, time.perf_counter() - start), raw.headers
+
+    def call():
+        # Rate-limited and retried, see [ratelimit] in config.ini
+        return call_with_retries(*_rate_limits(), prompt, attempt)
+    llm_response = cached_call(_cache(), prompt, model, temp, call, n, logprobs)
+    usage_log.record(stage, llm_response)
+    return llm_response
+
+async def aprompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Async version of prompt_model, sends the prompt through the AsyncOpenAI client.
+    Args:
+        prompt (str or list): The prompt, or a list of chat messages, to send to the model.
+        temp (float): The temperature for the model's response.
+        json_mode (bool): Constrain the model to answer with a JSON object.
+        stage (str): Pipeline stage the call belongs to, used for usage telemetry.
+        n (int): Number of completions to sample, returned in LLMResponse.samples if > 1.
+        model (str): Model to use instead of the configured one (e.g. a stronger tier).
+        logprobs (bool): Also return the answer's token logprobs (LLMResponse.logprobs).
+    Returns:
+        LLMResponse: The model's response with token usage and latency, served from
+                     the response cache when it is enabled.
+    """
+    model = model or model_name()
+
+    async def attempt():
+        start = time.perf_counter()
+        raw = await get_async_client().chat.completions.with_raw_response.create(
+            model=model,
+            store=True,
+            temperature=temp,
+            messages=_messages(prompt),
+            **_response_format(json_mode),
+            **_samples(n),
+            **_logprobs(logprobs)
+        )
+        return response_from_completion(raw.parse(), model, time.perf_counter() - start), raw.headers
+
+    async def call():
+        return await acall_with_retries(*_rate_limits(), prompt, attempt)
+    llm_response = await acached_call(_cache(), prompt, model, temp, call, n, logprobs)
+    usage_log.record(stage, llm_response)
+    return llm_response
 
 if __name__ == "__main__":
     # Test the LLM client is working
-    text = prompt_model("Say hello world back to me.")
-    print(text)
\ No newline at end of file
+    response = prompt_model("Say hello world back to me.")
+    print(response.content)
\ No newline at end of file
@@ -1,35 +1,137 @@
-import os
-import configparser
-from openai import AzureOpenAI
-
-# Read Azure OpenAI config from config.ini
-config = configparser.ConfigParser()
-config_file = os.path.join(os.path.dirname(__file__), "../../config/config.ini")
-config.read(config_file)
-
-api_key = config['azure_openai']['api_key']
-endpoint = config['azure_openai']['endpoint']
-deployment = config['azure_openai']['deployment']
-api_version = config['azure_openai']['api_version']
-
-# Initialize Azure OpenAI client
-client = AzureOpenAI(
-    api_key=api_key,
-    api_version=api_version,
-    azure_endpoint=endpoint
-)
-
-def prompt_model(prompt, temp=1.0):
-    """
-    Sends a prompt to the Azure OpenAI model and returns the response.
-    """
-    response = client.chat.completions.create(
-        model=deployment,  # this must match the *deployment name* in Azure
-        temperature=temp,
-        messages=[{"role": "user", "content": prompt}]
+import time
+import weakref
+import asyncio
+from functools import lru_cache
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from modules.clients.cache import load_cache, cached_call, acached_call
+from modules.clients.usage import usage_log, response_from_completion
+from modules.clients.ratelimit import load_rate_limits, call_with_retries, acall_with_retries
+from modules.clients.http import get_http_client, get_async_http_client
+from modules.clients.registry import load_config
+
+# Settings and clients are only read/created on first use, see modules/clients/registry.py
+
+def _settings():
+    # [azure_openai] api_key, endpoint, deployment, api_version
+    return load_config()["azure_openai"]
+
+def model_name():
+    return _settings()["deployment"]
+
+@lru_cache(maxsize=None)
+def _cache():
+    # Optional on-disk response cache, see the [cache] section of config.ini
+    return load_cache(load_config())
+
+@lru_cache(maxsize=None)
+def _rate_limits():
+    # (RateLimiter, RetryPolicy) shared by every call of this backend
+    return load_rate_limits(load_config())
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    The Azure OpenAI client, on the shared connection pool.
+    """
+    settings = _settings()
+    return AzureOpenAI(
+        api_key=settings["api_key"],
+        api_version=settings["api_version"],
+        azure_endpoint=settings["endpoint"],
+        http_client=get_http_client(),
+        max_retries=0
     )
-    return response.choices[0].message.content
+
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    """
+    Async counterpart used by the concurrent runner, one per event loop (like its connection pool).
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        settings = _settings()
+        _async_clients[loop] = AsyncAzureOpenAI(
+            api_key=settings["api_key"],
+            api_version=settings["api_version"],
+            azure_endpoint=settings["endpoint"],
+            http_client=get_async_http_client(),
+            max_retries=0
+        )
+    return _async_clients[loop]
+
+def _response_format(json_mode):
+    return {"response_format": {"type": "json_object"}} if json_mode else {}
+
+def _samples(n):
+    # Several completions of the same prompt in one request (billed once for the prompt)
+    return {"n": n} if n > 1 else {}
+
+def _logprobs(logprobs):
+    # Token logprobs of the answer with the likeliest alternatives, e.g. for confidence scores
+    return {"logprobs": True, "top_logprobs": 5} if logprobs else {}
+
+def _messages(prompt):
+    """
+    Accepts either a plain prompt string or a list of role-separated chat messages.
+    """
+    return [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+
+def prompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Sends a prompt (a string or a list of chat messages) to the Azure OpenAI model
+    and returns an LLMResponse with the content, token usage and latency. The call
+    is recorded under `stage` in the usage log. With json_mode the model is
+    constrained to answer with a JSON object, and with n > 1 the model samples n
+    completions in the one request (LLMResponse.samples). `model` sends the request to
+    another deployment than the configured one, and `logprobs` also returns the
+    answer's token logprobs. Responses are served from the response cache when it is enabled.
+    """
+    deployment = model or model_name()
+
+    def attempt():
+        start = time.perf_counter()
+        raw = get_client().chat.completions.with_raw_response.create(
+            model=deployment,  # this must match the *deployment name* in Azure
+            temperature=temp,
+            messages=_messages(prompt),
+            **_response_format(json_mode),
+            **_samples(n),
+            **_logprobs(logprobs)
+        )
+        return response_from_completion(raw.parse(), deployment, time.perf_counter() - start), raw.headers
+
+    def call():
+        # Rate-limited and retried, see [ratelimit] in config.ini
+        return call_with_retries(*_rate_limits(), prompt, attempt)
+    llm_response = cached_call(_cache(), prompt, deployment, temp, call, n, logprobs)
+    usage_log.record(stage, llm_response)
+    return llm_response
+
+async def aprompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Async version of prompt_model, sends the prompt through the AsyncAzureOpenAI client.
+    """
+    deployment = model or model_name()
+
+    async def attempt():
+        start = time.perf_counter()
+        raw = await get_async_client().chat.completions.with_raw_response.create(
+            model=deployment,  # this must match the *deployment name* in Azure
+            temperature=temp,
+            messages=_messages(prompt),
+            **_response_format(json_mode),
+            **_samples(n),
+            **_logprobs(logprobs)
+        )
+        return response_from_completion(raw.parse(), deployment, time.perf_counter() - start), raw.headers
+
+    async def call():
+        return await acall_with_retries(*_rate_limits(), prompt, attempt)
+    llm_response = await acached_call(_cache(), prompt, deployment, temp, call, n, logprobs)
+    usage_log.record(stage, llm_response)
+    return llm_response
 
 if __name__ == "__main__":
-    text = prompt_model("Say hello world back to me.")
-    print(text)
\ No newline at end of file
+    response = prompt_model("Say hello world back to me.")
+    print(response.content)
\ No newline at end of file
@@ -0,0 +1,297 @@
+import time
+import random
+import weakref
+import asyncio
+import threading
+from functools import lru_cache
+
+from modules.clients.cache import load_cache, cached_call, acached_call
+from modules.clients.usage import usage_log, response_from_completion
+from modules.clients.ratelimit import (RateLimiter, RetryPolicy, load_rate_limits, config_number, estimate_tokens,
+                                       is_retryable, status_code, error_headers)
+from modules.clients.http import get_http_client, get_async_http_client
+from modules.clients.registry import load_config
+
+# Fans requests out over several deployments, selected with `--backend pool` or `[llm] backend = pool`.
+# Every [endpoint:<name>] section of config.ini is one deployment:
+#
+#   [endpoint:eastus]
+#   type = azure                 ; azure (api_key, endpoint, deployment, api_version) or openai (api_key, model)
+#   weight = 2                   ; share of the traffic relative to the other endpoints
+#   max_concurrency = 16         ; requests in flight on this endpoint at most
+#   rpm = 600                    ; optional per-endpoint budgets, otherwise learned from its headers
+#   tpm = 200000
+#
+# and [pool] sets the routing (least_outstanding or weighted), when an endpoint is
+# drained (unhealthy_after consecutive failures) and for how long (cooldown seconds).
+
+ROUTING_MODES = ("least_outstanding", "weighted")
+
+class Endpoint:
+    """
+    One deployment of the pool: its lazily created SDK clients, rate limiter, concurrency
+    budget, outstanding request count and health.
+    """
+    def __init__(self, name, settings, headroom=0.9):
+        self.name = name
+        self.kind = settings.get("type", "azure").strip()
+        if self.kind not in ("azure", "openai"):
+            raise ValueError(f"Endpoint '{name}': unknown type '{self.kind}', expected 'azure' or 'openai'")
+        self.settings = settings
+        self.model = settings["deployment"] if self.kind == "azure" else settings["model"]
+        self.weight = config_number(settings, "weight", 1.0)
+        self.max_concurrency = config_number(settings, "max_concurrency", 16, int)
+        # Limits left empty are learned from the endpoint's headers
+        self.limiter = RateLimiter(rpm=config_number(settings, "rpm", None), tpm=config_number(settings, "tpm", None),
+                                   headroom=headroom)
+
+        self.outstanding = 0
+        self.failures = 0              # consecutive
+        self.down_until = 0.0
+        self.stats = {"calls": 0, "errors": 0, "drained": 0}
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._client = None
+
+    def healthy(self, now):
+        return now >= self.down_until and now >= self.limiter.paused_until
+
+    def _client_kwargs(self):
+        if self.kind == "azure":
+            return {"api_key": self.settings["api_key"], "api_version": self.settings["api_version"],
+                    "azure_endpoint": self.settings["endpoint"], "max_retries": 0}
+        return {"api_key": self.settings["api_key"], "max_retries": 0}
+
+    def _request_kwargs(self, prompt, options):
+        # options: temp, json_mode, n, model, logprobs (see prompt_model)
+        kwargs = {
+            "model": options["model"] or self.model,
+            "temperature": options["temp"],
+            "messages": [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt,
+        }
+        if self.kind == "openai":
+            kwargs["store"] = True
+        if options["json_mode"]:
+            kwargs["response_format"] = {"type": "json_object"}
+        if options["n"] > 1:
+            kwargs["n"] = options["n"]
+        if options["logprobs"]:
+            kwargs.update(logprobs=True, top_logprobs=5)
+        return kwargs
+
+    def client(self):
+        if self._client is None:
+            from openai import AzureOpenAI, OpenAI
+            factory = AzureOpenAI if self.kind == "azure" else OpenAI
+            self._client = factory(http_client=get_http_client(), **self._client_kwargs())
+        return self._client
+
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            from openai import AsyncAzureOpenAI, AsyncOpenAI
+            factory = AsyncAzureOpenAI if self.kind == "azure" else AsyncOpenAI
+            self._async_clients[loop] = factory(http_client=get_async_http_client(), **self._client_kwargs())
+        return self._async_clients[loop]
+
+    def async_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_semaphores:
+            self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._async_semaphores[loop]
+
+    def send(self, prompt, options):
+        kwargs = self._request_kwargs(prompt, options)
+        with self._semaphore:
+            start = time.perf_counter()
+            raw = self.client().chat.completions.with_raw_response.create(**kwargs)
+            return response_from_completion(raw.parse(), kwargs["model"], time.perf_counter() - start), raw.headers
+
+    async def asend(self, prompt, options):
+        kwargs = self._request_kwargs(prompt, options)
+        async with self.async_semaphore():
+            start = time.perf_counter()
+            raw = await self.async_client().chat.completions.with_raw_response.create(**kwargs)
+            return response_from_completion(raw.parse(), kwargs["model"], time.perf_counter() - start), raw.headers
+
+class EndpointPool:
+    """
+    Routes each request to one endpoint and fails over to the others.
+
+    Routing is "least_outstanding" (the healthy endpoint with the fewest in-flight
+    requests relative to its weight) or "weighted" (random, proportional to weight).
+    An endpoint is drained for `cooldown` seconds after `unhealthy_after` consecutive
+    transient failures, or while its limiter is paused by a 429; once the cooldown is
+    over it gets traffic again and is drained at once if the next request fails too.
+    A failed attempt is retried on another healthy endpoint straight away, and only
+    backs off when no other endpoint is available.
+    """
+    def __init__(self, endpoints, routing="least_outstanding", unhealthy_after=3, cooldown=30.0, policy=None):
+        if not endpoints:
+            raise ValueError("The pool backend needs at least one [endpoint:<name>] section in config.ini")
+        if routing not in ROUTING_MODES:
+            raise ValueError(f"Unknown routing '{routing}', expected one of {ROUTING_MODES}")
+        self.endpoints = endpoints
+        self.routing = routing
+        self.unhealthy_after = unhealthy_after
+        self.cooldown = cooldown
+        self.policy = policy or RetryPolicy()
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def pick(self, exclude=()):
+        """
+        Chooses the endpoint for the next attempt and counts it as outstanding.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [e for e in self.endpoints if e.healthy(now) and e not in exclude]
+            if not candidates:
+                candidates = [e for e in self.endpoints if e.healthy(now)] or \
+                             [min(self.endpoints, key=lambda e: max(e.down_until, e.limiter.paused_until))]
+            if self.routing == "weighted":
+                endpoint = self._random.choices(candidates, weights=[e.weight for e in candidates])[0]
+            else:
+                endpoint = min(candidates, key=lambda e: ((e.outstanding + 1) / e.weight, self._random.random()))
+            endpoint.outstanding += 1
+            return endpoint
+
+    def done(self, endpoint, error=None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.stats["calls"] += 1
+            if error is None:
+                endpoint.failures = 0
+                return
+            endpoint.stats["errors"] += 1
+            if is_retryable(error) and status_code(error) != 429:
+                endpoint.failures += 1
+                now = time.monotonic()
+                if endpoint.failures >= self.unhealthy_after:
+                    # Requests already in flight on a drained endpoint extend its cooldown
+                    if now >= endpoint.down_until:
+                        endpoint.stats["drained"] += 1
+                    endpoint.down_until = now + self.cooldown
+
+    def _after_failure(self, endpoint, error, attempt, tried):
+        """
+        Returns the delay before the next attempt, or raises if the request should not be retried.
+        """
+        if attempt == self.policy.max_retries or not is_retryable(error):
+            raise error
+        delay = self.policy.delay(attempt, error)
+        endpoint.limiter.observe(error_headers(error))
+        if status_code(error) == 429:
+            endpoint.limiter.throttled(delay)
+        now = time.monotonic()
+        if any(e.healthy(now) and e not in tried for e in self.endpoints):
+            return 0.0
+        return delay
+
+    def call(self, prompt, options):
+        tokens = estimate_tokens(prompt)
+        tried = set()
+        for attempt in range(self.policy.max_retries + 1):
+            endpoint = self.pick(tried)
+            tried.add(endpoint)
+            try:
+                endpoint.limiter.acquire(tokens)
+                response, headers = endpoint.send(prompt, options)
+            except Exception as error:
+                self.done(endpoint, error)
+                time.sleep(self._after_failure(endpoint, error, attempt, tried))
+                continue
+            self.done(endpoint)
+            return self._succeeded(endpoint, response, headers, tokens)
+
+    async def acall(self, prompt, options):
+        tokens = estimate_tokens(prompt)
+        tried = set()
+        for attempt in range(self.policy.max_retries + 1):
+            endpoint = self.pick(tried)
+            tried.add(endpoint)
+            try:
+                await endpoint.limiter.aacquire(tokens)
+                response, headers = await endpoint.asend(prompt, options)
+            except Exception as error:
+                self.done(endpoint, error)
+                await asyncio.sleep(self._after_failure(endpoint, error, attempt, tried))
+                continue
+            self.done(endpoint)
+            return self._succeeded(endpoint, response, headers, tokens)
+
+    def _succeeded(self, endpoint, response, headers, tokens):
+        endpoint.limiter.observe(headers, tokens, (response.prompt_tokens + response.completion_tokens) or None)
+        endpoint.limiter.succeeded()
+        response.endpoint = endpoint.name
+        return response
+
+    def stats(self):
+        """
+        Per endpoint: calls, errors, how often it was drained and whether it is healthy now.
+        """
+        now = time.monotonic()
+        return {e.name: {**e.stats, "healthy": e.healthy(now), "rate_limited": e.limiter.rate_limited}
+                for e in self.endpoints}
+
+@lru_cache(maxsize=None)
+def get_pool():
+    """
+    The pool described by config.ini, created on first use.
+    """
+    config = load_config()
+    section = config["pool"] if config.has_section("pool") else {}
+    # Retries and headroom come from [ratelimit]; the limits are per endpoint
+    limiter, policy = load_rate_limits(config)
+    endpoints = [Endpoint(name.split(":", 1)[1].strip(), config[name], limiter.headroom)
+                 for name in config.sections() if name.startswith("endpoint:")]
+    return EndpointPool(endpoints,
+                        routing=section.get("routing", "least_outstanding").strip(),
+                        unhealthy_after=int(section.get("unhealthy_after", 3)),
+                        cooldown=float(section.get("cooldown", 30.0)),
+                        policy=policy)
+
+def model_name():
+    # Cache key and pricing name of the pool: [pool] model, else the first endpoint's model
+    config = load_config()
+    if config.has_section("pool") and config["pool"].get("model"):
+        return config["pool"]["model"].strip()
+    return get_pool().endpoints[0].model
+
+def get_client():
+    """
+    SDK client of the first endpoint (Batch API and embeddings are not load balanced).
+    """
+    return get_pool().endpoints[0].client()
+
+def endpoint_stats():
+    return get_pool().stats()
+
+@lru_cache(maxsize=None)
+def _cache():
+    # Optional on-disk response cache, see the [cache] section of config.ini
+    return load_cache(load_config())
+
+def prompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Sends the prompt to one of the pool's endpoints (see EndpointPool) and returns an
+    LLMResponse whose `endpoint` names the deployment that answered. `model` replaces
+    the endpoints' own model or deployment name for this request.
+    """
+    pool = get_pool()
+    options = {"temp": temp, "json_mode": json_mode, "n": n, "model": model, "logprobs": logprobs}
+    llm_response = cached_call(_cache(), prompt, model or model_name(), temp, lambda: pool.call(prompt, options), n, logprobs)
+    usage_log.record(stage, llm_response)
+    return llm_response
+
+async def aprompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Async version of prompt_model.
+    """
+    pool = get_pool()
+    options = {"temp": temp, "json_mode": json_mode, "n": n, "model": model, "logprobs": logprobs}
+    llm_response = await acached_call(_cache(), prompt, model or model_name(), temp, lambda: pool.acall(prompt, options),
+                                      n, logprobs)
+    usage_log.record(stage, llm_response)
+    return llm_response
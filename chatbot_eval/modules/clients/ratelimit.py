@@ -0,0 +1,280 @@
+import math
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# SDK exceptions without a status code that are transient (matched by name, so the SDK is not imported)
+RETRYABLE_ERRORS = {"APITimeoutError", "APIConnectionError", "TimeoutError", "ConnectionError"}
+
+# Completion tokens reserved per request before the actual usage is known
+EXPECTED_COMPLETION_TOKENS = 32
+
+class TokenBucket:
+    """
+    Token bucket refilled at `per_minute` / 60 per second, holding at most `burst_seconds`
+    worth of tokens so a full bucket cannot be spent in one storm. Reservations may take
+    the level below zero; the caller then waits until the refill has caught up, which
+    queues callers in arrival order. A bucket without a rate never waits.
+    """
+    def __init__(self, per_minute=None, burst_seconds=10.0):
+        self.burst_seconds = burst_seconds
+        self.per_minute = None
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(per_minute)
+
+    @property
+    def capacity(self):
+        return self.per_minute * self.burst_seconds / 60 if self.per_minute else math.inf
+
+    def set_rate(self, per_minute):
+        first = self.per_minute is None
+        self.per_minute = per_minute
+        if per_minute and first:
+            self.level = self.capacity
+
+    def _refill(self, now):
+        if self.per_minute:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """
+        Takes `amount` tokens and returns how many seconds to wait before using them.
+        """
+        self._refill(now)
+        if not self.per_minute:
+            return 0.0
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level * 60 / self.per_minute)
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limiter shared by all calls of a backend.
+
+    The limits start from the [ratelimit] config (if any) and adapt to what the provider
+    reports: x-ratelimit-limit-* headers set them, x-ratelimit-remaining-* headers cap the
+    buckets at the server's view of the quota, and every 429 pauses all callers for the
+    Retry-After delay and lowers the rate multiplicatively; successes raise it back
+    additively (AIMD). `headroom` keeps throughput just below the ceiling.
+    """
+    def __init__(self, rpm=None, tpm=None, headroom=0.9):
+        self.headroom = headroom
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.scale = 1.0
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+        self.paused_until = 0.0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._apply_limits()
+
+    def _apply_limits(self):
+        for name, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            limit = self.limits[name]
+            bucket.set_rate(limit * self.headroom * self.scale if limit else None)
+
+    def _reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            return max(self.paused_until - now,
+                       self.requests.reserve(1, now),
+                       self.tokens.reserve(tokens, now))
+
+    def acquire(self, tokens):
+        """
+        Blocks until a request of about `tokens` tokens fits in the limits.
+        """
+        delay = self._reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self, tokens):
+        """
+        Async version of acquire.
+        """
+        delay = self._reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def observe(self, headers, estimated_tokens=0, used_tokens=None):
+        """
+        Updates the limits from a response's rate-limit headers and returns the
+        difference between the reserved and the actually used tokens to the bucket.
+        """
+        with self._lock:
+            if used_tokens is not None:
+                self.tokens.level = min(self.tokens.capacity, self.tokens.level + estimated_tokens - used_tokens)
+            if not headers:
+                return
+            changed = False
+            for name in ("requests", "tokens"):
+                limit = _header_number(headers, f"x-ratelimit-limit-{name}")
+                if limit and limit != self.limits[name]:
+                    self.limits[name] = limit
+                    changed = True
+            if changed:
+                self._apply_limits()
+            for name, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+                remaining = _header_number(headers, f"x-ratelimit-remaining-{name}")
+                if remaining is not None and bucket.per_minute:
+                    bucket.level = min(bucket.level, remaining * self.headroom)
+
+    def succeeded(self):
+        with self._lock:
+            if self.scale < 1.0:
+                self.scale = min(1.0, self.scale + 0.02)
+                self._apply_limits()
+
+    def throttled(self, delay):
+        """
+        Records a 429: every caller waits `delay` seconds and the rate is lowered.
+        """
+        with self._lock:
+            self.rate_limited += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.scale = max(0.1, self.scale * 0.75)
+            self._apply_limits()
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff ("full jitter": a random delay up to base * 2^attempt,
+    capped at max_delay), unless the provider says how long to wait with Retry-After.
+    """
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=60.0, seed=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random.Random(seed)
+
+    def delay(self, attempt, error):
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+def _header_number(headers, name):
+    value = headers.get(name) if headers else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def error_headers(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "headers", None) or {}
+
+def status_code(error):
+    return getattr(error, "status_code", None)
+
+def is_retryable(error):
+    """
+    True for rate limits, timeouts, connection failures and server errors.
+    """
+    if status_code(error) is not None:
+        return status_code(error) in RETRYABLE_STATUS
+    return isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)) or type(error).__name__ in RETRYABLE_ERRORS
+
+def retry_after_seconds(error):
+    """
+    The delay requested by the error's retry-after-ms or Retry-After header (seconds or
+    an HTTP date), or None.
+    """
+    headers = error_headers(error)
+    milliseconds = _header_number(headers, "retry-after-ms")
+    if milliseconds is not None:
+        return milliseconds / 1000
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def estimate_tokens(prompt):
+    """
+    Rough token count of a request (chars/4 plus the expected completion) to reserve up front.
+    """
+    text = prompt if isinstance(prompt, str) else "".join(message["content"] for message in prompt)
+    return math.ceil(len(text) / 4) + EXPECTED_COMPLETION_TOKENS
+
+def _used_tokens(response):
+    used = response.prompt_tokens + response.completion_tokens
+    return used or None
+
+def call_with_retries(limiter, policy, prompt, call):
+    """
+    Runs `call()` (returning (LLMResponse, response headers)) within the rate limits,
+    retrying transient failures. The last error is raised once the retries run out.
+    """
+    tokens = estimate_tokens(prompt)
+    for attempt in range(policy.max_retries + 1):
+        limiter.acquire(tokens)
+        try:
+            response, headers = call()
+        except Exception as error:
+            if attempt == policy.max_retries or not is_retryable(error):
+                raise
+            delay = policy.delay(attempt, error)
+            limiter.observe(error_headers(error))
+            if status_code(error) == 429:
+                limiter.throttled(delay)
+            else:
+                time.sleep(delay)
+            continue
+        limiter.observe(headers, tokens, _used_tokens(response))
+        limiter.succeeded()
+        return response
+
+async def acall_with_retries(limiter, policy, prompt, call):
+    """
+    Async version of call_with_retries, `call()` must return an awaitable.
+    """
+    tokens = estimate_tokens(prompt)
+    for attempt in range(policy.max_retries + 1):
+        await limiter.aacquire(tokens)
+        try:
+            response, headers = await call()
+        except Exception as error:
+            if attempt == policy.max_retries or not is_retryable(error):
+                raise
+            delay = policy.delay(attempt, error)
+            limiter.observe(error_headers(error))
+            if status_code(error) == 429:
+                limiter.throttled(delay)
+            else:
+                await asyncio.sleep(delay)
+            continue
+        limiter.observe(headers, tokens, _used_tokens(response))
+        limiter.succeeded()
+        return response
+
+def config_number(section, key, default, cast=float):
+    """
+    A number of a config.ini section, `default` when the key is missing or left empty (e.g. `rpm =`).
+    """
+    value = section.get(key, "")
+    return cast(value) if str(value).strip() else default
+
+def load_rate_limits(config):
+    """
+    Builds the (RateLimiter, RetryPolicy) pair described by the [ratelimit] section of
+    config.ini. Limits left empty are learned from the provider's headers.
+    """
+    section = config["ratelimit"] if config.has_section("ratelimit") else {}
+
+    def number(key, default, cast=float):
+        return config_number(section, key, default, cast)
+
+    limiter = RateLimiter(rpm=number("rpm", None), tpm=number("tpm", None), headroom=number("headroom", 0.9))
+    policy = RetryPolicy(max_retries=number("max_retries", 5, int), base_delay=number("base_delay", 0.5),
+                         max_delay=number("max_delay", 60.0))
+    return limiter, policy
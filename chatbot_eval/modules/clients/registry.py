@@ -0,0 +1,112 @@
+import os
+import importlib
+import configparser
+from functools import lru_cache
+
+from modules.clients.http import configure_http
+from modules.profiling import span
+
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), "../../config/config.ini")
+
+# Backend name -> module providing prompt_model, aprompt_model, model_name and, for the
+# backends built on an SDK (not mock), get_client for the Batch API and embeddings.
+# Modules are only imported (together with their SDK) when the backend is first used.
+BACKENDS = {
+    "azure": "modules.clients.openai_client_azure",
+    "openai": "modules.clients.openai_client",
+    "mock": "modules.clients.mock_client",
+    "pool": "modules.clients.pool_client",
+}
+DEFAULT_BACKEND = "azure"
+
+_selected = None
+
+@lru_cache(maxsize=None)
+def load_config():
+    """
+    Reads config.ini once per process, applying its [http] connection pool settings.
+    """
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    configure_http(config)
+    return config
+
+def register_backend(name, module):
+    """
+    Makes the backend implemented by `module` (a dotted module path) selectable as `name`.
+    """
+    BACKENDS[name] = module
+
+def set_backend(name):
+    """
+    Selects the backend for the rest of the process, overriding [llm] backend in config.ini.
+    """
+    global _selected
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', expected one of {tuple(BACKENDS)}")
+    _selected = name
+
+def backend_name():
+    """
+    The selected backend: set_backend's choice, else [llm] backend in config.ini, else azure.
+    """
+    if _selected:
+        return _selected
+    config = load_config()
+    return config["llm"].get("backend", DEFAULT_BACKEND).strip() if config.has_section("llm") else DEFAULT_BACKEND
+
+def get_backend(name=None):
+    """
+    Returns the module of the named (default: selected) backend, importing it on first use.
+    """
+    name = name or backend_name()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', expected one of {tuple(BACKENDS)}")
+    return importlib.import_module(BACKENDS[name])
+
+def client_backend(name=None):
+    """
+    Returns the module of the named (default: selected) backend, checking that it has an
+    SDK client (get_client), as the Batch API and embeddings need.
+
+    Raises:
+        ValueError: If it has none, e.g. the mock backend.
+    """
+    backend = get_backend(name)
+    if not hasattr(backend, "get_client"):
+        raise ValueError(f"The '{name or backend_name()}' backend has no SDK client for the Batch API or "
+                         f"embeddings, use azure, openai or pool")
+    return backend
+
+def model_name():
+    """
+    The model (or Azure deployment) name of the selected backend.
+    """
+    return get_backend().model_name()
+
+def backend_stats():
+    """
+    Per-endpoint health counters of the selected backend if it has several (see pool_client), else None.
+    """
+    stats = getattr(get_backend(), "endpoint_stats", None)
+    return stats() if stats else None
+
+def prompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Sends the prompt to the selected backend, see openai_client_azure.prompt_model.
+    """
+    with span(f"prompt_model.{stage}") as timed:
+        response = get_backend().prompt_model(prompt, temp=temp, json_mode=json_mode, stage=stage, n=n,
+                                              model=model, logprobs=logprobs)
+        timed.set(model=response.model, from_cache=response.from_cache)
+        return response
+
+async def aprompt_model(prompt, temp=1.0, json_mode=False, stage=None, n=1, model=None, logprobs=False):
+    """
+    Async version of prompt_model.
+    """
+    with span(f"prompt_model.{stage}") as timed:
+        response = await get_backend().aprompt_model(prompt, temp=temp, json_mode=json_mode, stage=stage, n=n,
+                                                     model=model, logprobs=logprobs)
+        timed.set(model=response.model, from_cache=response.from_cache)
+        return response
@@ -0,0 +1,115 @@
+import threading
+from dataclasses import dataclass, asdict
+from typing import List, Optional
+
+from modules.io import save_to_json
+
+@dataclass
+class LLMResponse:
+    """
+    What the clients return for every call: the message content plus token usage
+    and timing. `from_cache` is True when the local response cache served the call,
+    in which case no tokens were billed. `endpoint` names the deployment that answered
+    when several are pooled (see clients/pool_client.py). When n > 1 completions were
+    requested, `samples` holds all of them and `content` is the first. When logprobs were
+    requested, `logprobs` lists the first completion's tokens as {"token", "logprob",
+    "top": {alternative token: logprob}}.
+    """
+    content: str
+    model: str
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0
+    from_cache: bool = False
+    endpoint: Optional[str] = None
+    samples: Optional[List[str]] = None
+    logprobs: Optional[List[dict]] = None
+
+def _field(obj, name, default=0):
+    """
+    Reads a usage field from either an SDK object or a plain dict (e.g. Batch API output).
+    """
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        value = obj.get(name, default)
+    else:
+        value = getattr(obj, name, default)
+    return default if value is None else value
+
+def response_from_usage(content, model, usage, latency=0.0):
+    """
+    Builds an LLMResponse from a chat completion's `usage` block (SDK object or dict).
+    """
+    details = _field(usage, "prompt_tokens_details", None)
+    return LLMResponse(
+        content=content,
+        model=model,
+        prompt_tokens=_field(usage, "prompt_tokens"),
+        cached_tokens=_field(details, "cached_tokens"),
+        completion_tokens=_field(usage, "completion_tokens"),
+        latency=latency,
+    )
+
+def response_from_completion(completion, model, latency):
+    """
+    Builds an LLMResponse from an SDK chat completion.
+    """
+    response = response_from_usage(completion.choices[0].message.content, model, completion.usage, latency)
+    if len(completion.choices) > 1:
+        response.samples = [choice.message.content for choice in completion.choices]
+    logprobs = getattr(completion.choices[0], "logprobs", None)
+    if logprobs is not None and logprobs.content:
+        response.logprobs = [{"token": t.token, "logprob": t.logprob,
+                              "top": {alt.token: alt.logprob for alt in (t.top_logprobs or [])}}
+                             for t in logprobs.content]
+    return response
+
+class UsageLog:
+    """
+    Thread-safe log of every LLM call (tokens, provider prompt-cache hits, latency),
+    aggregated per stage into the run report.
+    """
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def record(self, stage, response):
+        """
+        Records one LLMResponse under `stage` ("pass_fail", "tagging", "structured", ...).
+        """
+        entry = {"stage": stage or "default", **asdict(response)}
+        del entry["content"], entry["samples"], entry["logprobs"]
+        with self._lock:
+            self.calls.append(entry)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.calls)
+
+    def summary(self):
+        """
+        Returns per-stage token totals and the share of prompt tokens served from the
+        provider's prompt cache.
+        """
+        stages = {}
+        for call in self.snapshot():
+            totals = stages.setdefault(call["stage"], {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+            totals["calls"] += 1
+            totals["prompt_tokens"] += call["prompt_tokens"]
+            totals["cached_tokens"] += call["cached_tokens"]
+            totals["completion_tokens"] += call["completion_tokens"]
+        for totals in stages.values():
+            totals["cached_rate"] = totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+        return stages
+
+    def save(self, filename):
+        save_to_json(filename, {"summary": self.summary(), "calls": self.snapshot()})
+
+    def reset(self):
+        with self._lock:
+            self.calls = []
+
+# Shared by every client in the process
+usage_log = UsageLog()
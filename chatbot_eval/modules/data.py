@@ -4,7 +4,10 @@ from collections import Counter
 
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Optional
+from itertools import islice
+from typing import Iterator, List, Tuple, Optional
+
+from modules.profiling import span, profiled_iter
 
 @dataclass
 class ConvoItem:
@@ -14,12 +17,52 @@ class ConvoItem:
 
 class ConvoLoader(ABC):
     @abstractmethod
-    def load(self, filename: str) -> List[ConvoItem]:
+    def iter_load(self, filename: str, limit: Optional[int] = None) -> Iterator[ConvoItem]:
         """
-        Load items from `<data_dir>/<filename>` into a list of ConvoItem.
+        Lazily yield ConvoItem from `<data_dir>/<filename>`, reading the file
+        incrementally and stopping after `limit` items if given.
         """
         ...
 
+    def load(self, filename: str, limit: Optional[int] = None) -> List[ConvoItem]:
+        """
+        Load items from `<data_dir>/<filename>` into a list of ConvoItem.
+        """
+        with span(f"load.{filename}"):
+            return list(self.iter_load(filename, limit))
+
+    def stream(self, filename: str, limit: Optional[int] = None) -> "ConvoStream":
+        """
+        Returns a re-iterable view of the file that streams it from disk on every pass.
+        """
+        return ConvoStream(self, filename, limit)
+
+    def iter_chunks(self, filename: str, chunk_size: int, limit: Optional[int] = None) -> Iterator[List[ConvoItem]]:
+        """
+        Yield lists of up to `chunk_size` ConvoItem, so only one chunk is in memory at a time.
+        """
+        items = self.iter_load(filename, limit)
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+class ConvoStream:
+    """
+    Re-iterable, lazily loaded dataset: each iteration calls `loader.iter_load` again,
+    so it can be scanned more than once (e.g. for a pre-flight estimate) without ever
+    holding the whole file in memory.
+    """
+    def __init__(self, loader: ConvoLoader, filename: str, limit: Optional[int] = None):
+        self.loader = loader
+        self.filename = filename
+        self.limit = limit
+
+    def __iter__(self) -> Iterator[ConvoItem]:
+        # With profiling, reading each item is timed (interleaved with the run consuming them)
+        return profiled_iter(f"load.{self.filename}", self.loader.iter_load(self.filename, self.limit))
+
 # Could modify this to extract tags from training data instead
 def get_tags(csv_filename: str = "valid_tags.csv") -> list:
     """
@@ -42,6 +85,22 @@ def get_tags(csv_filename: str = "valid_tags.csv") -> list:
             tags.append(row[0].strip())
     return tags
 
+def get_tag_aliases(csv_filename: str = "tag_aliases.csv") -> dict:
+    """
+    Load alternative hashtag spellings from an optional two-column CSV file
+    (alias, canonical hashtag) next to valid_tags.csv. Returns {} if there is none.
+    """
+    path = os.path.join(os.path.dirname(__file__), "../config/", csv_filename)
+    if not os.path.exists(path):
+        return {}
+
+    aliases = {}
+    with open(path, newline="", encoding="utf-8") as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) >= 2 and row[0].strip():
+                aliases[row[0].strip()] = row[1].strip()
+    return aliases
+
 def print_failure_distribution(data) -> None:
     """
     Prints the distribution of pass/fail statuses in the dataset in descending order.
@@ -0,0 +1,193 @@
+import hashlib
+
+# Finds the conversations of a test set that are the same or nearly the same (exports
+# repeat them across retries and split transcripts), so each cluster of duplicates is
+# evaluated once: runner.run_tests dispatches its representative only and copies the
+# prediction to the other members (see DuplicateClusters). Selected with `--dedup`,
+# configured by the [dedup] section of config.ini.
+
+# "exact": same text up to case and whitespace, "near": also MinHash/LSH near-duplicates
+DEDUP_MODES = ("exact", "near")
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+def text_key(text):
+    """
+    Stable hash of a conversation's normalized text, identical for exact duplicates.
+    """
+    return hashlib.blake2b(normalize(text).encode("utf-8"), digest_size=16).digest()
+
+class DuplicateClusters:
+    """
+    Clusters of duplicate test examples, each evaluated through its representative
+    (its first example). Examples without duplicates are their own representative.
+
+    Parameters:
+        members (dict): idx of each representative -> [(idx, ConvoItem)] of its other members.
+        examples (int): Examples clustered.
+        leaks (list): Test examples duplicating a demonstration, see Deduplicator.clusters.
+    """
+    def __init__(self, members, examples, leaks=None):
+        self.members = members
+        self.examples = examples
+        self.leaks = leaks
+        self.representative_of = {idx: rep for rep, copies in members.items() for idx, _ in copies}
+        self.reused = 0
+
+    def dispatched(self, idx, done=()):
+        """
+        Whether example idx must be evaluated: it represents its cluster, and its own
+        outcome or one of its members' is missing (e.g. a resumed run that stopped in between).
+        """
+        if idx in self.representative_of:
+            return False
+        return idx not in done or any(member not in done for member, _ in self.members.get(idx, ()))
+
+    def fan_out(self, idx, result, error):
+        """
+        The (idx, result, error) outcomes of the members of idx's cluster, copied from its
+        representative's: the prediction is shared, the text and labels are each member's own.
+        """
+        outcomes = []
+        for member, item in self.members.get(idx, ()):
+            if result is not None:
+                outcomes.append((member, {**result, "review": item.text, "pass_fail": item.pass_fail,
+                                          "tags": item.expected, "duplicate_of": idx}, None))
+            else:
+                outcomes.append((member, None, {**error, "review": item.text, "pass_fail": item.pass_fail,
+                                                "true_labels": item.expected, "duplicate_of": idx}))
+        self.reused += len(outcomes)
+        return outcomes
+
+    def summary(self):
+        duplicates = len(self.representative_of)
+        summary = {
+            "examples": self.examples,
+            "unique": self.examples - duplicates,
+            "duplicates": duplicates,
+            "dedup_ratio": duplicates / self.examples if self.examples else 0.0,
+            "clusters": len(self.members),
+            "largest_cluster": 1 + max((len(copies) for copies in self.members.values()), default=0),
+            "reused": self.reused,
+        }
+        if self.leaks is not None:
+            summary["leaks"] = self.leaks
+        return summary
+
+class Deduplicator:
+    """
+    Groups exact duplicates (same normalized text) and, in "near" mode, the conversations
+    whose MinHash similarity to an earlier one is at least `threshold`.
+
+    Parameters:
+        mode (str): One of DEDUP_MODES.
+        threshold (float): Estimated Jaccard similarity of the word shingles from which
+                           two conversations are near-duplicates.
+        shingle_size (int): Words per shingle.
+        num_perm (int): MinHash signature length.
+        bands (int): LSH bands (see minhash.MinHasher).
+    """
+    def __init__(self, mode="near", threshold=0.8, shingle_size=5, num_perm=128, bands=16):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode '{mode}', expected one of {DEDUP_MODES}")
+        self.mode = mode
+        self.threshold = threshold
+        self.hasher = None
+        if mode == "near":
+            # numpy is only needed for near-duplicates
+            from modules.minhash import MinHasher
+            self.hasher = MinHasher(num_perm, bands, shingle_size)
+
+    def _new_index(self):
+        if self.hasher is None:
+            return None
+        from modules.minhash import LSHIndex
+        return LSHIndex(self.hasher, self.threshold)
+
+    def _index(self, texts):
+        # Exact keys and (near mode) the LSH index of some texts, by position
+        keys, index = {}, self._new_index()
+        for position, text in enumerate(texts):
+            keys.setdefault(text_key(text), position)
+            if index is not None:
+                index.add(self.hasher.signature(text))
+        return keys, index
+
+    def clusters(self, data_test, indices=None, demos=None):
+        """
+        Clusters a test set, read once (it may be streamed).
+
+        Parameters:
+            data_test (iterable): ConvoItem to deduplicate.
+            indices (list): idx of each example, as passed to runner.run_tests (default: its position).
+            demos (list): Demonstration pool (ConvoItem) to check the test set against for
+                          leakage, None to skip the check.
+
+        Returns:
+            DuplicateClusters: whose `leaks` are, with demos, the test examples that duplicate
+                               a demonstration as {"idx", "demo", "similarity"}.
+        """
+        demo_keys, demo_index = self._index(demo.text for demo in demos) if demos is not None else ({}, None)
+        leaks = [] if demos is not None else None
+        keys, index = {}, self._new_index()
+        representatives, members = [], {}
+        examples = 0
+        pairs = zip(indices, data_test) if indices is not None else enumerate(data_test)
+        for idx, item in pairs:
+            examples += 1
+            key = text_key(item.text)
+            signature = self.hasher.signature(item.text) if self.hasher else None
+            if demos is not None:
+                leak = self._leak(key, signature, demo_keys, demo_index)
+                if leak:
+                    leaks.append({"idx": idx, "demo": leak[0], "similarity": leak[1]})
+
+            rep = keys.get(key)
+            if rep is None and index is not None:
+                # The most similar earlier representative, if any is similar enough
+                matches = index.query(signature)
+                rep = representatives[max(matches, key=lambda match: match[1])[0]] if matches else None
+            if rep is not None:
+                members.setdefault(rep, []).append((idx, item))
+                continue
+            keys[key] = idx
+            if index is not None:
+                # Only representatives are indexed, so members join the cluster of the
+                # example they are similar to rather than chaining clusters together
+                index.add(signature)
+                representatives.append(idx)
+        return DuplicateClusters(members, examples, leaks)
+
+    def _leak(self, key, signature, demo_keys, demo_index):
+        # (position of the demonstration, similarity) duplicated by a test example, or None
+        if key in demo_keys:
+            return demo_keys[key], 1.0
+        if demo_index is None:
+            return None
+        matches = demo_index.query(signature)
+        return max(matches, key=lambda match: match[1]) if matches else None
+
+def load_deduplicator(config, **overrides):
+    """
+    Builds the Deduplicator described by the [dedup] section of config.ini, updated with `overrides`.
+    """
+    section = config["dedup"] if config.has_section("dedup") else {}
+    settings = {
+        "mode": section.get("mode", "near").strip(),
+        "threshold": float(section.get("threshold", 0.8)),
+        "shingle_size": int(section.get("shingle_size", 5)),
+        "num_perm": int(section.get("num_perm", 128)),
+        "bands": int(section.get("bands", 16)),
+    }
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    return Deduplicator(**settings)
+
+def print_dedup_summary(summary):
+    print(f"Dedup: {summary['duplicates']} of {summary['examples']} test examples are duplicates "
+          f"({summary['dedup_ratio']:.1%}), {summary['unique']} to evaluate; "
+          f"{summary['clusters']} clusters, the largest of {summary['largest_cluster']}.")
+    if summary.get("leaks") is not None:
+        leaks = summary["leaks"]
+        print(f"Leakage: {len(leaks)} test examples duplicate a demonstration"
+              + (f", e.g. idx {', '.join(str(leak['idx']) for leak in leaks[:10])}." if leaks else "."))
@@ -1,9 +1,28 @@
 import json
+import textwrap
 
+from modules.profiling import profiled
+
+@profiled("io.read_json")
 def read_from_json(filename):
     with open(filename, "r") as f:
         return json.load(f)
 
+@profiled("io.save_json")
 def save_to_json(filename, data):
     with open(filename, "w") as f:
-        json.dump(data, f, indent=4)
\ No newline at end of file
+        json.dump(data, f, indent=4)
+
+@profiled("io.save_json")
+def save_to_json_stream(filename, items):
+    """
+    Writes an iterable of items as a JSON array, one item at a time, in the same
+    format as save_to_json (indent=4) without building the list in memory.
+    """
+    with open(filename, "w") as f:
+        first = True
+        for item in items:
+            f.write("[\n" if first else ",\n")
+            f.write(textwrap.indent(json.dumps(item, indent=4), "    "))
+            first = False
+        f.write("[]" if first else "\n]")
\ No newline at end of file
@@ -0,0 +1,142 @@
+import os
+import json
+
+from modules.io import save_to_json_stream
+from modules.profiling import profiled
+
+class ResultJournal:
+    """
+    Append-only JSONL journal of per-example outcomes.
+
+    Every line is {"idx": int, "result": {...}} or {"idx": int, "error": {...}}.
+    Lines are flushed as they are written and fsynced every `fsync_every` records,
+    so a crash or CTRL-C loses at most the last unsynced batch. When an idx appears
+    more than once (e.g. an error that succeeded on a later run) the last line wins.
+    """
+    def __init__(self, path, fsync_every=16):
+        self.path = path
+        self.fsync_every = fsync_every
+        self._file = None
+        self._unsynced = 0
+
+    def _scan(self):
+        """
+        Yields (idx, record, byte offset) for every readable line of the journal.
+        A truncated last line (from a crash mid-write) is ignored.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                start, offset = offset, offset + len(line)
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                yield record["idx"], record, start
+
+    def read(self):
+        """
+        Returns {idx: record} for every record in the journal, keeping the latest per idx.
+        """
+        return {idx: record for idx, record, _ in self._scan()}
+
+    def completed_indices(self):
+        """
+        Returns the set of idx values that already have a successful result.
+        """
+        latest = {}
+        for idx, record, _ in self._scan():
+            latest[idx] = "result" in record
+        return {idx for idx, has_result in latest.items() if has_result}
+
+    def open(self, resume=False):
+        """
+        Opens the journal for appending. Without `resume` any previous journal is discarded.
+        """
+        self._file = open(self.path, "a" if resume else "w", encoding="utf-8")
+        self._unsynced = 0
+        if resume and self._file.tell() > 0:
+            # Terminate a line truncated by a crash so the next record starts on its own line
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+        return self
+
+    @profiled("io.journal_append")
+    def append(self, idx, result=None, error=None):
+        """
+        Writes one outcome to the journal.
+        """
+        record = {"idx": idx, "result": result} if result is not None else {"idx": idx, "error": error}
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Forces everything written so far to disk.
+        """
+        if self._file and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        if self._file:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _latest(self):
+        # Byte offset of each idx's latest line, and whether it is a result, in idx order
+        offsets, is_result = {}, {}
+        for idx, record, offset in self._scan():
+            offsets[idx] = offset
+            is_result[idx] = "result" in record
+        return sorted(offsets), offsets, is_result
+
+    def _records(self, order, offsets, is_result, want_results):
+        with open(self.path, "rb") as f:
+            for idx in order:
+                if is_result[idx] != want_results:
+                    continue
+                f.seek(offsets[idx])
+                record = json.loads(f.readline())
+                yield {"idx": idx, **(record["result"] if want_results else record["error"])}
+
+    def iter_results(self):
+        """
+        Yields the latest result of every idx, ordered by idx, each with its "idx" key.
+        """
+        yield from self._records(*self._latest(), want_results=True)
+
+    @profiled("io.journal_export")
+    def export(self, results_file="results.json", errors_file="errors.json"):
+        """
+        Derives the final results/errors JSON files from the journal, ordered by idx.
+        Each saved dict gets an "idx" key pointing back at the test example.
+        Only the byte offset of each idx's latest line is kept in memory; the records
+        are streamed from the journal into the output files. results_file may be None
+        when the results are kept in a results store instead (see results_store).
+
+        Returns:
+            tuple: (number of results, number of errors)
+        """
+        order, offsets, is_result = self._latest()
+        if results_file:
+            save_to_json_stream(results_file, self._records(order, offsets, is_result, True))
+        save_to_json_stream(errors_file, self._records(order, offsets, is_result, False))
+        n_results = sum(is_result.values())
+        return n_results, len(order) - n_results
@@ -1,7 +1,7 @@
 
 import os
 import csv
-from typing import List
+from typing import Iterator, Optional
 from modules.data import ConvoItem, ConvoLoader
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
@@ -17,11 +17,11 @@ class CSVConvoLoader(ConvoLoader):
         self.label_col = label_col
         self.pass_fail_col = pass_fail_col  # New attribute for pass/fail
 
-    from typing import List
-
-    def load(self, filename: str) -> List[ConvoItem]:
+    def iter_load(self, filename: str, limit: Optional[int] = None) -> Iterator[ConvoItem]:
         path = os.path.join(self.base, filename)
-        items: List[ConvoItem] = []
+        if limit is not None and limit <= 0:
+            return
+        count = 0
         with open(path, newline='', encoding='utf-8') as f:
             reader = csv.DictReader(f)
             for row in reader:
@@ -44,6 +44,9 @@ class CSVConvoLoader(ConvoLoader):
                 # 3) Fetch pass/fail (allowing it to be None if column truly missing)
                 pass_fail = row.get(self.pass_fail_col)
 
-                items.append(ConvoItem(text=text, expected=tags, pass_fail=pass_fail))
+                yield ConvoItem(text=text, expected=tags, pass_fail=pass_fail)
 
-        return items
\ No newline at end of file
+                # 4) Stop early once we have enough items
+                count += 1
+                if limit is not None and count >= limit:
+                    return
\ No newline at end of file
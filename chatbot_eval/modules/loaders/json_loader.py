@@ -1,23 +1,83 @@
 # modules/data.py (continued)
 
 import os
-from typing import List
+import json
+from typing import Iterator, Optional
 from modules.data import ConvoItem, ConvoLoader
-from modules.io import read_from_json  # update this import as needed
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
+# Characters read from disk at a time while parsing a JSON array
+READ_SIZE = 1 << 16
+
 class JSONConvoLoader(ConvoLoader):
+    """
+    Loads conversations from either a JSON array of objects or JSON Lines
+    (one object per line). Both are parsed incrementally, one entry at a time.
+    """
     def __init__(self, data_dir: str = "data"):
         self.base = os.path.join(PROJECT_ROOT, data_dir)
 
-    def load(self, filename: str) -> List[ConvoItem]:
+    def iter_load(self, filename: str, limit: Optional[int] = None) -> Iterator[ConvoItem]:
         path = os.path.join(self.base, filename)
-        raw = read_from_json(path)
-        
+        if limit is not None and limit <= 0:
+            return
+
         # drop any extra keys
         allowed = {'text', 'expected', 'pass_fail'}  # Added pass_fail
-        return [
-            ConvoItem(**{k: v for k, v in entry.items() if k in allowed})
-            for entry in raw
-        ]
\ No newline at end of file
+        count = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for entry in _iter_json_entries(f):
+                yield ConvoItem(**{k: v for k, v in entry.items() if k in allowed})
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+def _iter_json_entries(f):
+    """
+    Yields the top-level entries of a JSON array file, or the lines of a JSON Lines file,
+    without reading the whole file into memory.
+    """
+    first = f.read(1)
+    while first and first.isspace():
+        first = f.read(1)
+    if first == "[":
+        yield from _iter_json_array(f)
+    elif first:
+        # JSON Lines: the first line is missing the character peeked at above
+        for n, line in enumerate(f):
+            if n == 0:
+                line = first + line
+            if line.strip():
+                yield json.loads(line)
+
+def _iter_json_array(f):
+    """
+    Incrementally decodes the objects of a JSON array whose opening '[' was already read.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos = f.read(READ_SIZE), 0
+    while True:
+        # skip whitespace and separators, refilling the buffer as needed
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+                pos += 1
+            if pos < len(buffer):
+                break
+            buffer, pos = f.read(READ_SIZE), 0
+            if not buffer:
+                raise ValueError("Unexpected end of file inside JSON array")
+        if buffer[pos] == "]":
+            return
+
+        try:
+            entry, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the entry continues past the buffer: read more and retry
+            more = f.read(max(READ_SIZE, len(buffer)))
+            if not more:
+                raise
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        yield entry
+        pos = end
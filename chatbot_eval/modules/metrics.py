@@ -1,7 +1,108 @@
+import math
 from collections import Counter
-from modules.io import read_from_json, save_to_json
+from modules.io import save_to_json
 
-def evaluator_metrics(results, beta2=4.0):
+def tag_scores(true_tags, pred_tags, beta2=4.0):
+    """
+    Precision, recall and F_β of one example's predicted hashtags (multiset matching).
+    """
+    # build count maps
+    true_counts = Counter(true_tags)
+    pred_counts = Counter(pred_tags)
+
+    # compute TP, FP, FN
+    tp = sum((true_counts & pred_counts).values())
+    fp = sum((pred_counts - true_counts).values())
+    fn = sum((true_counts - pred_counts).values())
+
+    # edge‐cases: no true & no pred → perfect; no true tags → recall=1 if none missed
+    if not true_counts and not pred_counts:
+        p = r = 1.0
+    else:
+        p = tp / (tp + fp) if (tp + fp) > 0 else 0.0
+        r = tp / (tp + fn) if (tp + fn) > 0 else 1.0
+
+    # F_β
+    f = ((1 + beta2) * p * r) / (beta2 * p + r) if (beta2 * p + r) > 0 else 0.0
+    return p, r, f
+
+class EvaluatorAccumulator:
+    """
+    Running state of evaluator_metrics: add results one at a time (or per shard) and
+    read the metrics so far. The scores are summed in the order the results are added,
+    as evaluator_metrics always has, so merging the accumulators of several shards may
+    differ from one pass over all the results in the last bits; shard.merge_shards
+    computes the final metrics from the merged results instead. state()/from_state()
+    round-trip it through JSON. The sum of squared per-example F_β is kept too, for a
+    running confidence interval (f_beta_interval).
+    """
+    KEYS = ("precision", "recall", "f_beta", "fail_precision", "fail_recall", "fail_f_beta")
+
+    def __init__(self, beta2=4.0):
+        self.beta2 = beta2
+        self.n = 0
+        self.n_fail = 0
+        self.sums = {key: 0.0 for key in self.KEYS}
+        self.f_beta_squares = 0.0
+
+    def add(self, result):
+        p, r, f = tag_scores(result["tags"], result["predicted_tags"], self.beta2)
+        self.n += 1
+        for key, value in zip(self.KEYS[:3], (p, r, f)):
+            self.sums[key] += value
+        self.f_beta_squares += f * f
+        # only failures (where there was at least one true tag)
+        if result["tags"]:
+            self.n_fail += 1
+            for key, value in zip(self.KEYS[3:], (p, r, f)):
+                self.sums[key] += value
+
+    def update(self, results):
+        for result in results:
+            self.add(result)
+        return self
+
+    def merge(self, other):
+        if other.beta2 != self.beta2:
+            raise ValueError(f"Cannot merge accumulators with β² {self.beta2} and {other.beta2}")
+        self.n += other.n
+        self.n_fail += other.n_fail
+        for key in self.KEYS:
+            self.sums[key] += other.sums[key]
+        self.f_beta_squares += other.f_beta_squares
+        return self
+
+    def f_beta_interval(self, z=1.96):
+        """
+        Normal-approximation confidence interval (z=1.96: 95%) of the macro F_β over
+        the examples seen so far, as (low, high), or None before 2 examples.
+        """
+        if self.n < 2:
+            return None
+        mean = self.sums["f_beta"] / self.n
+        variance = max(0.0, (self.f_beta_squares - self.n * mean * mean) / (self.n - 1))
+        half_width = z * math.sqrt(variance / self.n)
+        return mean - half_width, mean + half_width
+
+    def metrics(self):
+        # macro-averages over all examples and over the fail subset
+        return {key: self.sums[key] / count if count > 0 else 0.0
+                for key, count in zip(self.KEYS, (self.n,) * 3 + (self.n_fail,) * 3)}
+
+    def state(self):
+        return {"beta2": self.beta2, "n": self.n, "n_fail": self.n_fail,
+                "sums": dict(self.sums), "f_beta_squares": self.f_beta_squares}
+
+    @classmethod
+    def from_state(cls, state):
+        accumulator = cls(state["beta2"])
+        accumulator.n = state["n"]
+        accumulator.n_fail = state["n_fail"]
+        accumulator.sums = {key: state["sums"][key] for key in cls.KEYS}
+        accumulator.f_beta_squares = state["f_beta_squares"]
+        return accumulator
+
+def evaluator_metrics(results, beta2=4.0, filename="metrics_evaluator.json"):
     """
     Evaluates tag classification results by calculating precision, recall,
     and a weighted F-score (recall weighted β² as important as precision),
@@ -14,6 +115,7 @@ def evaluator_metrics(results, beta2=4.0):
             "tags"           : list[str], ground-truth tags (empty list if none)
             "predicted_tags" : list[str], predicted tags (empty list if none)
         beta2 (float):    β² value for F_β; default=4.0
+        filename (str):   Where to save the metrics, or None to skip saving.
 
     Returns:
         dict: {
@@ -25,84 +127,71 @@ def evaluator_metrics(results, beta2=4.0):
             "fail_f_beta"    : float
         }
     """
-    total_p = total_r = total_f = 0.0
-    total_p_fail = total_r_fail = total_f_fail = 0.0
-    n = len(results)
-    n_fail = 0
-
-    for result in results:
-        true_tags = result["tags"]
-        pred_tags = result["predicted_tags"]
-
-        # build count maps
-        true_counts = {}
-        for t in true_tags:
-            true_counts[t] = true_counts.get(t, 0) + 1
-        pred_counts = {}
-        for t in pred_tags:
-            pred_counts[t] = pred_counts.get(t, 0) + 1
-
-        # compute TP, FP, FN
-        tp = fp = fn = 0
-        for tag, cnt in pred_counts.items():
-            if tag in true_counts:
-                tp += min(cnt, true_counts[tag])
-                fp += max(0, cnt - true_counts[tag])
-            else:
-                fp += cnt
-        for tag, cnt in true_counts.items():
-            if tag not in pred_counts:
-                fn += cnt
-            else:
-                fn += max(0, cnt - pred_counts[tag])
-
-        # edge‐cases: no true & no pred → perfect; no true tags → recall=1 if none missed
-        if not true_counts and not pred_counts:
-            p = r = 1.0
-        else:
-            p = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-            r = tp / (tp + fn) if (tp + fn) > 0 else 1.0
-
-        # F_β
-        f = ((1 + beta2) * p * r) / (beta2 * p + r) if (beta2 * p + r) > 0 else 0.0
-
-        # accumulate overall
-        total_p += p
-        total_r += r
-        total_f += f
-
-        # accumulate only failures (where there was at least one true tag)
-        if true_tags:
-            total_p_fail += p
-            total_r_fail += r
-            total_f_fail += f
-            n_fail += 1
-
-    # macro‐average overall
-    avg_p = total_p / n if n > 0 else 0.0
-    avg_r = total_r / n if n > 0 else 0.0
-    avg_f = total_f / n if n > 0 else 0.0
-
-    # macro‐average on fail subset
-    avg_p_fail = total_p_fail / n_fail if n_fail > 0 else 0.0
-    avg_r_fail = total_r_fail / n_fail if n_fail > 0 else 0.0
-    avg_f_fail = total_f_fail / n_fail if n_fail > 0 else 0.0
-
-    metrics = {
-        "precision"      : avg_p,
-        "recall"         : avg_r,
-        "f_beta"         : avg_f,
-        "fail_precision": avg_p_fail,
-        "fail_recall"   : avg_r_fail,
-        "fail_f_beta"   : avg_f_fail,
-    }
+    metrics = EvaluatorAccumulator(beta2).update(results).metrics()
 
     # Persist to disk if needed
-    save_to_json("metrics_evaluator.json", metrics)
+    if filename:
+        save_to_json(filename, metrics)
 
     return metrics
 
-def chatbot_metrics(results):
+class ChatbotAccumulator:
+    """
+    Running, mergeable state of chatbot_metrics, see EvaluatorAccumulator.
+    """
+    def __init__(self):
+        self.total = 0
+        self.passes = 0
+        self.tags_of_failures = 0
+        self.tag_counter = Counter()
+
+    def add(self, result):
+        self.total += 1
+        if result["predicted_pass_fail"] == "Pass":
+            self.passes += 1
+        else:
+            self.tags_of_failures += len(result["predicted_tags"])
+            self.tag_counter.update(result["predicted_tags"])
+
+    def update(self, results):
+        for result in results:
+            self.add(result)
+        return self
+
+    def merge(self, other):
+        self.total += other.total
+        self.passes += other.passes
+        self.tags_of_failures += other.tags_of_failures
+        self.tag_counter.update(other.tag_counter)
+        return self
+
+    def metrics(self):
+        fails = self.total - self.passes
+        return {
+            "total": self.total,
+            "passes": self.passes,
+            "fails": fails,
+            "pass_rate": self.passes / self.total if self.total else 0.0,
+            "fail_rate": fails / self.total if self.total else 0.0,
+            # Average number of tags among failures
+            "avg_tags_per_failure": self.tags_of_failures / fails if fails else 0.0,
+            "tag_distribution": dict(self.tag_counter),
+        }
+
+    def state(self):
+        return {"total": self.total, "passes": self.passes, "tags_of_failures": self.tags_of_failures,
+                "tag_counter": dict(self.tag_counter)}
+
+    @classmethod
+    def from_state(cls, state):
+        accumulator = cls()
+        accumulator.total = state["total"]
+        accumulator.passes = state["passes"]
+        accumulator.tags_of_failures = state["tags_of_failures"]
+        accumulator.tag_counter = Counter(state["tag_counter"])
+        return accumulator
+
+def chatbot_metrics(results, filename="metrics_chatbot.json"):
     """
     Computes chatbot performance metrics, assuming all predictions are 'Pass' or 'Fail'.
     
@@ -110,6 +199,7 @@ def chatbot_metrics(results):
         results (list): Each result dict must contain:
             - "predicted_pass_fail": str, either "Pass" or "Fail"
             - "predicted_tags"     : list[str], tags assigned if it failed
+        filename (str): Where to save the metrics, or None to skip saving.
     
     Returns:
         dict: {
@@ -122,35 +212,86 @@ def chatbot_metrics(results):
             "tag_distribution": { tag: count, ... }
         }
     """
-    total   = len(results)
-    passes  = sum(1 for r in results if r["predicted_pass_fail"] == "Pass")
-    fails   = total - passes
-
-    pass_rate = passes / total if total else 0.0
-    fail_rate = fails  / total if total else 0.0
-
-    # Average number of tags among failures
-    tags_per_fail = [len(r["predicted_tags"]) for r in results if r["predicted_pass_fail"] == "Fail"]
-    avg_tags = sum(tags_per_fail) / len(tags_per_fail) if tags_per_fail else 0.0
-
-    # Distribution of predicted tags across all failures
-    tag_counter = Counter()
-    for r in results:
-        if r["predicted_pass_fail"] == "Fail":
-            tag_counter.update(r["predicted_tags"])
-
-    metrics = {
-        "total": total,
-        "passes": passes,
-        "fails": fails,
-        "pass_rate": pass_rate,
-        "fail_rate": fail_rate,
-        "avg_tags_per_failure": avg_tags,
-        "tag_distribution": dict(tag_counter)
+    metrics = ChatbotAccumulator().update(results).metrics()
+    if filename:
+        save_to_json(filename, metrics)
+    return metrics
+
+def agreement_metrics(results):
+    """
+    Summarizes the self-consistency agreement of results evaluated with several samples
+    (runner.run_tests with samples > 1) and how well it signals correct answers.
+    
+    Returns:
+        dict: {
+            "examples": int,                 # results with an agreement
+            "pass_fail_agreement": float,    # mean share of samples agreeing with the vote
+            "unanimous_rate": float,         # share of results whose samples all agreed
+            "unanimous_accuracy": float,     # pass/fail accuracy of the unanimous results
+            "split_accuracy": float,         # pass/fail accuracy of the others
+            "tag_agreement": float           # mean tag agreement of the voted failures
+        }, values None when there is nothing to average
+    """
+    voted = [r for r in results if r.get("agreement")]
+    unanimous = [r for r in voted if r["agreement"]["pass_fail"] == 1.0]
+    split = [r for r in voted if r["agreement"]["pass_fail"] < 1.0]
+    tag_agreements = [r["agreement"]["tags"] for r in voted if r["agreement"]["tags"] is not None]
+
+    def mean(values):
+        values = list(values)
+        return sum(values) / len(values) if values else None
+
+    def accuracy(rs):
+        return mean(r["predicted_pass_fail"] == r["pass_fail"] for r in rs)
+
+    return {
+        "examples": len(voted),
+        "pass_fail_agreement": mean(r["agreement"]["pass_fail"] for r in voted),
+        "unanimous_rate": len(unanimous) / len(voted) if voted else None,
+        "unanimous_accuracy": accuracy(unanimous),
+        "split_accuracy": accuracy(split),
+        "tag_agreement": mean(tag_agreements),
     }
 
-    save_to_json("metrics_chatbot.json", metrics)
-    return metrics
+def tier_metrics(results):
+    """
+    Breaks the results of a cascaded run (runner.run_tests with a cascade) down by the
+    tier that answered them, and measures what escalating changed.
+
+    Returns:
+        dict: {
+            "examples": int,                    # results with a tier
+            "escalation_rate": float,           # share answered by the strong model
+            "tiers": {tier: {"examples": int, "pass_fail_accuracy": float,
+                             "f_beta": float, "fail_f_beta": float}},
+            "escalated_base_accuracy": float,   # pass/fail accuracy of the base answers that were escalated
+            "escalated_strong_accuracy": float, # ... and of the strong model's answers to them
+            "escalation_flips": int             # escalated results whose pass/fail changed
+        }, values None when there is nothing to average
+    """
+    tiered = [r for r in results if r.get("tier")]
+    escalated = [r for r in tiered if r["tier"] == "strong"]
+
+    def accuracy(rs, key="predicted_pass_fail"):
+        return sum(r[key] == r["pass_fail"] for r in rs) / len(rs) if rs else None
+
+    tiers = {}
+    for tier in ("base", "strong"):
+        subset = [r for r in tiered if r["tier"] == tier]
+        if not subset:
+            continue
+        scores = evaluator_metrics(subset, filename=None)
+        tiers[tier] = {"examples": len(subset), "pass_fail_accuracy": accuracy(subset),
+                       "f_beta": scores["f_beta"], "fail_f_beta": scores["fail_f_beta"]}
+
+    return {
+        "examples": len(tiered),
+        "escalation_rate": len(escalated) / len(tiered) if tiered else None,
+        "tiers": tiers,
+        "escalated_base_accuracy": accuracy(escalated, "base_pass_fail"),
+        "escalated_strong_accuracy": accuracy(escalated),
+        "escalation_flips": sum(r["base_pass_fail"] != r["predicted_pass_fail"] for r in escalated),
+    }
 
 def print_evaluator_metrics(metrics):
     """
@@ -178,8 +319,38 @@ def print_chatbot_metrics(metrics):
     for tag, count in sorted(metrics["tag_distribution"].items(), key=lambda x: -x[1]):
         print(f"{tag}: {count}")
 
+def print_agreement_metrics(metrics):
+    """
+    Nicely prints the self-consistency agreement metrics.
+    """
+    def fmt(value):
+        return "n/a" if value is None else f"{value:.3f}"
+    print("Self-consistency agreement:")
+    print(f"Voted convos       : {metrics['examples']}")
+    print(f"Pass/fail agreement: {fmt(metrics['pass_fail_agreement'])} "
+          f"(unanimous {fmt(metrics['unanimous_rate'])})")
+    print(f"Pass/fail accuracy : {fmt(metrics['unanimous_accuracy'])} when unanimous, "
+          f"{fmt(metrics['split_accuracy'])} when split")
+    print(f"Tag agreement      : {fmt(metrics['tag_agreement'])}")
+
+def print_tier_metrics(metrics):
+    """
+    Nicely prints the per-tier metrics of a cascaded run.
+    """
+    def fmt(value):
+        return "n/a" if value is None else f"{value:.3f}"
+    print("Model cascade:")
+    print(f"Escalated          : {fmt(metrics['escalation_rate'])} of {metrics['examples']} convos "
+          f"({metrics['escalation_flips']} pass/fail answers changed)")
+    for tier, t in metrics["tiers"].items():
+        print(f"{tier.capitalize() + ' tier':<19}: {t['examples']} convos, pass/fail accuracy {fmt(t['pass_fail_accuracy'])}, "
+              f"F-beta {fmt(t['f_beta'])} (fails {fmt(t['fail_f_beta'])})")
+    print(f"Escalated accuracy : {fmt(metrics['escalated_base_accuracy'])} base -> "
+          f"{fmt(metrics['escalated_strong_accuracy'])} strong")
+
 if __name__ == "__main__":
-    results = read_from_json("results.json")
+    from modules.runner import load_results
+    results = load_results()
     metrics = evaluator_metrics(results)
     print_evaluator_metrics(metrics)
     print()
@@ -0,0 +1,366 @@
+import os
+import json
+import random
+
+import numpy as np
+
+from modules.io import save_to_json
+
+# Resampled rows materialized at once by the bootstrap (n_resamples x n_results indices)
+BOOTSTRAP_CHUNK_ELEMENTS = 10_000_000
+
+def build_vocabulary(tag_list, results):
+    """
+    Returns tag_list extended with any tag that appears in `results` but not in
+    tag_list (e.g. a ground-truth tag outside the config), so nothing is dropped.
+    """
+    vocab = list(tag_list)
+    seen = set(vocab)
+    for result in results:
+        for tag in (result["tags"] or []) + (result["predicted_tags"] or []):
+            if tag not in seen:
+                seen.add(tag)
+                vocab.append(tag)
+    return vocab
+
+def encode_tags(tag_lists, vocab):
+    """
+    Encodes lists of tags as an (n_results x n_tags) matrix of tag counts over `vocab`.
+    Counts rather than 0/1 indicators, so repeated tags are scored exactly like
+    metrics.evaluator_metrics does.
+    """
+    index = {tag: j for j, tag in enumerate(vocab)}
+    rows, cols = [], []
+    for i, tags in enumerate(tag_lists):
+        for tag in tags or []:
+            rows.append(i)
+            cols.append(index[tag])
+    matrix = np.zeros((len(tag_lists), len(vocab)), dtype=np.int32)
+    np.add.at(matrix, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), 1)
+    return matrix
+
+def _f_beta(p, r, beta2):
+    """
+    Element-wise F_β with the same operation order as metrics.evaluator_metrics.
+    """
+    denominator = beta2 * p + r
+    return np.divide((1 + beta2) * p * r, denominator, out=np.zeros_like(p, dtype=np.float64), where=denominator > 0)
+
+def _ratio(numerator, denominator, empty):
+    """
+    numerator / denominator element-wise, `empty` where the denominator is 0.
+    """
+    return np.divide(numerator, denominator, out=np.full(np.shape(numerator), empty, dtype=np.float64), where=denominator > 0)
+
+def _sequential_mean(values):
+    """
+    Mean with the values summed left to right, matching the running sums of
+    metrics.evaluator_metrics bit for bit (np.sum uses pairwise summation).
+    """
+    total = 0.0
+    for value in values.tolist():
+        total += value
+    return total / len(values) if len(values) else 0.0
+
+def example_scores(true_counts, pred_counts, beta2=4.0):
+    """
+    Per-example TP/FP/FN and precision, recall and F_β from the tag count matrices.
+    """
+    tp = np.minimum(true_counts, pred_counts).sum(axis=1)
+    fp = np.maximum(pred_counts - true_counts, 0).sum(axis=1)
+    fn = np.maximum(true_counts - pred_counts, 0).sum(axis=1)
+
+    p = _ratio(tp, tp + fp, 0.0)
+    r = _ratio(tp, tp + fn, 1.0)
+    # no true & no pred → perfect
+    both_empty = (true_counts.sum(axis=1) == 0) & (pred_counts.sum(axis=1) == 0)
+    p[both_empty] = 1.0
+    r[both_empty] = 1.0
+    return tp, fp, fn, p, r, _f_beta(p, r, beta2)
+
+def _bootstrap(tp, fp, fn, p, r, f, fail_mask, beta2, n_resamples, confidence, seed):
+    """
+    Percentile bootstrap confidence intervals over resampled examples.
+    """
+    n = len(p)
+    rng = np.random.default_rng(seed)
+    chunk = max(1, BOOTSTRAP_CHUNK_ELEMENTS // max(n, 1))
+    samples = {key: [] for key in ("precision", "recall", "f_beta", "fail_f_beta", "micro_f_beta")}
+    fail = fail_mask.astype(np.float64)
+
+    for start in range(0, n_resamples, chunk):
+        idx = rng.integers(0, n, size=(min(chunk, n_resamples - start), n))
+        samples["precision"].append(p[idx].mean(axis=1))
+        samples["recall"].append(r[idx].mean(axis=1))
+        samples["f_beta"].append(f[idx].mean(axis=1))
+        n_fail = fail[idx].sum(axis=1)
+        samples["fail_f_beta"].append(_ratio((f * fail)[idx].sum(axis=1), n_fail, 0.0))
+        tp_s, fp_s, fn_s = tp[idx].sum(axis=1), fp[idx].sum(axis=1), fn[idx].sum(axis=1)
+        samples["micro_f_beta"].append(_f_beta(_ratio(tp_s, tp_s + fp_s, 0.0), _ratio(tp_s, tp_s + fn_s, 1.0), beta2))
+
+    alpha = (1 - confidence) / 2 * 100
+    return {
+        key: [float(np.percentile(np.concatenate(values), alpha)), float(np.percentile(np.concatenate(values), 100 - alpha))]
+        for key, values in samples.items()
+    }
+
+def pass_fail_confusion(results):
+    """
+    Confusion counts between true and predicted pass/fail, with "Fail" as the positive class.
+    """
+    true = np.array([result.get("pass_fail") == "Fail" for result in results], dtype=bool)
+    pred = np.array([result["predicted_pass_fail"] == "Fail" for result in results], dtype=bool)
+    tp = int(np.sum(true & pred))
+    fp = int(np.sum(~true & pred))
+    fn = int(np.sum(true & ~pred))
+    tn = int(np.sum(~true & ~pred))
+    precision = tp / (tp + fp) if (tp + fp) else 0.0
+    recall = tp / (tp + fn) if (tp + fn) else 0.0
+    return {
+        "true_fail_pred_fail": tp,
+        "true_pass_pred_fail": fp,
+        "true_fail_pred_pass": fn,
+        "true_pass_pred_pass": tn,
+        "accuracy": (tp + tn) / len(results) if results else 0.0,
+        "fail_precision": precision,
+        "fail_recall": recall,
+        "fail_f1": 2 * precision * recall / (precision + recall) if (precision + recall) else 0.0,
+    }
+
+def detailed_evaluator_metrics(results, tag_list, beta2=4.0, n_bootstrap=1000, confidence=0.95, seed=0,
+                               filename="metrics_evaluator_detailed.json"):
+    """
+    Vectorized counterpart of metrics.evaluator_metrics with per-tag and micro metrics.
+
+    Tags and predicted tags are encoded as count matrices over the `tag_list` vocabulary
+    and every metric is computed with batched array operations.
+
+    Parameters:
+        results (list): Result dicts with "tags", "predicted_tags", "pass_fail" and "predicted_pass_fail".
+        tag_list (list): The tag vocabulary, usually get_tags().
+        beta2 (float): β² value for F_β; default=4.0
+        n_bootstrap (int): Number of bootstrap resamples for the confidence intervals (0 to skip).
+        confidence (float): Confidence level of the intervals.
+        seed (int): Seed of the bootstrap resampling.
+        filename (str): Where to save the metrics, or None to skip saving.
+
+    Returns:
+        dict: {
+            "macro"     : same keys and values as metrics.evaluator_metrics,
+            "micro"     : precision/recall/f_beta from summed TP/FP/FN (all and fail subset),
+            "per_tag"   : { tag: support/predicted/tp/precision/recall/f_beta },
+            "pass_fail" : pass/fail confusion counts and scores,
+            "bootstrap" : { metric: [low, high] } confidence intervals
+        }
+    """
+    vocab = build_vocabulary(tag_list, results)
+    true_counts = encode_tags([result["tags"] for result in results], vocab)
+    pred_counts = encode_tags([result["predicted_tags"] for result in results], vocab)
+    tp, fp, fn, p, r, f = example_scores(true_counts, pred_counts, beta2)
+    fail_mask = true_counts.sum(axis=1) > 0
+
+    macro = {
+        "precision"     : _sequential_mean(p),
+        "recall"        : _sequential_mean(r),
+        "f_beta"        : _sequential_mean(f),
+        "fail_precision": _sequential_mean(p[fail_mask]),
+        "fail_recall"   : _sequential_mean(r[fail_mask]),
+        "fail_f_beta"   : _sequential_mean(f[fail_mask]),
+    }
+
+    micro = {}
+    for prefix, mask in (("", slice(None)), ("fail_", fail_mask)):
+        tp_sum, fp_sum, fn_sum = tp[mask].sum(), fp[mask].sum(), fn[mask].sum()
+        micro_p = tp_sum / (tp_sum + fp_sum) if (tp_sum + fp_sum) else 0.0
+        micro_r = tp_sum / (tp_sum + fn_sum) if (tp_sum + fn_sum) else 1.0
+        micro[f"{prefix}precision"] = float(micro_p)
+        micro[f"{prefix}recall"] = float(micro_r)
+        micro[f"{prefix}f_beta"] = float(_f_beta(np.array([micro_p]), np.array([micro_r]), beta2)[0])
+
+    tag_tp = np.minimum(true_counts, pred_counts).sum(axis=0)
+    tag_support = true_counts.sum(axis=0)
+    tag_predicted = pred_counts.sum(axis=0)
+    tag_p = _ratio(tag_tp, tag_predicted, 0.0)
+    tag_r = _ratio(tag_tp, tag_support, 0.0)
+    tag_f = _f_beta(tag_p, tag_r, beta2)
+    per_tag = {
+        tag: {
+            "support": int(tag_support[j]),
+            "predicted": int(tag_predicted[j]),
+            "tp": int(tag_tp[j]),
+            "precision": float(tag_p[j]),
+            "recall": float(tag_r[j]),
+            "f_beta": float(tag_f[j]),
+        }
+        for j, tag in enumerate(vocab)
+    }
+
+    metrics = {
+        "macro": macro,
+        "micro": micro,
+        "per_tag": per_tag,
+        "pass_fail": pass_fail_confusion(results),
+    }
+    if n_bootstrap and len(results):
+        metrics["bootstrap"] = _bootstrap(tp, fp, fn, p, r, f, fail_mask, beta2, n_bootstrap, confidence, seed)
+        metrics["bootstrap_confidence"] = confidence
+
+    if filename:
+        save_to_json(filename, metrics)
+    return metrics
+
+def print_detailed_metrics(metrics):
+    """
+    Prints micro averages, bootstrap intervals, the pass/fail confusion and per-tag scores.
+    """
+    print("Evaluator micro-averaged metrics:")
+    for metric, value in metrics["micro"].items():
+        print(f"{metric.capitalize():<15}: {value:.3f}")
+
+    if "bootstrap" in metrics:
+        print(f"\nBootstrap {metrics['bootstrap_confidence']:.0%} confidence intervals:")
+        for metric, (low, high) in metrics["bootstrap"].items():
+            print(f"{metric.capitalize():<15}: [{low:.3f}, {high:.3f}]")
+
+    confusion = metrics["pass_fail"]
+    print("\nPass/Fail confusion (rows: true, columns: predicted Fail / Pass):")
+    print(f"Fail: {confusion['true_fail_pred_fail']:>6} {confusion['true_fail_pred_pass']:>6}")
+    print(f"Pass: {confusion['true_pass_pred_fail']:>6} {confusion['true_pass_pred_pass']:>6}")
+    print(f"Accuracy: {confusion['accuracy']:.3f}, Fail F1: {confusion['fail_f1']:.3f}")
+
+    print("\nPer-tag metrics (sorted by support):")
+    for tag, scores in sorted(metrics["per_tag"].items(), key=lambda kv: (-kv[1]["support"], kv[0])):
+        print(f"{tag}: support={scores['support']} P={scores['precision']:.3f} "
+              f"R={scores['recall']:.3f} F_beta={scores['f_beta']:.3f}")
+
+def synthetic_results(n, tag_list, seed=0):
+    """
+    `n` reproducible result dicts with random labels and predictions, including repeated
+    predicted tags and tags outside `tag_list`, for self_check without a run.
+    """
+    rng = random.Random(seed)
+    tags = list(tag_list) + ["#not_in_tag_list"]
+    results = []
+    for i in range(n):
+        true_tags = rng.sample(tags, rng.randint(1, 3)) if rng.random() < 0.4 else []
+        predicted = rng.choice(("Pass", "Fail"))
+        predicted_tags = []
+        if predicted == "Fail":
+            predicted_tags = rng.sample(true_tags, rng.randint(0, len(true_tags))) + rng.choices(tags, k=rng.randint(0, 2))
+        results.append({"idx": i, "review": f"[{i}]", "pass_fail": "Fail" if true_tags else "Pass", "tags": true_tags,
+                        "predicted_pass_fail": predicted, "predicted_tags": predicted_tags})
+    return results
+
+def reference_evaluator_metrics(results, beta2=4.0):
+    """
+    The macro metrics as evaluator_metrics computed them before any of the faster
+    implementations: per-result count dicts, and each average a left-to-right float sum
+    divided by the number of results. Kept apart from metrics.py so self_check can tell
+    when evaluator_metrics itself drifts from the numbers of existing outputs.
+    """
+    totals = {key: 0.0 for key in ("precision", "recall", "f_beta", "fail_precision", "fail_recall", "fail_f_beta")}
+    n = n_fail = 0
+    for result in results:
+        true_counts, pred_counts = {}, {}
+        for tag in result["tags"]:
+            true_counts[tag] = true_counts.get(tag, 0) + 1
+        for tag in result["predicted_tags"]:
+            pred_counts[tag] = pred_counts.get(tag, 0) + 1
+        tp = sum(min(count, true_counts.get(tag, 0)) for tag, count in pred_counts.items())
+        fp = sum(pred_counts.values()) - tp
+        fn = sum(true_counts.values()) - tp
+        if not true_counts and not pred_counts:
+            p = r = 1.0
+        else:
+            p = tp / (tp + fp) if (tp + fp) > 0 else 0.0
+            r = tp / (tp + fn) if (tp + fn) > 0 else 1.0
+        f = ((1 + beta2) * p * r) / (beta2 * p + r) if (beta2 * p + r) > 0 else 0.0
+        n += 1
+        totals["precision"] += p
+        totals["recall"] += r
+        totals["f_beta"] += f
+        if result["tags"]:
+            n_fail += 1
+            totals["fail_precision"] += p
+            totals["fail_recall"] += r
+            totals["fail_f_beta"] += f
+    counts = {key: n_fail if key.startswith("fail_") else n for key in totals}
+    return {key: total / counts[key] if counts[key] > 0 else 0.0 for key, total in totals.items()}
+
+def self_check(results, tag_list):
+    """
+    Checks that metrics.evaluator_metrics still gives exactly (==, not within a tolerance)
+    the numbers of reference_evaluator_metrics, and that the other implementations of the
+    metrics give exactly what metrics.evaluator_metrics and metrics.chatbot_metrics give on `results`:
+    the macro metrics of detailed_evaluator_metrics, the accumulators continued after a
+    state()/from_state() round-trip, and the results store's metrics. Also
+    checks that the exact tagmatch.TagMatcher reads the same hashtags as the previous
+    regex extraction from answers listing each result's predicted tags.
+
+    Returns:
+        list: (check name, list of the mismatching keys, empty if it passed).
+    """
+    from modules.metrics import evaluator_metrics, chatbot_metrics, EvaluatorAccumulator, ChatbotAccumulator
+    from modules.results_store import ResultsStore
+    from modules.tagmatch import TagMatcher, _exact_matches
+
+    def mismatches(expected, actual):
+        return [key for key in expected if actual.get(key) != expected[key]]
+
+    expected = evaluator_metrics(results, filename=None)
+    expected_chatbot = chatbot_metrics(results, filename=None)
+    checks = [("evaluator_metrics against the reference sums", mismatches(reference_evaluator_metrics(results), expected)),
+              ("detailed_evaluator_metrics macro",
+               mismatches(expected, detailed_evaluator_metrics(results, tag_list, n_bootstrap=0, filename=None)["macro"]))]
+
+    # Continued after a JSON round-trip of its state halfway, the results still being added in order
+    half = len(results) // 2
+    evaluator = EvaluatorAccumulator.from_state(json.loads(json.dumps(EvaluatorAccumulator().update(results[:half]).state())))
+    chatbot = ChatbotAccumulator.from_state(json.loads(json.dumps(ChatbotAccumulator().update(results[:half]).state())))
+    checks.append(("EvaluatorAccumulator through state()", mismatches(expected, evaluator.update(results[half:]).metrics())))
+    checks.append(("ChatbotAccumulator through state()", mismatches(expected_chatbot, chatbot.update(results[half:]).metrics())))
+
+    store = ResultsStore.from_records(results, tag_list)
+    checks.append(("ResultsStore.evaluator_metrics", mismatches(expected, store.evaluator_metrics())))
+    checks.append(("ResultsStore.chatbot_metrics", mismatches(expected_chatbot, store.chatbot_metrics())))
+
+    matcher = TagMatcher(tag_list)
+    wrong = []
+    for i, result in enumerate(results):
+        tags = result["predicted_tags"] or []
+        answer = f"Hashtags: {', '.join(tags)}. " + " ".join(tag.lstrip("#") for tag in tags)
+        if matcher.extract(answer) != _exact_matches(answer, tag_list):
+            wrong.append(i)
+    checks.append(("TagMatcher (exact) on the predicted tags", wrong))
+    return checks
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    from modules.data import get_tags
+    from modules.runner import load_results
+    parser = argparse.ArgumentParser(description="Detailed evaluator metrics of the last run's results.")
+    parser.add_argument("--output-dir", default=".", help="Directory of the results (default: .)")
+    parser.add_argument("--check", action="store_true",
+                        help="Instead, check that the vectorized, accumulated and columnar metrics and the tag "
+                             "matcher agree exactly with metrics.py; exits with status 1 on a mismatch")
+    parser.add_argument("--synthetic", type=int, metavar="N",
+                        help="With --check, use N synthetic results instead of the run's results")
+    args = parser.parse_args()
+    if args.synthetic:
+        # Needs neither a run nor config/valid_tags.csv, e.g. for CI
+        from modules.benchmark import synthetic_tags
+        tag_list = synthetic_tags()
+        results = synthetic_results(args.synthetic, tag_list)
+    else:
+        tag_list = get_tags()
+        results = load_results(args.output_dir)
+    if args.check:
+        failed = 0
+        for name, wrong in self_check(results, tag_list):
+            failed += bool(wrong)
+            print(f"{'MISMATCH' if wrong else 'OK':<8} {name}" + (f": {', '.join(map(str, wrong[:10]))}" if wrong else ""))
+        print(f"{len(results)} results: " + (f"{failed} checks failed." if failed else "all checks passed."))
+        sys.exit(1 if failed else 0)
+    detailed_file = os.path.join(args.output_dir, "metrics_evaluator_detailed.json")
+    print_detailed_metrics(detailed_evaluator_metrics(results, tag_list, filename=detailed_file))
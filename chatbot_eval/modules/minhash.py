@@ -0,0 +1,70 @@
+import hashlib
+
+import numpy as np
+
+from modules.sampling import tokenize
+
+# Largest prime below 2**32: with 32-bit shingle hashes, a * h + b stays within uint64
+_PRIME = 4294967291
+
+class MinHasher:
+    """
+    MinHash signatures over the word `shingle_size`-grams of a text: the share of equal
+    positions in two signatures estimates the Jaccard similarity of their shingle sets.
+
+    The signature is split into `bands` bands of num_perm / bands rows for LSH: texts
+    sharing any band are candidate pairs, which catches pairs of similarity s with
+    probability 1 - (1 - s^rows)^bands (about 95% at 0.8 for the defaults).
+    """
+    def __init__(self, num_perm=128, bands=16, shingle_size=5, seed=0):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, num_perm, dtype=np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+    def shingles(self, text):
+        tokens = tokenize(text)
+        k = self.shingle_size
+        grams = {" ".join(tokens[i:i + k]) for i in range(max(1, len(tokens) - k + 1))}
+        return np.fromiter((int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=4).digest(), "big")
+                            for gram in grams), dtype=np.uint64, count=len(grams))
+
+    def signature(self, text):
+        hashes = self.shingles(text)
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % _PRIME).min(axis=1)
+
+    def band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+def similarity(signature, other):
+    return float(np.mean(signature == other))
+
+class LSHIndex:
+    """
+    Signatures bucketed by band, answering which indexed texts are at least
+    `threshold` similar to a signature.
+    """
+    def __init__(self, hasher, threshold):
+        self.hasher = hasher
+        self.threshold = threshold
+        self.signatures = []
+        self.buckets = {}
+
+    def add(self, signature):
+        position = len(self.signatures)
+        self.signatures.append(signature)
+        for key in self.hasher.band_keys(signature):
+            self.buckets.setdefault(key, []).append(position)
+        return position
+
+    def query(self, signature):
+        """
+        Returns [(position, estimated similarity)] of the indexed texts at least `threshold` similar.
+        """
+        candidates = {position for key in self.hasher.band_keys(signature) for position in self.buckets.get(key, ())}
+        matches = ((position, similarity(signature, self.signatures[position])) for position in sorted(candidates))
+        return [(position, s) for position, s in matches if s >= self.threshold]
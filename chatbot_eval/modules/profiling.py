@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import asyncio
+import inspect
+import itertools
+import threading
+import functools
+import contextvars
+
+# Timing spans over the stages of a run (data loading, linearization, prompts, model
+# calls, parsing, JSON I/O), enabled with `python app.py --profile trace.json`. While
+# disabled, span() returns a shared no-op and @profiled functions call straight
+# through, so the hooks can stay in the hot paths. The spans are exported as a Chrome
+# trace (chrome://tracing, https://ui.perfetto.dev) or OTLP JSON, and summed up in a
+# table of the hot paths (see Profiler.summary).
+
+TRACE_FORMATS = ("chrome", "otlp")
+
+# The active Profiler, None while profiling is disabled
+_profiler = None
+# Innermost open span of the current thread or asyncio task
+_current = contextvars.ContextVar("profiling_span", default=None)
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Span:
+    """
+    One timed section, recorded by its Profiler when it exits. `attributes` are free-form
+    details (e.g. the stage of a model call) that can be added while it runs with set().
+    """
+    __slots__ = ("profiler", "name", "attributes", "id", "parent", "lane", "start", "end", "child_time", "_token")
+
+    def __init__(self, profiler, name, attributes):
+        self.profiler = profiler
+        self.name = name
+        self.attributes = attributes
+        self.child_time = 0.0
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.id = next(self.profiler.ids)
+        self.parent = _current.get()
+        self._token = _current.set(self)
+        self.lane = self.profiler.lane()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        # Children running concurrently on other tasks or threads are not part of its self time
+        if self.parent is not None and self.parent.lane == self.lane:
+            self.parent.child_time += self.end - self.start
+        self.profiler.spans.append(self)
+        return False
+
+class Profiler:
+    """
+    Collects the spans of a run. Each thread and asyncio task has its own lane (a row of
+    the trace), so spans on a lane are properly nested even when examples run concurrently.
+    The lane of a finished task is reused by the next one, so there are about as many
+    lanes as examples in flight.
+    """
+    def __init__(self):
+        self.spans = []
+        self.ids = itertools.count(1)
+        self.start = time.perf_counter()
+        # Unix time in ns of perf_counter() == 0, for OTLP timestamps
+        self.epoch_ns = time.time_ns() - int(self.start * 1e9)
+        self.trace_id = os.urandom(16).hex()
+        self.lane_names = []
+        self._lanes = {}
+        self._free_lanes = {}
+        self._lock = threading.Lock()
+
+    def lane(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        thread = threading.get_ident()
+        key = (thread, id(task) if task else None)
+        lane = self._lanes.get(key)
+        if lane is not None:
+            return lane
+        with self._lock:
+            free = self._free_lanes.get(thread)
+            if free:
+                lane = free.pop()
+            else:
+                lane = len(self.lane_names)
+                self.lane_names.append(threading.current_thread().name + (f" / task {lane}" if task else ""))
+            self._lanes[key] = lane
+        if task:
+            task.add_done_callback(lambda _: self._release(key, lane))
+        return lane
+
+    def _release(self, key, lane):
+        with self._lock:
+            del self._lanes[key]
+            self._free_lanes.setdefault(key[0], []).append(lane)
+
+    def chrome_trace(self):
+        """
+        The spans as Chrome trace events ("X" complete events in µs), one thread row per lane.
+        """
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for tid, name in enumerate(self.lane_names)]
+        events += [{"name": s.name, "cat": s.name.split(".")[0], "ph": "X", "pid": pid, "tid": s.lane,
+                    "ts": (s.start - self.start) * 1e6, "dur": (s.end - s.start) * 1e6, "args": s.attributes}
+                   for s in self.spans]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def otlp_trace(self):
+        """
+        The spans as an OTLP/JSON trace (ExportTraceServiceRequest), e.g. for an OpenTelemetry collector.
+        """
+        def unix_ns(seconds):
+            return str(self.epoch_ns + int(seconds * 1e9))
+
+        spans = []
+        for s in self.spans:
+            span = {"traceId": self.trace_id, "spanId": f"{s.id:016x}", "name": s.name, "kind": 1,
+                    "startTimeUnixNano": unix_ns(s.start), "endTimeUnixNano": unix_ns(s.end),
+                    "attributes": [_otlp_attribute(key, value) for key, value in s.attributes.items()]}
+            if s.parent is not None:
+                span["parentSpanId"] = f"{s.parent.id:016x}"
+            spans.append(span)
+        resource = {"attributes": [_otlp_attribute("service.name", "chatbot-eval")]}
+        return {"resourceSpans": [{"resource": resource, "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}]}]}
+
+    def export(self, filename, format="chrome"):
+        if format not in TRACE_FORMATS:
+            raise ValueError(f"Unknown trace format '{format}', expected one of {TRACE_FORMATS}")
+        trace = self.chrome_trace() if format == "chrome" else self.otlp_trace()
+        with open(filename, "w") as f:
+            json.dump(trace, f)
+
+    def summary(self):
+        """
+        Per span name (model calls served by the response cache apart), sorted by self time:
+        calls, total and self time (without nested spans of the same lane), mean/p95/max
+        duration, the share of the wall time it was running, and its concurrency (total
+        time / time running, e.g. ~8 for model calls with 8 examples in flight).
+        """
+        from modules.report import percentile
+        wall_time = time.perf_counter() - self.start
+        groups = {}
+        for s in self.spans:
+            name = s.name + (" [cache]" if s.attributes.get("from_cache") else "")
+            groups.setdefault(name, []).append(s)
+
+        rows = []
+        for name, spans in groups.items():
+            durations = [s.end - s.start for s in spans]
+            total = sum(durations)
+            busy = _covered_time(spans)
+            rows.append({
+                "name": name,
+                "calls": len(spans),
+                "total_s": total,
+                "self_s": sum(duration - s.child_time for duration, s in zip(durations, spans)),
+                "mean_ms": total / len(spans) * 1e3,
+                "p95_ms": percentile(durations, 95) * 1e3,
+                "max_ms": max(durations) * 1e3,
+                "wall_share": busy / wall_time if wall_time else 0.0,
+                "concurrency": total / busy if busy else 1.0,
+            })
+        rows.sort(key=lambda row: row["self_s"], reverse=True)
+        return {"wall_time_s": wall_time, "spans": rows}
+
+def _covered_time(spans):
+    # Length of the union of the spans' intervals
+    covered, end = 0.0, None
+    for s in sorted(spans, key=lambda s: s.start):
+        if end is None or s.start > end:
+            covered += s.end - s.start
+            end = s.end
+        elif s.end > end:
+            covered += s.end - end
+            end = s.end
+    return covered
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+def start_profiling():
+    """
+    Starts recording spans, discarding those of a previous profiler. Returns the new Profiler.
+    """
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+def stop_profiling():
+    """
+    Stops recording spans. Returns the Profiler that recorded them (None if none was enabled).
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def profiling_enabled():
+    return _profiler is not None
+
+def span(name, **attributes):
+    """
+    Context manager timing a section of code as `name` (dotted, its first part being the
+    category in the trace), e.g. `with span("prompt_model.tagging", model=model) as s: ...`.
+    """
+    profiler = _profiler
+    if profiler is None:
+        return _NULL_SPAN
+    return Span(profiler, name, attributes)
+
+def profiled(name):
+    """
+    Decorator timing every call of a function or coroutine function as a span `name`.
+    """
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                profiler = _profiler
+                if profiler is None:
+                    return await function(*args, **kwargs)
+                with Span(profiler, name, {}):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                profiler = _profiler
+                if profiler is None:
+                    return function(*args, **kwargs)
+                with Span(profiler, name, {}):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def profiled_iter(name, iterable):
+    """
+    Times each step of an iterable (e.g. reading the next row of a streamed file) as a
+    span `name`. Returns the iterable itself while profiling is disabled.
+    """
+    if _profiler is None:
+        return iterable
+    return _timed_steps(name, iter(iterable))
+
+def _timed_steps(name, iterator):
+    while True:
+        with span(name):
+            item = next(iterator, _NULL_SPAN)
+        if item is _NULL_SPAN:
+            return
+        yield item
+
+def print_profile(summary, limit=20):
+    """
+    Prints the hot paths of Profiler.summary, at most `limit` rows.
+    """
+    print(f"Profile (hot paths by self time, {summary['wall_time_s']:.1f}s wall):")
+    print(f"{'span':<32} {'calls':>7} {'total s':>9} {'self s':>8} {'mean ms':>9} {'p95 ms':>9} "
+          f"{'max ms':>9} {'% wall':>7} {'concur.':>7}")
+    for row in summary["spans"][:limit]:
+        print(f"{row['name'][:32]:<32} {row['calls']:>7} {row['total_s']:>9.3f} {row['self_s']:>8.3f} "
+              f"{row['mean_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['max_ms']:>9.2f} "
+              f"{row['wall_share']:>7.1%} {row['concurrency']:>7.1f}")
@@ -0,0 +1,142 @@
+import time
+
+from modules.metrics import EvaluatorAccumulator, ChatbotAccumulator
+
+# Results needed before the F-beta interval is trusted enough to stop a run on it
+MIN_EXAMPLES_TO_STOP = 30
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+class RunProgress:
+    """
+    Live metrics of a run, updated as each outcome lands: the evaluator and chatbot
+    metric accumulators (see metrics.EvaluatorAccumulator), throughput and ETA. A
+    progress line is printed every `every` seconds.
+
+    With `stop_ci_width`, `stopped` turns True once the 95% confidence interval of the
+    running F-beta is at most that wide (after MIN_EXAMPLES_TO_STOP results); the run
+    then stops taking new examples (see take) and lets those in flight finish.
+    `stopped_early` only turns True once an example was actually left out, so a run
+    whose criterion is met on its last example has not stopped early.
+
+    Parameters:
+        total (int): Examples this run will process, if known (for the ETA).
+        every (float): Seconds between progress lines, None for no lines.
+        stop_ci_width (float): Width of the F-beta interval to stop at, None to never stop.
+        beta2 (float): β² of the F-beta, as in evaluator_metrics.
+        label (str): Start of the progress lines.
+
+    Outcomes must be recorded from one thread, as runner.run_tests does.
+    """
+    def __init__(self, total=None, every=10.0, stop_ci_width=None, beta2=4.0, label="Progress"):
+        self.total = total
+        self.every = every
+        self.stop_ci_width = stop_ci_width
+        self.label = label
+        self.evaluator = EvaluatorAccumulator(beta2)
+        self.chatbot = ChatbotAccumulator()
+        self.processed = 0
+        self.errors = 0
+        self.resumed = 0
+        self.stopped = False
+        self.stopped_early = False
+        self._stop_reason = None
+        self.start = time.perf_counter()
+        self._printed = self.start
+
+    def add(self, result):
+        """
+        Adds a result to the running metrics without counting it as processed (it cost no calls).
+        """
+        self.evaluator.add(result)
+        self.chatbot.add(result)
+
+    def seed(self, results):
+        """
+        Counts the results of a previous run that this one resumes, without counting them as processed.
+        """
+        for result in results:
+            self.add(result)
+            self.resumed += 1
+
+    def update(self, result, error=None):
+        self.processed += 1
+        if result is None:
+            self.errors += 1
+        else:
+            self.evaluator.add(result)
+            self.chatbot.add(result)
+            if self.stop_ci_width is not None and not self.stopped and self.evaluator.n >= MIN_EXAMPLES_TO_STOP:
+                low, high = self.evaluator.f_beta_interval()
+                if high - low <= self.stop_ci_width:
+                    self.stopped = True
+                    self._stop_reason = (f"F-beta interval [{low:.3f}, {high:.3f}] is within {self.stop_ci_width} "
+                                         f"after {self.evaluator.n} results")
+        now = time.perf_counter()
+        if self.every is not None and now - self._printed >= self.every:
+            self._printed = now
+            print(self.line())
+
+    def skip(self):
+        """
+        Records that an example is left out because the run stopped.
+        """
+        if not self.stopped_early:
+            self.stopped_early = True
+            print(f"{self.label}: {self._stop_reason}, stopping early")
+
+    def take(self, pending):
+        """
+        Yields the pending examples until the run stops.
+        """
+        for item in pending:
+            if self.stopped:
+                self.skip()
+                return
+            yield item
+
+    @property
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.processed / elapsed if elapsed > 0 else None
+
+    def eta(self):
+        if self.total is None or not self.rate:
+            return None
+        return max(0, self.total - self.processed) / self.rate
+
+    def line(self):
+        """
+        e.g. "Progress: 120/1000 (12.0%), 3.2 examples/s, ETA 4m35s, F-beta 0.612 ±0.041, fail rate 0.450, 2 errors"
+        """
+        done = f"{self.processed}/{self.total} ({self.processed / self.total:.1%})" if self.total else f"{self.processed}"
+        text = f"{self.label}: {done}, {self.rate or 0.0:.1f} examples/s, ETA {format_duration(self.eta())}"
+        interval = self.evaluator.f_beta_interval()
+        if interval:
+            low, high = interval
+            text += f", F-beta {(low + high) / 2:.3f} ±{(high - low) / 2:.3f}, " \
+                    f"fail rate {self.chatbot.metrics()['fail_rate']:.3f}"
+        return text + f", {self.errors} errors"
+
+    def summary(self):
+        """
+        Returns the run's throughput, whether it stopped early, and its running metrics
+        (including resumed results) with the F-beta interval.
+        """
+        interval = self.evaluator.f_beta_interval()
+        return {
+            "processed": self.processed,
+            "errors": self.errors,
+            "resumed": self.resumed,
+            "elapsed_s": time.perf_counter() - self.start,
+            "examples_per_sec": self.rate,
+            "stopped_early": self.stopped_early,
+            "evaluator": self.evaluator.metrics(),
+            "f_beta_ci": list(interval) if interval else None,
+            "chatbot": self.chatbot.metrics(),
+        }
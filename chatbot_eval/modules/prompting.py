@@ -1,6 +1,10 @@
-import re
-from modules.clients.openai_client_azure import prompt_model
+import json
+from collections import Counter
+from modules.tagmatch import matcher_for
+from modules.profiling import profiled
+from modules.clients.registry import prompt_model, aprompt_model
 
+@profiled("prompting.linearize")
 def linearize_demonstrations_pass_fail(demonstrations):
     """
     Converts a list of demonstration examples into a formatted text string
@@ -13,6 +17,7 @@ def linearize_demonstrations_pass_fail(demonstrations):
         prompt_text += f"Pass/Fail: {demo.pass_fail}\n\n"
     return prompt_text
 
+@profiled("prompting.linearize")
 def linearize_demonstrations_tagging(demonstrations):
     """
     Converts a list of demonstration examples into a formatted text string
@@ -26,6 +31,26 @@ def linearize_demonstrations_tagging(demonstrations):
             prompt_text += f"Hashtags: {hashtags}\n\n"
     return prompt_text
 
+@profiled("prompting.linearize")
+def linearize_demonstrations_structured(demonstrations):
+    """
+    Converts a list of demonstration examples into a formatted text string
+    for the single-call structured step, showing each conversation once with
+    both its pass/fail status and its hashtags as the expected JSON answer.
+    """
+    prompt_text = ""
+    for demo in demonstrations:
+        answer = {"pass_fail": demo.pass_fail, "tags": (demo.expected or []) if demo.pass_fail == "Fail" else []}
+        prompt_text += f"Conversation:\n {demo.text}\n"
+        prompt_text += f"Answer: {json.dumps(answer)}\n\n"
+    return prompt_text
+
+# Prompts are split into role-separated messages. Everything before the final user
+# message (instructions, tag options, demonstrations) only depends on the run's
+# demonstrations and tag list, so it is byte-identical across all calls of a run and
+# the provider's automatic prompt caching can reuse it. Only the last message varies.
+
+@profiled("prompting.construct_prompt")
 def construct_prompt_pass_fail(demonstrations_text, conversation):
     """
     Constructs the prompt to classify whether the conversation passes or fails.
@@ -35,16 +60,18 @@ def construct_prompt_pass_fail(demonstrations_text, conversation):
         conversation (str): The text of the conversation to classify.
     
     Returns:
-        str: The constructed prompt for pass/fail classification.
+        list: The chat messages for pass/fail classification, with a static prefix
+              and the conversation in the last message.
     """
-    prompt = (
-        f"Below are conversations with their 'Pass/Fail' status:\n{demonstrations_text}\n"
-        "Does the conversation pass or fail? Respond with 'Pass' or 'Fail'.\n"
-        f"Conversation: {conversation}\n"
-    )
-    # print(prompt)
-    return prompt
+    messages = [
+        {"role": "system", "content": "Does the conversation pass or fail? Respond with 'Pass' or 'Fail'."},
+        {"role": "user", "content": f"Below are conversations with their 'Pass/Fail' status:\n{demonstrations_text}"},
+        {"role": "user", "content": f"Conversation: {conversation}\n"},
+    ]
+    # print(messages)
+    return messages
 
+@profiled("prompting.construct_prompt")
 def construct_prompt_tagging(demonstrations_text, conversation, tag_list):
     """
     Constructs the prompt to select hashtags for a failed conversation.
@@ -55,24 +82,70 @@ def construct_prompt_tagging(demonstrations_text, conversation, tag_list):
         tag_list (list): The full list of valid hashtags for prediction.
     
     Returns:
-        str: The constructed prompt for selecting hashtags.
+        list: The chat messages for selecting hashtags, with a static prefix
+              and the conversation in the last message.
+    """
+    bulletpoint_tag_list = "\n".join([f"- {tag}" for tag in tag_list])
+    messages = [
+        {"role": "system", "content": (
+            "Select the hashtags from the options below that are most applicable to the conversation. "
+            "Return only the selected hashtags separated by commas (no additional text).\n"
+            f"Options:\n{bulletpoint_tag_list}\n"
+        )},
+        {"role": "user", "content": f"Below are conversations and the hashtags that describe them:\n{demonstrations_text}"},
+        {"role": "user", "content": f"Conversation: {conversation}\n"},
+    ]
+    # print(messages)
+    return messages
+
+@profiled("prompting.construct_prompt")
+def construct_prompt_structured(demonstrations_text, conversation, tag_list):
+    """
+    Constructs the prompt that classifies pass/fail and selects hashtags in one call.
+    
+    Parameters:
+        demonstrations_text (str): The formatted text of the structured demonstrations.
+        conversation (str): The text of the conversation to classify.
+        tag_list (list): The full list of valid hashtags for prediction.
+    
+    Returns:
+        list: The chat messages asking for a JSON object answer, with a static prefix
+              and the conversation in the last message.
     """
     bulletpoint_tag_list = "\n".join([f"- {tag}" for tag in tag_list])
-    prompt = (
-        f"Below are conversations and the hashtags that describe them:\n{demonstrations_text}\n"
-        "Select the hashtags from the options below that are most applicable to the conversation. "
-        "Return only the selected hashtags separated by commas (no additional text).\n"
-        f"Conversation: {conversation}\n"
-        f"Options:\n{bulletpoint_tag_list}\n"
-    )
-    # print(prompt)
-    return prompt
-
-def process_example(idx, test_data, pass_fail_demos_text, tagging_demos_text, tags):
+    messages = [
+        {"role": "system", "content": (
+            "Does the conversation pass or fail? If it fails, also select the hashtags from the options below "
+            "that are most applicable to the conversation.\n"
+            'Respond with a JSON object only: {"pass_fail": "Pass" or "Fail", "tags": [selected hashtags, empty if "Pass"]}.\n'
+            f"Options:\n{bulletpoint_tag_list}\n"
+        )},
+        {"role": "user", "content": (
+            "Below are conversations with their 'Pass/Fail' status and the hashtags that describe the failures:\n"
+            f"{demonstrations_text}"
+        )},
+        {"role": "user", "content": f"Conversation: {conversation}\n"},
+    ]
+    # print(messages)
+    return messages
+
+@profiled("example")
+def process_example(idx, test_data, pass_fail_demos_text, tagging_demos_text, tags, samples=1, tag_threshold=0.5,
+                    model=None, cascade=None):
     """
     Run one test example through the model in two steps:
     Step 1: Classify pass/fail.
     Step 2: If fail, predict failure hashtags.
+
+    With samples > 1 each step asks for that many completions in a single request
+    (self-consistency): pass/fail is the majority vote and the hashtags are those
+    chosen by at least `tag_threshold` of the samples, see vote_pass_fail and vote_tags.
+    The result then also holds the samples' "agreement" as a confidence signal.
+
+    `model` overrides the backend's model. With a `cascade` (see cascade.Cascade), an
+    example whose pass/fail answer is not confident enough is evaluated again by the
+    cascade's strong model before any tagging call, and the result records its "tier"
+    ("base" or "strong"), the base answer's "confidence" and, if escalated, its "base_pass_fail".
     
     Returns (result_dict, None) on success, (None, error_dict) on failure.
     """
@@ -80,56 +153,326 @@ def process_example(idx, test_data, pass_fail_demos_text, tagging_demos_text, ta
     pass_fail_prompt = construct_prompt_pass_fail(pass_fail_demos_text, test_data.text)
     try:
         # First API call: pass/fail classification
-        pass_fail_response = prompt_model(pass_fail_prompt)
-        print(f"{idx}: {pass_fail_response}")
+        pass_fail_response = prompt_model(pass_fail_prompt, stage="pass_fail", n=samples, model=model,
+                                          logprobs=bool(cascade and cascade.logprobs))
+        print(f"{idx}: {pass_fail_response.content}")
         
-        if "Fail" in pass_fail_response:
-            predicted_pass_fail = "Fail"
-            
+        predicted_pass_fail, agreement = vote_pass_fail(response_samples(pass_fail_response))
+        if cascade:
+            confidence = cascade.confidence(pass_fail_response, predicted_pass_fail, agreement)
+            if cascade.escalates(confidence):
+                print(f"{idx}: escalating to {cascade.strong_model} (confidence {_format_confidence(confidence)})")
+                outcome = process_example(idx, test_data, pass_fail_demos_text, tagging_demos_text, tags,
+                                          model=cascade.strong_model)
+                return cascade.escalated(outcome, predicted_pass_fail, confidence)
+        tag_agreement = None
+        if predicted_pass_fail == "Fail":
             # Step 2: If it failed, predict hashtags (tags)
             tagging_prompt = construct_prompt_tagging(tagging_demos_text, test_data.text, tags)
             # Second API call: tag prediction
-            tagging_response = prompt_model(tagging_prompt)
-            print(f"Tags: {tagging_response}")
+            tagging_response = prompt_model(tagging_prompt, stage="tagging", n=samples, model=model)
+            print(f"Tags: {tagging_response.content}")
             
-            predicted_tags = extract_valid_hashtags(tagging_response, tags)
-        else: # assuming "Pass" if not "Fail"
-            predicted_pass_fail = "Pass"
+            predicted_tags, tag_agreement = vote_tags(
+                [extract_valid_hashtags(sample, tags) for sample in response_samples(tagging_response)], tag_threshold)
+        else:
             predicted_tags = []
 
-        return {
-            "review": test_data.text,
-            "pass_fail": test_data.pass_fail,
-            "tags": test_data.expected,
-            "predicted_pass_fail": predicted_pass_fail,
-            "predicted_tags": predicted_tags,
-        }, None
+        result = build_result(test_data, predicted_pass_fail, predicted_tags)
+        if samples > 1:
+            result["agreement"] = {"pass_fail": agreement, "tags": tag_agreement}
+        if cascade:
+            return cascade.kept((result, None), confidence)
+        return result, None
     
     except Exception as e:
-        return None, {
-            "review": test_data.text,
-            "true_labels": test_data.expected,
-            "error": str(e),
-        }
+        return None, build_error(test_data, e)
 
-def extract_valid_hashtags(response, tag_list):
+@profiled("example")
+async def process_example_async(idx, test_data, pass_fail_demos_text, tagging_demos_text, tags, samples=1, tag_threshold=0.5,
+                                model=None, cascade=None):
     """
-    Extracts valid hashtags from the model's response.
+    Async version of process_example, awaiting the model instead of blocking on it.
+    The two steps stay sequential per example; concurrency comes from running many
+    examples at once (see runner.run_tests).
+    
+    Returns (result_dict, None) on success, (None, error_dict) on failure.
+    """
+    pass_fail_prompt = construct_prompt_pass_fail(pass_fail_demos_text, test_data.text)
+    try:
+        pass_fail_response = await aprompt_model(pass_fail_prompt, stage="pass_fail", n=samples, model=model,
+                                                 logprobs=bool(cascade and cascade.logprobs))
+        print(f"{idx}: {pass_fail_response.content}")
+
+        predicted_pass_fail, agreement = vote_pass_fail(response_samples(pass_fail_response))
+        if cascade:
+            confidence = cascade.confidence(pass_fail_response, predicted_pass_fail, agreement)
+            if cascade.escalates(confidence):
+                print(f"{idx}: escalating to {cascade.strong_model} (confidence {_format_confidence(confidence)})")
+                outcome = await process_example_async(idx, test_data, pass_fail_demos_text, tagging_demos_text, tags,
+                                                      model=cascade.strong_model)
+                return cascade.escalated(outcome, predicted_pass_fail, confidence)
+        tag_agreement = None
+        if predicted_pass_fail == "Fail":
+            tagging_prompt = construct_prompt_tagging(tagging_demos_text, test_data.text, tags)
+            tagging_response = await aprompt_model(tagging_prompt, stage="tagging", n=samples, model=model)
+            print(f"Tags: {tagging_response.content}")
+            predicted_tags, tag_agreement = vote_tags(
+                [extract_valid_hashtags(sample, tags) for sample in response_samples(tagging_response)], tag_threshold)
+        else:
+            predicted_tags = []
+
+        result = build_result(test_data, predicted_pass_fail, predicted_tags)
+        if samples > 1:
+            result["agreement"] = {"pass_fail": agreement, "tags": tag_agreement}
+        if cascade:
+            return cascade.kept((result, None), confidence)
+        return result, None
+
+    except Exception as e:
+        return None, build_error(test_data, e)
+
+@profiled("example")
+def process_example_structured(idx, test_data, structured_demos_text, pass_fail_demos_text, tagging_demos_text, tags,
+                               samples=1, tag_threshold=0.5, model=None, cascade=None):
+    """
+    Run one test example through the model in a single call that returns
+    {"pass_fail", "tags"} as JSON. If the answer cannot be parsed, falls back to
+    the two-step process_example. With samples > 1 the parseable samples are voted
+    on, see vote_structured. `model` and `cascade` work as in process_example, the
+    confidence being that of the JSON answer's pass/fail value.
+    
+    Returns (result_dict, None) on success, (None, error_dict) on failure.
+    The result has "fallback": True when the two-step flow was used.
+    """
+    prompt = construct_prompt_structured(structured_demos_text, test_data.text, tags)
+    try:
+        response = prompt_model(prompt, json_mode=True, stage="structured", n=samples, model=model,
+                                logprobs=bool(cascade and cascade.logprobs))
+        print(f"{idx}: {response.content}")
+    except Exception as e:
+        return None, build_error(test_data, e)
+
+    # Only an unparseable answer falls back; errors of the call itself are not retried
+    try:
+        predicted_pass_fail, predicted_tags, agreement = vote_structured(response_samples(response), tags, tag_threshold)
+    except ValueError as e:
+        print(f"{idx}: unparseable structured answer ({e}), falling back to two steps")
+        res, err = process_example(idx, test_data, pass_fail_demos_text, tagging_demos_text, tags, samples, tag_threshold,
+                                   model, cascade)
+        if res:
+            res["fallback"] = True
+        return res, err
+    except Exception as e:
+        return None, build_error(test_data, e)
+
+    if cascade:
+        confidence = cascade.confidence(response, predicted_pass_fail, agreement["pass_fail"])
+        if cascade.escalates(confidence):
+            print(f"{idx}: escalating to {cascade.strong_model} (confidence {_format_confidence(confidence)})")
+            outcome = process_example_structured(idx, test_data, structured_demos_text, pass_fail_demos_text,
+                                             tagging_demos_text, tags, model=cascade.strong_model)
+            return cascade.escalated(outcome, predicted_pass_fail, confidence)
+
+    result = build_result(test_data, predicted_pass_fail, predicted_tags)
+    result["fallback"] = False
+    if samples > 1:
+        result["agreement"] = agreement
+    if cascade:
+        return cascade.kept((result, None), confidence)
+    return result, None
+
+@profiled("example")
+async def process_example_structured_async(idx, test_data, structured_demos_text, pass_fail_demos_text, tagging_demos_text, tags,
+                                           samples=1, tag_threshold=0.5, model=None, cascade=None):
+    """
+    Async version of process_example_structured.
+    
+    Returns (result_dict, None) on success, (None, error_dict) on failure.
+    """
+    prompt = construct_prompt_structured(structured_demos_text, test_data.text, tags)
+    try:
+        response = await aprompt_model(prompt, json_mode=True, stage="structured", n=samples, model=model,
+                                       logprobs=bool(cascade and cascade.logprobs))
+        print(f"{idx}: {response.content}")
+    except Exception as e:
+        return None, build_error(test_data, e)
+
+    # Only an unparseable answer falls back; errors of the call itself are not retried
+    try:
+        predicted_pass_fail, predicted_tags, agreement = vote_structured(response_samples(response), tags, tag_threshold)
+    except ValueError as e:
+        print(f"{idx}: unparseable structured answer ({e}), falling back to two steps")
+        res, err = await process_example_async(idx, test_data, pass_fail_demos_text, tagging_demos_text, tags,
+                                               samples, tag_threshold, model, cascade)
+        if res:
+            res["fallback"] = True
+        return res, err
+    except Exception as e:
+        return None, build_error(test_data, e)
+
+    if cascade:
+        confidence = cascade.confidence(response, predicted_pass_fail, agreement["pass_fail"])
+        if cascade.escalates(confidence):
+            print(f"{idx}: escalating to {cascade.strong_model} (confidence {_format_confidence(confidence)})")
+            outcome = await process_example_structured_async(idx, test_data, structured_demos_text, pass_fail_demos_text,
+                                                         tagging_demos_text, tags, model=cascade.strong_model)
+            return cascade.escalated(outcome, predicted_pass_fail, confidence)
+
+    result = build_result(test_data, predicted_pass_fail, predicted_tags)
+    result["fallback"] = False
+    if samples > 1:
+        result["agreement"] = agreement
+    if cascade:
+        return cascade.kept((result, None), confidence)
+    return result, None
+
+def response_samples(response):
+    """
+    All completions of an LLMResponse: its samples when several were requested, else its content.
+    """
+    return response.samples or [response.content]
+
+def vote_pass_fail(responses):
+    """
+    Majority vote over the pass/fail answers of several samples.
+
+    Returns:
+        tuple: ("Pass" or "Fail", share of the samples that agree with it). Ties go to
+               the answer of the earliest sample.
+    """
+    votes = Counter(parse_pass_fail(response) for response in responses)
+    label, count = votes.most_common(1)[0]
+    return label, count / len(responses)
+
+def vote_tags(tag_lists, threshold=0.5):
+    """
+    Thresholded vote over the hashtags of several samples.
+
+    Parameters:
+        tag_lists (list): The valid hashtags extracted from each sample.
+        threshold (float): Share of the samples that must choose a hashtag for it to be kept.
+
+    Returns:
+        tuple: (kept hashtags in order of first appearance, agreement), the agreement
+               being the mean Jaccard similarity between each sample's hashtags and the kept ones.
+    """
+    votes = Counter(tag for tags in tag_lists for tag in dict.fromkeys(tags))
+    kept = [tag for tag, count in votes.items() if count >= threshold * len(tag_lists)]
+    kept_set = set(kept)
+
+    def jaccard(tags):
+        union = kept_set | set(tags)
+        return len(kept_set & set(tags)) / len(union) if union else 1.0
+    return kept, sum(jaccard(tags) for tags in tag_lists) / len(tag_lists)
+
+def vote_structured(responses, tag_list, threshold=0.5):
+    """
+    Votes over the JSON answers of the structured prompt: majority pass/fail among the
+    parseable samples, then a thresholded vote on the hashtags of the samples that
+    answered "Fail".
+
+    Returns:
+        tuple: ("Pass" or "Fail", hashtags, {"pass_fail": agreement, "tags": agreement or None}).
+
+    Raises:
+        ValueError: If none of the samples can be parsed (see parse_structured_response).
+    """
+    answers = []
+    error = None
+    for response in responses:
+        try:
+            answers.append(parse_structured_response(response, tag_list))
+        except ValueError as e:
+            error = error or e
+    if not answers:
+        raise error
+
+    votes = Counter(pass_fail for pass_fail, _ in answers)
+    pass_fail, count = votes.most_common(1)[0]
+    if pass_fail == "Pass":
+        return pass_fail, [], {"pass_fail": count / len(answers), "tags": None}
+    tags, tag_agreement = vote_tags([tags for label, tags in answers if label == "Fail"], threshold)
+    return pass_fail, tags, {"pass_fail": count / len(answers), "tags": tag_agreement}
+
+def _format_confidence(confidence):
+    return "unknown" if confidence is None else f"{confidence:.2f}"
+
+@profiled("prompting.parse_structured")
+def parse_structured_response(response, tag_list):
+    """
+    Parses and validates the JSON answer of the structured prompt.
     
     Parameters:
         response (str): The raw response string from the model.
         tag_list (list): The list of valid hashtags.
     
     Returns:
-        list: A list of valid hashtags extracted from the response.
-    """
-    # Normalize the response by removing extra spaces and splitting into lines
-    response = response.strip()
+        tuple: ("Pass" or "Fail", list of valid hashtags). Hashtags outside tag_list are dropped.
     
-    # Use a regular expression to extract all words starting with '#'
-    extracted_tags = re.findall(r"#\w+", response)
+    Raises:
+        ValueError: If the response is not a JSON object with a valid "pass_fail" and a "tags" list.
+    """
+    try:
+        answer = json.loads(response)
+    except (json.JSONDecodeError, TypeError) as e:
+        raise ValueError(f"not valid JSON: {e}") from e
+    if not isinstance(answer, dict):
+        raise ValueError("answer is not a JSON object")
+
+    pass_fail = answer.get("pass_fail")
+    if pass_fail not in ("Pass", "Fail"):
+        raise ValueError(f"invalid pass_fail value {pass_fail!r}")
+    tags = answer.get("tags", [])
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        raise ValueError("tags is not a list of strings")
+
+    if pass_fail == "Pass":
+        return pass_fail, []
+    return pass_fail, extract_valid_hashtags(", ".join(tags), tag_list)
+
+def parse_pass_fail(response):
+    """
+    Maps the model's pass/fail answer to "Pass" or "Fail", assuming "Pass" if not "Fail".
+    """
+    return "Fail" if "Fail" in response else "Pass"
+
+def build_result(test_data, predicted_pass_fail, predicted_tags):
+    """
+    Builds the result dict saved to the results store for one example.
+    """
+    return {
+        "review": test_data.text,
+        "pass_fail": test_data.pass_fail,
+        "tags": test_data.expected,
+        "predicted_pass_fail": predicted_pass_fail,
+        "predicted_tags": predicted_tags,
+    }
+
+def build_error(test_data, error):
+    """
+    Builds the error dict saved to errors.json for one example.
+    """
+    return {
+        "review": test_data.text,
+        "pass_fail": test_data.pass_fail,
+        "true_labels": test_data.expected,
+        "error": str(error),
+    }
+
+@profiled("prompting.extract_hashtags")
+def extract_valid_hashtags(response, tag_list):
+    """
+    Extracts valid hashtags from the model's response.
     
-    # Filter the extracted tags to include only those in the valid tag list
-    valid_tags = [tag for tag in extracted_tags if tag in tag_list]
+    Parameters:
+        response (str): The raw response string from the model.
+        tag_list (list): The list of valid hashtags.
     
-    return valid_tags
\ No newline at end of file
+    Returns:
+        list: The valid hashtags found in the response, in their canonical spelling.
+              Aliases, and with `match = fuzzy` near-misses (case, missing '#', spaces
+              instead of '_'), are accepted as configured by [tags] in config.ini, see
+              tagmatch.TagMatcher.
+    """
+    return matcher_for(tag_list).extract(response)
\ No newline at end of file
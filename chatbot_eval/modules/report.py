@@ -0,0 +1,332 @@
+import math
+
+from modules.io import save_to_json
+from modules.clients.registry import load_config
+from modules.prompting import (linearize_demonstrations_pass_fail, linearize_demonstrations_tagging, linearize_demonstrations_structured,
+                               construct_prompt_pass_fail, construct_prompt_tagging, construct_prompt_structured)
+
+# USD per 1M tokens: (input, cached input, output). Override or add deployment
+# names in the [pricing] section of config.ini, e.g. `my-deployment = 0.40, 0.10, 1.60`
+MODEL_PRICES = {
+    "gpt-4.1":      (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o":       (2.50, 1.25, 10.00),
+    "gpt-4o-mini":  (0.15, 0.075, 0.60),
+}
+
+# Typical completion lengths used by the pre-flight estimate
+EXPECTED_OUTPUT_TOKENS = {"pass_fail": 2, "tagging": 16, "structured": 24}
+
+# Providers only cache prompt prefixes of at least this many tokens
+MIN_CACHEABLE_PREFIX = 1024
+
+# Examples over which the pre-flight estimate averages the prefixes that differ per example
+PREFIX_SAMPLE_SIZE = 100
+
+def load_prices():
+    """
+    Returns MODEL_PRICES updated with the [pricing] section of config.ini, if any.
+    """
+    prices = dict(MODEL_PRICES)
+    config = load_config()
+    if config.has_section("pricing"):
+        for name, value in config["pricing"].items():
+            prices[name] = tuple(float(part) for part in value.split(","))
+    return prices
+
+def estimate_cost(model, prompt_tokens, cached_tokens, completion_tokens, prices=None):
+    """
+    Estimated USD cost of the given token counts, or None if the model has no known price.
+    """
+    prices = prices or load_prices()
+    if model not in prices:
+        return None
+    input_price, cached_price, output_price = prices[model]
+    return ((prompt_tokens - cached_tokens) * input_price
+            + cached_tokens * cached_price
+            + completion_tokens * output_price) / 1_000_000
+
+def _encoder():
+    """
+    Returns tiktoken's o200k_base encoder (used by the gpt-4o/4.1 family) if tiktoken
+    is installed, otherwise None.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(messages, encoder=None):
+    """
+    Counts the prompt tokens of a list of chat messages. Without a tokenizer it
+    approximates 4 characters per token.
+    """
+    # every reply is primed with the assistant header
+    return 3 + sum(_message_tokens(message, encoder) for message in messages)
+
+def _message_tokens(message, encoder=None):
+    content = message["content"]
+    return 3 + (len(encoder.encode(content)) if encoder else math.ceil(len(content) / 4))
+
+def preflight_estimate(data_test, demos, tags, model, pipeline="two_step", selector=None, shortlister=None, samples=1):
+    """
+    Estimates the tokens and cost of a run before any request is sent, in a single pass
+    over `data_test` that only tokenizes each example's conversation (the last message of
+    its prompts); the prefix before it is counted once per stage. The number of tagging
+    calls is estimated from the fail rate of the demonstrations.
+    With a per-example `selector` the prefix differs between examples and is not shared
+    between calls; likewise for the prompts listing hashtag options when a `shortlister`
+    narrows them per example. Its size is then averaged over the first PREFIX_SAMPLE_SIZE
+    examples, so selector and shortlister are not run over the whole test set. With
+    `samples` completions per call only the completion tokens are multiplied.
+
+    Returns:
+        dict: Per stage estimated calls, prompt tokens, cacheable prompt tokens, completion
+              tokens and cost, plus the totals and the number of examples.
+    """
+    encoder = _encoder()
+    prices = load_prices()
+    fail_rate = sum(1 for demo in demos if demo.pass_fail == "Fail") / len(demos) if demos else 0.0
+
+    if pipeline == "structured":
+        stage_prompts = {"structured": (linearize_demonstrations_structured, construct_prompt_structured, 1.0, True)}
+    else:
+        stage_prompts = {
+            "pass_fail": (linearize_demonstrations_pass_fail, construct_prompt_pass_fail, 1.0, False),
+            "tagging": (linearize_demonstrations_tagging, construct_prompt_tagging, fail_rate, True),
+        }
+    shared_texts = {stage: linearize(demos) for stage, (linearize, *_) in stage_prompts.items()}
+
+    def prompt(stage, demos_text, conversation, tag_list):
+        construct, with_tags = stage_prompts[stage][1], stage_prompts[stage][3]
+        return construct(demos_text, conversation, tag_list) if with_tags else construct(demos_text, conversation)
+
+    # Everything but the last message is the prefix (see prompting.py)
+    shared_prefix = {stage: count_tokens(prompt(stage, shared_texts[stage], "", tags)[:-1], encoder)
+                     for stage in stage_prompts}
+    per_example = {stage: selector is not None or (shortlister is not None and with_tags)
+                   for stage, (_, _, _, with_tags) in stage_prompts.items()}
+
+    # One pass over the data for all stages, so data_test may be a stream
+    conversation_tokens = {stage: 0 for stage in stage_prompts}
+    sampled_prefix = {stage: 0 for stage in stage_prompts}
+    n = sampled = 0
+    for item in data_test:
+        counted = {}
+        for stage in stage_prompts:
+            # The last message only holds the conversation, whatever the demonstrations and options
+            message = prompt(stage, "", item.text, ())[-1]
+            if message["content"] not in counted:
+                counted[message["content"]] = _message_tokens(message, encoder)
+            conversation_tokens[stage] += counted[message["content"]]
+        if sampled < PREFIX_SAMPLE_SIZE and any(per_example.values()):
+            item_demos = selector(item) if selector else None
+            item_tags = shortlister(item) if shortlister else tags
+            for stage, (linearize, *_) in stage_prompts.items():
+                if per_example[stage]:
+                    demos_text = linearize(item_demos) if selector else shared_texts[stage]
+                    sampled_prefix[stage] += count_tokens(prompt(stage, demos_text, "", item_tags)[:-1], encoder)
+            sampled += 1
+        n += 1
+
+    stages = {}
+    for stage, (linearize, construct, share, with_tags) in stage_prompts.items():
+        calls = n * share
+        if per_example[stage]:
+            prefix_tokens = sampled_prefix[stage] / sampled if sampled else shared_prefix[stage]
+            cached = 0
+        else:
+            prefix_tokens = shared_prefix[stage]
+            cached = prefix_tokens * max(calls - 1, 0) if prefix_tokens >= MIN_CACHEABLE_PREFIX else 0
+        prompt_tokens = (prefix_tokens * n + conversation_tokens[stage]) * share
+        completion = EXPECTED_OUTPUT_TOKENS[stage] * calls * samples
+        stages[stage] = {
+            "calls": calls,
+            "prompt_tokens": prompt_tokens,
+            "cacheable_prompt_tokens": cached,
+            "completion_tokens": completion,
+            "estimated_cost_usd": estimate_cost(model, prompt_tokens, cached, completion, prices),
+        }
+
+    return {
+        "model": model,
+        "tokenizer": "o200k_base" if encoder else "chars/4",
+        "examples": n,
+        "stages": stages,
+        "total": _sum_stages(stages.values(), ("calls", "prompt_tokens", "cacheable_prompt_tokens", "completion_tokens", "estimated_cost_usd")),
+    }
+
+def percentile(values, q):
+    """
+    Linear-interpolated percentile of a list of numbers, q in [0, 100].
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+def _sum_stages(stages, keys):
+    totals = {}
+    for key in keys:
+        values = [stage[key] for stage in stages]
+        totals[key] = None if any(v is None for v in values) else sum(values)
+    return totals
+
+def build_run_report(calls, wall_time, preflight=None, endpoint_health=None):
+    """
+    Aggregates the usage log's per-call records into a run report.
+
+    Parameters:
+        calls (list): UsageLog records (stage, model, tokens, latency, from_cache).
+        wall_time (float): Duration of the run in seconds.
+        preflight (dict): Optional pre-flight estimate to include for comparison.
+        endpoint_health (dict): Optional per-endpoint counters of a pooled backend (registry.backend_stats).
+
+    Returns:
+        dict: Per stage call counts, token totals, p50/p95/p99 latency, completion tokens/sec
+              and estimated cost, plus run totals and, for pooled backends, the same per endpoint.
+              When calls went to several models (e.g. a cascade), calls, tokens and cost per model.
+    """
+    prices = load_prices()
+    by_stage = {}
+    for call in calls:
+        by_stage.setdefault(call["stage"], []).append(call)
+
+    stages = {}
+    for stage, stage_calls in by_stage.items():
+        api_calls = [c for c in stage_calls if not c["from_cache"]]
+        latencies = [c["latency"] for c in api_calls if c["latency"]]
+        prompt_tokens = sum(c["prompt_tokens"] for c in api_calls)
+        cached_tokens = sum(c["cached_tokens"] for c in api_calls)
+        completion_tokens = sum(c["completion_tokens"] for c in api_calls)
+
+        cost = 0.0
+        for c in api_calls:
+            call_cost = estimate_cost(c["model"], c["prompt_tokens"], c["cached_tokens"], c["completion_tokens"], prices)
+            if call_cost is None:
+                cost = None
+                break
+            cost += call_cost
+
+        stages[stage] = {
+            "calls": len(stage_calls),
+            "response_cache_hits": len(stage_calls) - len(api_calls),
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "latency_p99": percentile(latencies, 99),
+            "completion_tokens_per_sec": completion_tokens / sum(latencies) if latencies else None,
+            "estimated_cost_usd": cost,
+        }
+
+    total = _sum_stages(stages.values(), ("calls", "response_cache_hits", "prompt_tokens", "cached_tokens",
+                                          "completion_tokens", "estimated_cost_usd"))
+    total["wall_time_s"] = wall_time
+    total["tokens_per_sec"] = (total["prompt_tokens"] + total["completion_tokens"]) / wall_time if wall_time else None
+    total["calls_per_sec"] = total["calls"] / wall_time if wall_time else None
+
+    report = {"stages": stages, "total": total}
+    endpoints = _endpoint_stats(calls, prices, endpoint_health or {})
+    if endpoints:
+        report["endpoints"] = endpoints
+    models = _model_stats(calls, prices)
+    if len(models) > 1:
+        report["models"] = models
+    if preflight is not None:
+        report["preflight"] = preflight
+    return report
+
+def _endpoint_stats(calls, prices, health):
+    by_endpoint = {name: [] for name in health}
+    for call in calls:
+        if call.get("endpoint") and not call["from_cache"]:
+            by_endpoint.setdefault(call["endpoint"], []).append(call)
+
+    endpoints = {}
+    for name, endpoint_calls in by_endpoint.items():
+        latencies = [c["latency"] for c in endpoint_calls if c["latency"]]
+        costs = [estimate_cost(c["model"], c["prompt_tokens"], c["cached_tokens"], c["completion_tokens"], prices)
+                 for c in endpoint_calls]
+        endpoints[name] = {
+            "calls": len(endpoint_calls),
+            "prompt_tokens": sum(c["prompt_tokens"] for c in endpoint_calls),
+            "completion_tokens": sum(c["completion_tokens"] for c in endpoint_calls),
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "latency_p99": percentile(latencies, 99),
+            "estimated_cost_usd": None if None in costs else sum(costs),
+            **({"health": health[name]} if name in health else {}),
+        }
+    return endpoints
+
+def _model_stats(calls, prices):
+    by_model = {}
+    for call in calls:
+        by_model.setdefault(call["model"], []).append(call)
+
+    models = {}
+    for model, model_calls in by_model.items():
+        api_calls = [c for c in model_calls if not c["from_cache"]]
+        costs = [estimate_cost(model, c["prompt_tokens"], c["cached_tokens"], c["completion_tokens"], prices)
+                 for c in api_calls]
+        models[model] = {
+            "calls": len(model_calls),
+            "response_cache_hits": len(model_calls) - len(api_calls),
+            "prompt_tokens": sum(c["prompt_tokens"] for c in api_calls),
+            "completion_tokens": sum(c["completion_tokens"] for c in api_calls),
+            "estimated_cost_usd": None if None in costs else sum(costs),
+        }
+    return models
+
+def save_run_report(report, filename="run_report.json"):
+    save_to_json(filename, report)
+
+def _fmt(value, spec, prefix="", suffix=""):
+    return "n/a" if value is None else f"{prefix}{format(value, spec)}{suffix}"
+
+def print_preflight_estimate(estimate):
+    """
+    Nicely prints the pre-flight estimate.
+    """
+    total = estimate["total"]
+    print(f"Pre-flight estimate ({estimate['model']}, tokenizer: {estimate['tokenizer']}):")
+    for stage, s in estimate["stages"].items():
+        print(f"{stage:<10}: ~{s['calls']:.0f} calls, ~{s['prompt_tokens']:.0f} prompt tokens "
+              f"(~{s['cacheable_prompt_tokens']:.0f} cacheable), ~{_fmt(s['estimated_cost_usd'], '.4f', '$')}")
+    print(f"Total     : ~{total['prompt_tokens']:.0f} prompt tokens, ~{_fmt(total['estimated_cost_usd'], '.4f', '$')}\n")
+
+def print_run_report(report):
+    """
+    Nicely prints the run report.
+    """
+    print("Run report (per stage):")
+    for stage, s in report["stages"].items():
+        cached_rate = s["cached_tokens"] / s["prompt_tokens"] if s["prompt_tokens"] else 0.0
+        print(f"{stage:<10}: {s['calls']} calls ({s['response_cache_hits']} from response cache), "
+              f"{s['prompt_tokens']} prompt tokens ({cached_rate:.1%} prompt-cached), "
+              f"{s['completion_tokens']} completion tokens")
+        print(f"{'':<10}  latency p50/p95/p99: {_fmt(s['latency_p50'], '.2f', suffix='s')}/{_fmt(s['latency_p95'], '.2f', suffix='s')}/"
+              f"{_fmt(s['latency_p99'], '.2f', suffix='s')}, est. cost {_fmt(s['estimated_cost_usd'], '.4f', '$')}")
+    if "endpoints" in report:
+        print("Per endpoint:")
+        for name, e in report["endpoints"].items():
+            health = e.get("health", {})
+            status = "" if not health else (f", {health['errors']} failed attempts, drained {health['drained']}x, "
+                                            f"{'healthy' if health['healthy'] else 'draining'}")
+            print(f"{name:<10}: {e['calls']} calls, latency p50/p95/p99: {_fmt(e['latency_p50'], '.2f', suffix='s')}/"
+                  f"{_fmt(e['latency_p95'], '.2f', suffix='s')}/{_fmt(e['latency_p99'], '.2f', suffix='s')}{status}")
+    if "models" in report:
+        print("Per model:")
+        for model, m in report["models"].items():
+            print(f"{model:<10}: {m['calls']} calls ({m['response_cache_hits']} from response cache), "
+                  f"{m['prompt_tokens']} prompt tokens, {m['completion_tokens']} completion tokens, "
+                  f"est. cost {_fmt(m['estimated_cost_usd'], '.4f', '$')}")
+    total = report["total"]
+    print(f"Total     : {total['calls']} calls in {total['wall_time_s']:.1f}s "
+          f"({_fmt(total['tokens_per_sec'], '.0f')} tokens/sec), est. cost {_fmt(total['estimated_cost_usd'], '.4f', '$')}")
@@ -0,0 +1,298 @@
+import os
+import json
+import argparse
+import importlib.util
+
+import numpy as np
+
+from modules.io import save_to_json_stream
+from modules.metrics_vectorized import _ratio, _f_beta, _sequential_mean
+
+# Pass/fail labels as stored, -1 standing for a missing label
+LABELS = ("Pass", "Fail")
+# Keys every result has (see prompting.build_result); the others are kept as JSON per result
+CORE_KEYS = ("idx", "review", "pass_fail", "tags", "predicted_pass_fail", "predicted_tags")
+
+def store_filename():
+    # Parquet when pyarrow is installed, else a numpy archive
+    return "results.parquet" if importlib.util.find_spec("pyarrow") else "results.npz"
+
+def _encode_label(label):
+    return LABELS.index(label) if label in LABELS else -1
+
+def _strings_to_blob(strings):
+    # UTF-8 bytes of all strings back to back, and their offsets
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def _blob_to_strings(blob, offsets):
+    data = blob.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+class ResultsStore:
+    """
+    Columnar store of a run's results, instead of results.json: one array per field,
+    with every conversation text stored once and referenced by `text_id`, and hashtags
+    dictionary-encoded against a vocabulary (get_tags(), plus any other tag found).
+
+    Columns (numpy arrays, one entry per result unless noted):
+        idx (int64), text_id (int32) into `texts`,
+        pass_fail, predicted_pass_fail (int8 index into LABELS, -1 if missing),
+        tag_offsets, predicted_offsets (int64, one more entry than results) delimiting each
+        result's codes in tag_codes, predicted_codes (int32 index into `vocab`),
+        tags_missing (bool, the true tags were None), extras (JSON of the other keys, or "").
+
+    Metrics are computed straight from the columns (evaluator_metrics, chatbot_metrics),
+    identical to metrics.evaluator_metrics and metrics.chatbot_metrics on the same results.
+    Saved as Parquet (.parquet, requires pyarrow, the texts as a dictionary-encoded column)
+    or as a numpy archive (.npz); to_records/export_json give back the results.json records.
+    """
+    def __init__(self, columns, texts, vocab):
+        self.columns = columns
+        self.texts = texts
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.columns["idx"])
+
+    @classmethod
+    def from_records(cls, records, tag_list):
+        """
+        Builds the store from result dicts with their "idx" (e.g. ResultJournal.iter_results), in one pass.
+        """
+        vocab = list(tag_list)
+        codes = {tag: j for j, tag in enumerate(vocab)}
+        text_ids = {}
+        fields = {name: [] for name in ("idx", "text_id", "pass_fail", "predicted_pass_fail", "tags_missing", "extras")}
+        tag_codes, predicted_codes, tag_lengths, predicted_lengths = [], [], [], []
+
+        def encode(tags, out, lengths):
+            for tag in tags or []:
+                if tag not in codes:
+                    codes[tag] = len(vocab)
+                    vocab.append(tag)
+                out.append(codes[tag])
+            lengths.append(len(tags or []))
+
+        for record in records:
+            fields["idx"].append(record["idx"])
+            fields["text_id"].append(text_ids.setdefault(record["review"], len(text_ids)))
+            fields["pass_fail"].append(_encode_label(record["pass_fail"]))
+            fields["predicted_pass_fail"].append(_encode_label(record["predicted_pass_fail"]))
+            fields["tags_missing"].append(record["tags"] is None)
+            encode(record["tags"], tag_codes, tag_lengths)
+            encode(record["predicted_tags"], predicted_codes, predicted_lengths)
+            extras = {key: value for key, value in record.items() if key not in CORE_KEYS}
+            fields["extras"].append(json.dumps(extras) if extras else "")
+
+        def offsets(lengths):
+            out = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=out[1:])
+            return out
+
+        columns = {
+            "idx": np.array(fields["idx"], dtype=np.int64),
+            "text_id": np.array(fields["text_id"], dtype=np.int32),
+            "pass_fail": np.array(fields["pass_fail"], dtype=np.int8),
+            "predicted_pass_fail": np.array(fields["predicted_pass_fail"], dtype=np.int8),
+            "tags_missing": np.array(fields["tags_missing"], dtype=bool),
+            "tag_offsets": offsets(tag_lengths),
+            "tag_codes": np.array(tag_codes, dtype=np.int32),
+            "predicted_offsets": offsets(predicted_lengths),
+            "predicted_codes": np.array(predicted_codes, dtype=np.int32),
+            "extras": fields["extras"],
+        }
+        return cls(columns, list(text_ids), vocab)
+
+    def _tag_lists(self, offsets, codes):
+        vocab = self.vocab
+        codes = codes.tolist()
+        offsets = offsets.tolist()
+        return [[vocab[code] for code in codes[offsets[i]:offsets[i + 1]]] for i in range(len(self))]
+
+    def to_records(self):
+        """
+        Returns the result dicts, as in results.json (ordered by idx, with the same keys).
+        """
+        c = self.columns
+        tags = self._tag_lists(c["tag_offsets"], c["tag_codes"])
+        predicted = self._tag_lists(c["predicted_offsets"], c["predicted_codes"])
+        records = []
+        for i, (idx, text_id, pass_fail, predicted_pass_fail, missing, extras) in enumerate(zip(
+                c["idx"].tolist(), c["text_id"].tolist(), c["pass_fail"].tolist(),
+                c["predicted_pass_fail"].tolist(), c["tags_missing"].tolist(), c["extras"])):
+            record = {
+                "idx": idx,
+                "review": self.texts[text_id],
+                "pass_fail": LABELS[pass_fail] if pass_fail >= 0 else None,
+                "tags": None if missing else tags[i],
+                "predicted_pass_fail": LABELS[predicted_pass_fail] if predicted_pass_fail >= 0 else None,
+                "predicted_tags": predicted[i],
+            }
+            if extras:
+                record.update(json.loads(extras))
+            records.append(record)
+        return records
+
+    def export_json(self, filename="results.json"):
+        save_to_json_stream(filename, self.to_records())
+
+    def example_scores(self, beta2=4.0):
+        """
+        Per-result precision, recall and F_β of the predicted hashtags, from the tag codes
+        (multiset matching, as metrics.tag_scores), and the mask of results with true tags.
+        """
+        c = self.columns
+        n, width = len(self), max(len(self.vocab), 1)
+        n_true = np.diff(c["tag_offsets"])
+        n_predicted = np.diff(c["predicted_offsets"])
+        # One key per (result, tag); matched counts are the smaller of its true and predicted counts
+        true_keys, true_counts = np.unique(np.repeat(np.arange(n, dtype=np.int64), n_true) * width + c["tag_codes"],
+                                           return_counts=True)
+        predicted_keys, predicted_counts = np.unique(
+            np.repeat(np.arange(n, dtype=np.int64), n_predicted) * width + c["predicted_codes"], return_counts=True)
+        common, true_at, predicted_at = np.intersect1d(true_keys, predicted_keys, assume_unique=True, return_indices=True)
+        tp = np.bincount(common // width, weights=np.minimum(true_counts[true_at], predicted_counts[predicted_at]),
+                         minlength=n).astype(np.int64)
+        fp = n_predicted - tp
+        fn = n_true - tp
+
+        p = _ratio(tp, tp + fp, 0.0)
+        r = _ratio(tp, tp + fn, 1.0)
+        # no true & no pred → perfect
+        both_empty = (n_true == 0) & (n_predicted == 0)
+        p[both_empty] = 1.0
+        r[both_empty] = 1.0
+        return p, r, _f_beta(p, r, beta2), n_true > 0
+
+    def evaluator_metrics(self, beta2=4.0):
+        """
+        Same as metrics.evaluator_metrics, bit for bit.
+        """
+        p, r, f, fail = self.example_scores(beta2)
+        mean = _sequential_mean
+        return {
+            "precision"     : mean(p),
+            "recall"        : mean(r),
+            "f_beta"        : mean(f),
+            "fail_precision": mean(p[fail]),
+            "fail_recall"   : mean(r[fail]),
+            "fail_f_beta"   : mean(f[fail]),
+        }
+
+    def chatbot_metrics(self):
+        """
+        Same as metrics.chatbot_metrics.
+        """
+        c = self.columns
+        total = len(self)
+        failed = c["predicted_pass_fail"] != LABELS.index("Pass")
+        passes = int(total - failed.sum())
+        fails = total - passes
+        n_predicted = np.diff(c["predicted_offsets"])
+        failed_codes = c["predicted_codes"][np.repeat(failed, n_predicted)]
+        counts = np.bincount(failed_codes, minlength=len(self.vocab))
+        # Tags in the order they first appear, as chatbot_metrics' Counter has them
+        codes, first = np.unique(failed_codes, return_index=True)
+        return {
+            "total": total,
+            "passes": passes,
+            "fails": fails,
+            "pass_rate": passes / total if total else 0.0,
+            "fail_rate": fails / total if total else 0.0,
+            "avg_tags_per_failure": int(n_predicted[failed].sum()) / fails if fails else 0.0,
+            "tag_distribution": {self.vocab[j]: int(counts[j]) for j in codes[np.argsort(first)].tolist()},
+        }
+
+    def save(self, path):
+        """
+        Writes the store to `path`: Parquet for .parquet, a numpy archive otherwise.
+        """
+        if path.endswith(".parquet"):
+            self._save_parquet(path)
+            return
+        c = self.columns
+        text_blob, text_offsets = _strings_to_blob(self.texts)
+        extras_blob, extras_offsets = _strings_to_blob(c["extras"])
+        vocab_blob, vocab_offsets = _strings_to_blob(self.vocab)
+        arrays = {name: c[name] for name in c if name != "extras"}
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **arrays, text_blob=text_blob, text_offsets=text_offsets,
+                                extras_blob=extras_blob, extras_offsets=extras_offsets,
+                                vocab_blob=vocab_blob, vocab_offsets=vocab_offsets)
+
+    def _save_parquet(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        c = self.columns
+        table = pa.table({
+            "idx": c["idx"],
+            # Dictionary-encoded: each distinct text is written once per row group
+            "review": pa.DictionaryArray.from_arrays(pa.array(c["text_id"]), pa.array(self.texts, type=pa.string())),
+            "pass_fail": c["pass_fail"],
+            "predicted_pass_fail": c["predicted_pass_fail"],
+            "tags_missing": c["tags_missing"],
+            "tags": pa.LargeListArray.from_arrays(pa.array(c["tag_offsets"]), pa.array(c["tag_codes"])),
+            "predicted_tags": pa.LargeListArray.from_arrays(pa.array(c["predicted_offsets"]), pa.array(c["predicted_codes"])),
+            "extras": pa.array(c["extras"], type=pa.string()),
+        }).replace_schema_metadata({"vocab": json.dumps(self.vocab)})
+        # A dictionary page larger than the limit would fall back to storing every text in full
+        pq.write_table(table, path, dictionary_pagesize_limit=2 ** 30)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a store written by save.
+        """
+        if path.endswith(".parquet"):
+            return cls._load_parquet(path)
+        with np.load(path) as archive:
+            columns = {name: archive[name] for name in archive.files if not name.endswith(("_blob", "_offsets"))
+                       or name in ("tag_offsets", "predicted_offsets")}
+            columns["extras"] = _blob_to_strings(archive["extras_blob"], archive["extras_offsets"])
+            texts = _blob_to_strings(archive["text_blob"], archive["text_offsets"])
+            vocab = _blob_to_strings(archive["vocab_blob"], archive["vocab_offsets"])
+        return cls(columns, texts, vocab)
+
+    @classmethod
+    def _load_parquet(cls, path):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, read_dictionary=["review"]).unify_dictionaries().combine_chunks()
+        review = table.column("review").chunk(0) if table.num_rows else None
+
+        def list_column(name):
+            column = table.column(name).chunk(0) if table.num_rows else None
+            if column is None:
+                return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32)
+            return column.offsets.to_numpy().astype(np.int64), column.values.to_numpy().astype(np.int32)
+
+        tag_offsets, tag_codes = list_column("tags")
+        predicted_offsets, predicted_codes = list_column("predicted_tags")
+        columns = {
+            "idx": table.column("idx").to_numpy(),
+            "text_id": review.indices.to_numpy().astype(np.int32) if review is not None else np.zeros(0, dtype=np.int32),
+            "pass_fail": table.column("pass_fail").to_numpy(),
+            "predicted_pass_fail": table.column("predicted_pass_fail").to_numpy(),
+            "tags_missing": table.column("tags_missing").to_numpy(),
+            "tag_offsets": tag_offsets,
+            "tag_codes": tag_codes,
+            "predicted_offsets": predicted_offsets,
+            "predicted_codes": predicted_codes,
+            "extras": table.column("extras").to_pylist(),
+        }
+        texts = review.dictionary.to_pylist() if review is not None else []
+        return cls(columns, texts, json.loads(table.schema.metadata[b"vocab"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a results store to results.json.")
+    parser.add_argument("store", nargs="?", help="results.parquet or results.npz (default: the latest one here)")
+    parser.add_argument("--json", default="results.json", help="JSON file to write (default: results.json)")
+    args = parser.parse_args()
+    path = args.store or next((name for name in ("results.parquet", "results.npz") if os.path.exists(name)), None)
+    if path is None:
+        parser.error("No results.parquet or results.npz here, pass the store to export")
+    store = ResultsStore.load(path)
+    store.export_json(args.json)
+    print(f"Exported {len(store)} results ({len(store.texts)} distinct conversations) to '{args.json}'.")
@@ -0,0 +1,322 @@
+import os
+import json
+import glob
+import shutil
+import math
+import zlib
+import hashlib
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from modules.sampling import tokenize
+from modules.clients.registry import load_config, client_backend
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(__file__))
+
+# Demonstrations vectorized (and written to the memmap) at a time while building
+BUILD_CHUNK = 4096
+# Index rows scored against a batch of queries at a time while searching
+SEARCH_CHUNK = 65536
+
+class HashingBackend:
+    """
+    Offline TF-IDF vectors over hashed word tokens.
+
+    Tokens are hashed (stable crc32, not Python's salted hash) into `dims` signed
+    buckets, so no vocabulary has to be kept. The document frequency of every bucket
+    is learned by `fit` and stored with the index, so test conversations are weighted
+    with the demonstration pool's IDF. Rows are L2-normalized: dot product = cosine.
+    """
+    name = "hashing"
+
+    def __init__(self, dims=1024):
+        self.dims = dims
+        self.idf = None
+
+    def signature(self):
+        return f"{self.name}{self.dims}"
+
+    def _counts(self, texts):
+        counts = np.zeros((len(texts), self.dims), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token, c in Counter(tokenize(text)).items():
+                h = zlib.crc32(token.encode("utf-8"))
+                counts[i, h % self.dims] += (1.0 if h & 0x80000000 else -1.0) * (1 + math.log(c))
+        return counts
+
+    def fit(self, chunks):
+        """
+        Learns the IDF of every bucket from an iterable of text lists.
+        """
+        df = np.zeros(self.dims, dtype=np.int64)
+        n = 0
+        for texts in chunks:
+            df += (self._counts(texts) != 0).sum(axis=0)
+            n += len(texts)
+        self.idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+
+    def transform(self, texts):
+        vectors = self._counts(texts) * self.idf
+        return _normalize(vectors)
+
+    def save(self, directory):
+        np.save(os.path.join(directory, "idf.npy"), self.idf)
+
+    def load(self, directory):
+        self.idf = np.load(os.path.join(directory, "idf.npy"))
+
+class EmbeddingBackend:
+    """
+    Vectors from an embedding model deployment (e.g. text-embedding-3-small), requested
+    `batch_size` texts per API call. Uses the client of the selected backend
+    (see clients/registry.py), which is only created when texts are actually embedded;
+    a backend without one (mock) is rejected right away with a ValueError.
+    """
+    name = "embedding"
+
+    def __init__(self, deployment="text-embedding-3-small", batch_size=256):
+        client_backend()
+        self.deployment = deployment
+        self.batch_size = batch_size
+
+    def signature(self):
+        return f"{self.name}-{self.deployment}"
+
+    def fit(self, chunks):
+        pass
+
+    def transform(self, texts):
+        client = client_backend().get_client()
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            response = client.embeddings.create(model=self.deployment, input=texts[start:start + self.batch_size])
+            vectors.extend(item.embedding for item in response.data)
+        return _normalize(np.array(vectors, dtype=np.float32))
+
+    def save(self, directory):
+        pass
+
+    def load(self, directory):
+        pass
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+def make_backend():
+    """
+    Builds the backend described by the optional [retrieval] section of config.ini
+    (backend = hashing | embedding, dims, embedding_deployment). Defaults to hashing.
+    """
+    config = load_config()
+    section = config["retrieval"] if config.has_section("retrieval") else {}
+    if section.get("backend", "hashing") == "embedding":
+        return EmbeddingBackend(section.get("embedding_deployment", "text-embedding-3-small"))
+    return HashingBackend(int(section.get("dims", 1024)))
+
+def file_hash(path):
+    """
+    sha256 of a file's bytes, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class KNNIndex:
+    """
+    Nearest-neighbour index over the text of a demonstration file.
+
+    The vectors live in `vectors.npy`, opened as a read-only memory map so pools of
+    100k+ demonstrations are paged in by the OS rather than loaded. Index directories
+    are named after the source file, the backend and the file's sha256, so editing the
+    CSV (or changing the backend) builds a new index and the stale one is removed.
+
+    Use KNNIndex.from_loader to load or build an index; `search` scores whole batches
+    of queries with one matrix multiply per chunk of index rows.
+    """
+    def __init__(self, directory, backend):
+        self.directory = directory
+        self.backend = backend
+        backend.load(directory)
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @classmethod
+    def from_loader(cls, loader, filename, backend=None, cache_dir="cache/retrieval"):
+        """
+        Returns the index of `<loader.base>/<filename>`, building it first if the file
+        has no index for this backend yet (or has changed since it was built).
+
+        Parameters:
+            loader (ConvoLoader): Loader of the demonstration file (needs a `base` directory).
+            filename (str): Demonstration file name, e.g. "demo.csv".
+            backend: HashingBackend or EmbeddingBackend; default from make_backend().
+            cache_dir (str): Where indexes are stored, relative to the project root.
+
+        Returns:
+            KNNIndex
+        """
+        backend = backend or make_backend()
+        source = os.path.join(loader.base, filename)
+        stem = f"{os.path.splitext(filename)[0]}-{backend.signature()}"
+        cache_dir = os.path.join(PROJECT_ROOT, cache_dir)
+        directory = os.path.join(cache_dir, f"{stem}-{file_hash(source)[:16]}")
+
+        if not os.path.exists(os.path.join(directory, "meta.json")):
+            for stale in glob.glob(os.path.join(cache_dir, f"{stem}-*")):
+                shutil.rmtree(stale, ignore_errors=True)
+            build_index(directory, backend, lambda: loader.iter_chunks(filename, BUILD_CHUNK), source)
+        return cls(directory, backend)
+
+    def search(self, texts, k, batch_size=1024):
+        """
+        Top-k most similar index rows for each query text.
+
+        Returns:
+            tuple: (indices, scores), both (len(texts) x k) arrays sorted by decreasing similarity.
+        """
+        k = min(k, len(self))
+        indices = np.zeros((len(texts), k), dtype=np.int64)
+        scores = np.zeros((len(texts), k), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            queries = self.backend.transform(texts[start:start + batch_size])
+            indices[start:start + len(queries)], scores[start:start + len(queries)] = self._search_vectors(queries, k)
+        return indices, scores
+
+    def _search_vectors(self, queries, k):
+        best_idx = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), SEARCH_CHUNK):
+            chunk_scores = queries @ np.asarray(self.vectors[start:start + SEARCH_CHUNK]).T
+            # Keep only the chunk's top k per query before merging with the running best
+            top = min(k, chunk_scores.shape[1])
+            part = np.argpartition(-chunk_scores, top - 1, axis=1)[:, :top]
+            best_idx = np.concatenate([best_idx, part + start], axis=1)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(chunk_scores, part, axis=1)], axis=1)
+            if best_idx.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_idx = np.take_along_axis(best_idx, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_idx, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+def build_index(directory, backend, chunks, source=None):
+    """
+    Vectorizes the demonstrations into `<directory>/vectors.npy`, one chunk at a time.
+    meta.json is written last, so an interrupted build is never mistaken for a complete one.
+
+    Parameters:
+        directory (str): Index directory to create.
+        backend: The vector backend.
+        chunks (callable): Returns a fresh iterator of ConvoItem lists (the data is read
+                           twice: once to fit the backend, once to vectorize).
+        source (str): Source file path, recorded in meta.json.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rows = [0]
+
+    def texts(count=False):
+        for chunk in chunks():
+            if count:
+                rows[0] += len(chunk)
+            yield [item.text for item in chunk]
+    backend.fit(texts(count=True))
+    n = rows[0]
+
+    vectors = None
+    row = 0
+    for batch in texts():
+        batch_vectors = backend.transform(batch)
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(os.path.join(directory, "vectors.npy"), mode="w+",
+                                                dtype=np.float32, shape=(n, batch_vectors.shape[1]))
+        vectors[row:row + len(batch)] = batch_vectors
+        row += len(batch)
+    if vectors is None:
+        raise ValueError("Cannot build a retrieval index over an empty demonstration file")
+    vectors.flush()
+    del vectors
+
+    backend.save(directory)
+    with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"source": source, "backend": backend.signature(), "rows": n}, f, indent=4)
+
+class KNNSelector:
+    """
+    Per-example demonstration selector (see runner.run_tests) returning the k
+    demonstrations most similar to the test conversation, most similar last.
+
+    Wrap the examples the run consumes with `prefetch` to search them in batches as
+    they are read; examples that were not prefetched are searched one at a time. Only
+    the neighbours of the last `2 * batch_size` conversations searched are kept, by a
+    digest of their text, so a streamed test set is never held in memory.
+
+    Parameters:
+        index (KNNIndex): Index over the demonstration file.
+        demos (list): The demonstrations, in the same order as the file the index was built from.
+        k (int): Number of demonstrations per example.
+        batch_size (int): Conversations searched at once by prefetch.
+    """
+    def __init__(self, index, demos, k=16, batch_size=1024):
+        if len(demos) != len(index):
+            raise ValueError(f"Index has {len(index)} rows but {len(demos)} demonstrations were given")
+        self.index = index
+        self.demos = demos
+        self.k = k
+        self.batch_size = batch_size
+        self._neighbours = OrderedDict()  # text digest -> rows of the neighbours
+
+    def prefetch(self, pairs):
+        """
+        Yields the (idx, ConvoItem) pairs unchanged, searching the neighbours of each
+        batch of `batch_size` examples before yielding its first one.
+        """
+        batch = []
+        for pair in pairs:
+            batch.append(pair)
+            if len(batch) >= self.batch_size:
+                self._store([item.text for _, item in batch])
+                yield from batch
+                batch = []
+        if batch:
+            self._store([item.text for _, item in batch])
+            yield from batch
+
+    def _store(self, texts):
+        indices, _ = self.index.search(texts, self.k)
+        for text, row in zip(texts, indices):
+            self._neighbours[_text_digest(text)] = row
+        # The previous batch may still be in flight
+        while len(self._neighbours) > 2 * self.batch_size:
+            self._neighbours.popitem(last=False)
+
+    def select(self, item):
+        """
+        Returns the k demonstrations for one example, most similar last.
+        """
+        key = _text_digest(item.text)
+        if key not in self._neighbours:
+            self._store([item.text])
+        return [self.demos[i] for i in reversed(self._neighbours[key])]
+
+    __call__ = select
+
+def _text_digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+if __name__ == "__main__":
+    from modules.loaders.csv_loader import CSVConvoLoader
+    loader = CSVConvoLoader()
+    index = KNNIndex.from_loader(loader, "demo.csv")
+    demos = loader.load("demo.csv")
+    test = loader.load("test.csv", limit=3)
+    indices, scores = index.search([item.text for item in test], k=3)
+    for item, rows, row_scores in zip(test, indices, scores):
+        print(f"{item.text[:80]!r}")
+        for i, score in zip(rows, row_scores):
+            print(f"  {score:.3f} {demos[i].text[:80]!r}")
@@ -1,21 +1,329 @@
 # modules/runner.py
-from modules.io import save_to_json
-from modules.prompting import linearize_demonstrations_pass_fail, linearize_demonstrations_tagging, process_example
+import os
+import time
+import asyncio
+import importlib.util
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-def run_tests(data_test, demos, tags):
+from modules.io import read_from_json, save_to_json
+from modules.data import ConvoItem
+from modules.journal import ResultJournal
+from modules.metrics import evaluator_metrics, chatbot_metrics
+from modules.progress import RunProgress
+from modules.profiling import span, profiled
+from modules.shortlist import ShortlistRecall, print_shortlist_recall
+from modules.clients.cache import print_cache_stats
+from modules.clients.usage import usage_log
+from modules.clients.registry import model_name, backend_stats
+from modules.report import preflight_estimate, print_preflight_estimate, build_run_report, save_run_report, print_run_report
+from modules.prompting import (linearize_demonstrations_pass_fail, linearize_demonstrations_tagging, linearize_demonstrations_structured,
+                               process_example, process_example_async, process_example_structured, process_example_structured_async)
+
+# Max number of conversations in flight at once for the "async" and "threads" modes.
+# Raise it until the provider's rate limit (not latency) is the bottleneck.
+DEFAULT_CONCURRENCY = 8
+
+RUN_MODES = ("sequential", "async", "threads")
+
+# "two_step": pass/fail call, then a tagging call for failures
+# "structured": one JSON call returning both, falling back to two_step if unparseable
+PIPELINES = ("two_step", "structured")
+
+@profiled("run_tests")
+def run_tests(data_test, demos, tags, mode="sequential", concurrency=DEFAULT_CONCURRENCY,
+              journal_path="results.jsonl", resume=False, pipeline="two_step", selector=None, indices=None,
+              shortlister=None, samples=1, tag_threshold=0.5, cascade=None, output_dir=".",
+              progress_every=10.0, stop_ci_width=None, export_json=False, duplicates=None):
     """
     Iterate over all test examples, collect successes/errors.
+
+    Parameters:
+        data_test (iterable): ConvoItem objects to evaluate. May be lazy (ConvoLoader.stream
+                              or iter_load), in which case examples are read as the run
+                              consumes them so memory stays flat regardless of dataset size.
+        demos (list): ConvoItem demonstrations shown to the model (the pool, when `selector` is set).
+        tags (list): The full list of valid hashtags.
+        mode (str): "sequential" (one example at a time), "async" (AsyncOpenAI client,
+                    up to `concurrency` examples in flight) or "threads" (sync client
+                    on a thread pool of `concurrency` workers).
+        concurrency (int): Max number of examples processed at once.
+        journal_path (str): JSONL file each outcome is appended to as soon as it completes.
+        resume (bool): Keep the existing journal and skip examples that already have a result.
+        pipeline (str): "two_step" or "structured" (pass/fail and tags in one JSON call).
+        selector (callable): Optional per-example demonstration selector, item -> list of
+                             demos (e.g. sampling.RelevantHashtagsLastSelector). Without it
+                             every example shares the same `demos` (and prompt prefix).
+        indices (list): idx of each example of data_test in the journal (default: its position),
+                        e.g. when re-running the examples of errors.json (see load_error_items).
+        shortlister (callable): Optional item -> hashtags narrowing the options of each
+                                example's prompt (shortlist.TagShortlister). Its recall on
+                                the labelled failed examples is added to the run report.
+        samples (int): Completions requested per call for self-consistency voting (1: no voting).
+        tag_threshold (float): Share of the samples that must choose a hashtag to keep it.
+        cascade (cascade.Cascade): Optional escalation of the examples the backend's model
+                                   is not confident about to a stronger model. With the
+                                   "agreement" signal, samples is raised to cascade.samples.
+        output_dir (str): Directory of the journal (when journal_path is relative) and
+                          of the files derived from it (e.g. one per shard, see modules.shard).
+        progress_every (float): Seconds between progress lines (throughput, ETA, running
+                                F-beta), None for none.
+        stop_ci_width (float): Stop taking new examples once the 95% interval of the running
+                               F-beta is at most this wide (see progress.RunProgress).
+        export_json (bool): Also write results.json next to the results store.
+        duplicates (dedup.DuplicateClusters): Optional clusters of duplicate examples of
+                                              data_test: only their representatives are
+                                              evaluated, and each outcome is copied to the
+                                              other members of its cluster.
+
+    The results store (see export_results) and errors.json are derived from the journal
+    once the run ends (also on CTRL-C), ordered by idx regardless of completion order. Token usage, latency and cost
+    per stage, along with a pre-flight estimate, are written to run_report.json. All of
+    them are written to output_dir, the report with the live metrics of the run.
+
+    Returns:
+        tuple: (number of results, number of errors)
+    """
+    if mode not in RUN_MODES:
+        raise ValueError(f"Unknown run mode '{mode}', expected one of {RUN_MODES}")
+    if pipeline not in PIPELINES:
+        raise ValueError(f"Unknown pipeline '{pipeline}', expected one of {PIPELINES}")
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+    if samples < 1:
+        raise ValueError(f"samples must be at least 1, got {samples}")
+    if cascade and cascade.signal == "agreement":
+        samples = max(samples, cascade.samples)
+
+    if pipeline == "structured":
+        process, aprocess = process_example_structured, process_example_structured_async
+    else:
+        process, aprocess = process_example, process_example_async
+    if samples > 1 or cascade:
+        process = partial(process, samples=samples, tag_threshold=tag_threshold, cascade=cascade)
+        aprocess = partial(aprocess, samples=samples, tag_threshold=tag_threshold, cascade=cascade)
+    shortlist_recall = ShortlistRecall() if shortlister else None
+    if selector is None and shortlister is None:
+        # Shared by every example, so linearized once
+        args = pipeline_args(pipeline, demos, tags)
+        process_one = process
+        aprocess_one = aprocess
+    else:
+        # Each example gets its own demonstrations (linearized when it is processed) and/or hashtag options
+        shared_args = pipeline_args(pipeline, demos, tags) if selector is None else None
+
+        def example_args(test_data):
+            demos_args = shared_args or pipeline_args(pipeline, selector(test_data), tags)
+            if shortlister is None:
+                return demos_args
+            options = shortlister(test_data)
+            shortlist_recall.add(test_data, options)
+            return demos_args[:-1] + (options,)
+
+        def process_one(idx, test_data):
+            return process(idx, test_data, *example_args(test_data))
+
+        async def aprocess_one(idx, test_data):
+            return await aprocess(idx, test_data, *example_args(test_data))
+        args = ()
+
+    os.makedirs(output_dir, exist_ok=True)
+    journal_path = os.path.join(output_dir, journal_path)
+    journal = ResultJournal(journal_path)
+    done = journal.completed_indices() if resume else set()
+    if done:
+        print(f"Resuming from '{journal_path}': skipping {len(done)} completed examples.")
+    def pending_examples():
+        pairs = zip(indices, data_test) if indices is not None else enumerate(data_test)
+        if duplicates is None:
+            return ((idx, test_data) for idx, test_data in pairs if idx not in done)
+        return ((idx, test_data) for idx, test_data in pairs if duplicates.dispatched(idx, done))
+    pending = pending_examples()
+    if hasattr(selector, "prefetch"):
+        # e.g. the knn selector searches the examples in batches as they are read
+        pending = selector.prefetch(pending)
+
+    # The estimate needs its own pass over the data, so it is skipped for one-shot
+    # iterators; lists and ConvoStream can be iterated again
+    preflight = None
+    if iter(data_test) is not data_test:
+        with span("run.preflight"):
+            preflight = preflight_estimate((test_data for idx, test_data in pending_examples()),
+                                           demos, tags, model_name(), pipeline, selector, shortlister, samples)
+        print_preflight_estimate(preflight)
+    progress = RunProgress(preflight["examples"] if preflight else None, progress_every, stop_ci_width)
+    if done:
+        progress.seed(record["result"] for record in journal.read().values() if "result" in record)
+    # An early stop only keeps new examples from starting
+    pending = progress.take(pending)
+    usage_log.reset()
+    start = time.perf_counter()
+
+    def record(idx, res, err):
+        if duplicates is not None:
+            for member, member_res, member_err in duplicates.fan_out(idx, res, err):
+                journal.append(member, result=member_res, error=member_err)
+                if member_res is not None:
+                    progress.add(member_res)
+        journal.append(idx, result=res, error=err)
+        progress.update(res, err)
+
+    try:
+        with journal.open(resume=resume):
+            if mode == "async":
+                asyncio.run(run_async(aprocess_one, pending, args, concurrency, record))
+            elif mode == "threads":
+                _run_threads(process_one, pending, args, concurrency, record)
+            else:
+                for idx, test_data in pending:
+                    record(idx, *process_one(idx, test_data, *args))
+    finally:
+        # Also runs on CTRL-C or a crash, after the journal has been synced and closed
+        results_path, n_results, n_errors = export_results(journal, tags, output_dir, export_json)
+        usage_log.save(os.path.join(output_dir, "usage.json"))
+        report = build_run_report(usage_log.snapshot(), time.perf_counter() - start, preflight, backend_stats())
+        report["progress"] = progress.summary()
+        if shortlist_recall:
+            report["shortlist"] = shortlist_recall.summary()
+        if duplicates is not None:
+            report["dedup"] = duplicates.summary()
+        if cascade:
+            report["cascade"] = {"strong_model": cascade.strong_model, "threshold": cascade.threshold,
+                                 "signal": cascade.signal, "samples": samples}
+        save_run_report(report, os.path.join(output_dir, "run_report.json"))
+
+    print(f"\nExperiment completed. {n_results} results saved to '{results_path}' ({n_errors} errors).")
+    print(progress.line())
+    if progress.stopped_early:
+        print(f"Stopped early after {progress.processed} of {progress.total or 'all'} examples; "
+              f"--resume evaluates the rest.")
+    print_cache_stats()
+    print_run_report(report)
+    if shortlist_recall:
+        print_shortlist_recall(report["shortlist"], getattr(shortlister, "top_n", None))
+    print()
+    return n_results, n_errors
+
+@profiled("io.export_results")
+def export_results(journal, tags, output_dir=".", export_json=False):
+    """
+    Writes a journal's errors to errors.json and its results to a columnar results store
+    (results_store.ResultsStore: results.parquet with pyarrow installed, else results.npz),
+    plus results.json with `export_json`. Without numpy only results.json is written.
+
+    Returns:
+        tuple: (path of the results, number of results, number of errors)
+    """
+    columnar = importlib.util.find_spec("numpy") is not None
+    json_path = os.path.join(output_dir, "results.json")
+    n_results, n_errors = journal.export(json_path if export_json or not columnar else None,
+                                         os.path.join(output_dir, "errors.json"))
+    if not columnar:
+        return json_path, n_results, n_errors
+    # numpy (and pyarrow) are only needed for the store
+    from modules.results_store import ResultsStore, store_filename
+    path = os.path.join(output_dir, store_filename())
+    ResultsStore.from_records(journal.iter_results(), tags).save(path)
+    return path, n_results, n_errors
+
+def find_results(output_dir="."):
+    """
+    Path of the results the last run wrote to output_dir: its results store, or its
+    results.json if that is newer (e.g. a run without numpy), or None.
+    """
+    paths = [os.path.join(output_dir, name) for name in ("results.parquet", "results.npz", "results.json")]
+    paths = [path for path in paths if os.path.exists(path)]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+def run_metrics(output_dir):
+    """
+    Computes and saves the evaluator and chatbot metrics of the results in output_dir,
+    straight from the columns of its results store when there is one.
+    """
+    path = find_results(output_dir)
+    evaluator_file = os.path.join(output_dir, "metrics_evaluator.json")
+    chatbot_file = os.path.join(output_dir, "metrics_chatbot.json")
+    if path.endswith(".json"):
+        results = read_from_json(path)
+        return evaluator_metrics(results, filename=evaluator_file), chatbot_metrics(results, filename=chatbot_file)
+    from modules.results_store import ResultsStore
+    store = ResultsStore.load(path)
+    metrics, chatbot_met = store.evaluator_metrics(), store.chatbot_metrics()
+    save_to_json(evaluator_file, metrics)
+    save_to_json(chatbot_file, chatbot_met)
+    return metrics, chatbot_met
+
+def load_results(output_dir="."):
+    """
+    The result dicts of the last run in output_dir (see find_results).
+    """
+    path = find_results(output_dir)
+    if path is None:
+        raise FileNotFoundError(f"No results in '{output_dir}'")
+    if path.endswith(".json"):
+        return read_from_json(path)
+    from modules.results_store import ResultsStore
+    return ResultsStore.load(path).to_records()
+
+def load_error_items(errors_file="errors.json"):
+    """
+    Rebuilds the examples that failed in a previous run from its errors.json.
+
+    Returns:
+        tuple: (list of ConvoItem, list of their idx), to pass to run_tests as
+               data_test and indices, with resume=True so the results already in the
+               journal are kept and the new outcomes replace the errors.
+    """
+    errors = read_from_json(errors_file)
+    items = [ConvoItem(text=error["review"], pass_fail=error.get("pass_fail"), expected=error["true_labels"])
+             for error in errors]
+    return items, [error["idx"] for error in errors]
+
+def pipeline_args(pipeline, demos, tags):
+    """
+    Linearizes `demos` into the demonstration arguments the pipeline's process function
+    expects after (idx, test_data).
     """
     pass_fail_demos_text = linearize_demonstrations_pass_fail(demos)
     tagging_demos_text = linearize_demonstrations_tagging(demos)
+    if pipeline == "structured":
+        return (linearize_demonstrations_structured(demos), pass_fail_demos_text, tagging_demos_text, tags)
+    return (pass_fail_demos_text, tagging_demos_text, tags)
 
-    results, errors = [], []
-    for idx, test_data in enumerate(data_test):
-        res, err = process_example(idx, test_data, pass_fail_demos_text, tagging_demos_text, tags)
-        if res:    results.append(res)
-        if err:    errors.append(err)
+async def run_async(aprocess, pending, args, concurrency, record):
+    """
+    Runs the async pipeline function `aprocess` over the pending (idx, example) pairs with at most
+    `concurrency` in flight, recording each outcome as it completes. Examples are pulled
+    from `pending` only as slots free up, so it can be a lazy iterator.
+    """
+    async def run_one(idx, test_data):
+        res, err = await aprocess(idx, test_data, *args)
+        # Runs on the event loop thread, so journal writes never interleave
+        record(idx, res, err)
+
+    in_flight = set()
+    for idx, test_data in pending:
+        if len(in_flight) >= concurrency:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()  # re-raise unexpected failures (e.g. journal I/O)
+        in_flight.add(asyncio.create_task(run_one(idx, test_data)))
+    if in_flight:
+        await asyncio.gather(*in_flight)
 
-    save_to_json("results.json", results)
-    save_to_json("errors.json", errors)
-    
-    print(f"\nExperiment completed. {len(results)} results saved to 'results.json'.\n")
\ No newline at end of file
+def _run_threads(process, pending, args, concurrency, record):
+    """
+    Fallback for the sync clients: runs the pipeline function `process` on a thread pool,
+    recording each outcome from the calling thread as it completes. At most
+    `concurrency` examples are submitted at a time, so `pending` can be a lazy iterator.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        in_flight = {}
+        for idx, test_data in pending:
+            if len(in_flight) >= concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record(in_flight.pop(future), *future.result())
+            in_flight[pool.submit(process, idx, test_data, *args)] = idx
+        for future in as_completed(in_flight):
+            record(in_flight[future], *future.result())
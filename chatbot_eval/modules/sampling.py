@@ -1,14 +1,172 @@
+import re
+import math
 import random
+from collections import Counter, defaultdict
 
-def sample_demonstrations(dataset, k=16):
+# How the demonstrations of each prompt are chosen (see demonstration_setup)
+SAMPLING_STRATEGIES = ("random", "relevant_hashtags_last", "knn")
+
+def sample_demonstrations(dataset, k=16, seed=None):
     """
-    Samples k random demonstrations from the dataset.
+    Samples k random demonstrations from the dataset, reproducibly if a seed is given.
     """
-    return random.sample(dataset, k)
+    rng = random.Random(seed) if seed is not None else random
+    return rng.sample(dataset, k)
 
 def relevant_hashtags_last(demonstrations, query_hashtags):
     """
     Orders demonstrations so that those most relevant to the query hashtags are placed last.
-    Use embeddings or other methods to determine relevance.
+    Relevance is the summed weight of the query hashtags each demonstration carries.
+
+    Parameters:
+        demonstrations (list): ConvoItem demonstrations to order.
+        query_hashtags (dict or list): Hashtag -> weight, or a plain list (all weighted 1).
+
+    Returns:
+        list: The demonstrations in ascending order of relevance (stable for ties).
+    """
+    if not isinstance(query_hashtags, dict):
+        query_hashtags = {tag: 1.0 for tag in query_hashtags}
+
+    def relevance(demo):
+        return sum(query_hashtags.get(tag, 0.0) for tag in set(demo.expected or []))
+
+    return sorted(demonstrations, key=relevance)
+
+def tokenize(text):
+    """
+    Lowercased word tokens used for lexical similarity.
+    """
+    return [token for token in re.findall(r"\w+", text.lower()) if len(token) > 1]
+
+class RelevantHashtagsLastSelector:
+    """
+    Per-query "Relevant Hashtags Last" demonstration selection (see notes.txt).
+
+    The query's hashtags are unknown at test time, so they are estimated from its
+    lexical neighbours in the demonstration pool. Two inverted indexes are built once:
+    token -> demonstrations (TF-IDF weighted, very common tokens dropped) and
+    hashtag -> demonstrations. A query only touches the postings of its own tokens and
+    of its estimated hashtags, never the whole pool. The k selected demonstrations are
+    then ordered with relevant_hashtags_last, so the most relevant come last.
+
+    Parameters:
+        demos (list): The demonstration pool (ConvoItem).
+        k (int): Number of demonstrations per query.
+        neighbours (int): Lexical neighbours used to estimate the query's hashtags.
+        max_df (float): Tokens in more than this share of demonstrations are not indexed.
+        per_tag_cap (int): Max demonstrations kept per hashtag in the hashtag index.
+        seed (int): Seed for the filler demonstrations and the per-tag caps.
+    """
+    def __init__(self, demos, k=16, neighbours=32, max_df=0.1, per_tag_cap=None, seed=0):
+        self.demos = list(demos)
+        self.k = min(k, len(self.demos))
+        self.neighbours = neighbours
+        rng = random.Random(seed)
+
+        # token -> [(demo id, tf-idf weight)]
+        n = len(self.demos)
+        doc_tokens = [Counter(tokenize(demo.text)) for demo in self.demos]
+        df = Counter(token for tokens in doc_tokens for token in tokens)
+        max_postings = max(1, int(max_df * n))
+        self.idf = {token: math.log(n / count) + 1.0 for token, count in df.items() if count <= max_postings}
+        self.token_index = defaultdict(list)
+        for i, tokens in enumerate(doc_tokens):
+            weights = {t: (1 + math.log(c)) * self.idf[t] for t, c in tokens.items() if t in self.idf}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for token, weight in weights.items():
+                self.token_index[token].append((i, weight / norm))
+
+        # hashtag -> [demo id], capped so popular hashtags stay cheap to look up
+        per_tag_cap = per_tag_cap or 4 * max(self.k, 1)
+        self.tag_index = defaultdict(list)
+        for i, demo in enumerate(self.demos):
+            for tag in set(demo.expected or []):
+                self.tag_index[tag].append(i)
+        for tag, ids in self.tag_index.items():
+            if len(ids) > per_tag_cap:
+                self.tag_index[tag] = rng.sample(ids, per_tag_cap)
+
+        # Fixed random order used to top up selections with too few relevant candidates
+        self._filler = rng.sample(range(n), min(n, 4 * max(self.k, 1)))
+
+    def lexical_neighbours(self, text):
+        """
+        Returns {demo id: cosine similarity} for demonstrations sharing indexed tokens with `text`.
+        """
+        tokens = Counter(token for token in tokenize(text) if token in self.idf)
+        weights = {t: (1 + math.log(c)) * self.idf[t] for t, c in tokens.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        scores = defaultdict(float)
+        for token, weight in weights.items():
+            for i, demo_weight in self.token_index[token]:
+                scores[i] += weight / norm * demo_weight
+        return scores
+
+    def estimate_query_hashtags(self, text, scores=None):
+        """
+        Estimates hashtag relevance for a query as the similarity-weighted hashtag votes
+        of its nearest lexical neighbours.
+        """
+        scores = self.lexical_neighbours(text) if scores is None else scores
+        nearest = sorted(scores.items(), key=lambda kv: -kv[1])[:self.neighbours]
+        votes = defaultdict(float)
+        for i, similarity in nearest:
+            for tag in set(self.demos[i].expected or []):
+                votes[tag] += similarity
+        return dict(votes)
+
+    def select(self, item):
+        """
+        Returns the k demonstrations for one query, most relevant last.
+        """
+        scores = self.lexical_neighbours(item.text)
+        query_hashtags = self.estimate_query_hashtags(item.text, scores)
+
+        # Candidates: lexical neighbours plus demonstrations carrying the likeliest hashtags
+        candidates = dict(sorted(scores.items(), key=lambda kv: -kv[1])[:self.neighbours])
+        for tag, _ in sorted(query_hashtags.items(), key=lambda kv: -kv[1])[:self.k]:
+            for i in self.tag_index[tag]:
+                candidates.setdefault(i, 0.0)
+
+        def relevance(i):
+            tag_score = sum(query_hashtags.get(tag, 0.0) for tag in set(self.demos[i].expected or []))
+            return tag_score + candidates[i]
+
+        chosen = sorted(candidates, key=relevance, reverse=True)[:self.k]
+        for i in self._filler:
+            if len(chosen) >= self.k:
+                break
+            if i not in candidates:
+                chosen.append(i)
+
+        # Reversed so ties keep ascending overall relevance too
+        return relevant_hashtags_last([self.demos[i] for i in reversed(chosen)], query_hashtags)
+
+    __call__ = select
+
+def demonstration_setup(strategy, pool, k=16, seed=None, knn_index=None):
+    """
+    Returns the (demos, selector) pair run_tests expects for a sampling strategy.
+
+    Parameters:
+        strategy (str): One of SAMPLING_STRATEGIES.
+        pool (list): All demonstrations (ConvoItem).
+        k (int): Number of demonstrations per prompt.
+        seed (int): Seed of the random sample / the selector's filler demonstrations.
+        knn_index: retrieval.KNNIndex over `pool`, required for "knn".
+
+    Returns:
+        tuple: (demos, None) for one shared random sample, or (pool, selector) for the
+               per-example strategies.
     """
-    pass
\ No newline at end of file
+    if strategy == "random":
+        return sample_demonstrations(pool, k, seed), None
+    if strategy == "relevant_hashtags_last":
+        return pool, RelevantHashtagsLastSelector(pool, k=k, seed=seed or 0)
+    if strategy == "knn":
+        if knn_index is None:
+            raise ValueError("The knn strategy needs a retrieval index over the demonstrations")
+        from modules.retrieval import KNNSelector
+        return pool, KNNSelector(knn_index, pool, k=k)
+    raise ValueError(f"Unknown sampling strategy '{strategy}', expected one of {SAMPLING_STRATEGIES}")
@@ -0,0 +1,140 @@
+import os
+import shutil
+import hashlib
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from modules.io import read_from_json, save_to_json
+from modules.journal import ResultJournal
+from modules.report import build_run_report, save_run_report
+from modules.runner import export_results, run_metrics
+
+# Splits one test set over processes or machines. Every shard is a regular run_tests
+# run over the examples hashed to it, writing its journal and outputs to its own
+# directory (see shard_dir); merge_shards then combines them into the files a single
+# run would have written. On several machines, run `python app.py --num-shards N --shard K`
+# on each, gather the shard directories into one --output-dir and run `--merge` there.
+
+def shard_of(item, num_shards):
+    """
+    The shard of a conversation (ConvoItem): a stable hash of its text, identical on
+    every machine and process (unlike hash()), so duplicates always share a shard.
+    """
+    digest = hashlib.blake2b(item.text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % num_shards
+
+def select_shard(data_test, shard, num_shards, indices=None):
+    """
+    Picks the examples of one shard.
+
+    Parameters:
+        data_test (iterable): The whole test set (ConvoItem), possibly streamed.
+        shard (int): Shard to keep, from 0 to num_shards - 1.
+        num_shards (int): Number of shards.
+        indices (list): idx of each example (default: its position), see runner.run_tests.
+
+    Returns:
+        tuple: (list of ConvoItem, list of their idx) to pass to run_tests as data_test
+               and indices, so idx stay those of the whole test set.
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"shard must be between 0 and {num_shards - 1}, got {shard}")
+    pairs = zip(indices, data_test) if indices is not None else enumerate(data_test)
+    selected = [(idx, item) for idx, item in pairs if shard_of(item, num_shards) == shard]
+    return [item for _, item in selected], [idx for idx, _ in selected]
+
+def shard_dir(output_dir, shard, num_shards):
+    return os.path.join(output_dir, f"shard-{shard:03d}-of-{num_shards:03d}")
+
+def _run_logged(worker, shard, num_shards, output_dir, args):
+    # Runs in the worker process, with its output in the shard's run.log
+    directory = shard_dir(output_dir, shard, num_shards)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "run.log"), "w", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+        return worker(shard, num_shards, directory, *args)
+
+def launch_shards(worker, num_shards, output_dir, workers=None, args=()):
+    """
+    Runs every shard on a pool of worker processes.
+
+    Parameters:
+        worker (callable): Module-level function worker(shard, num_shards, directory, *args)
+                           evaluating one shard into `directory` (it must be picklable).
+        num_shards (int): Number of shards.
+        output_dir (str): Directory holding the shard directories.
+        workers (int): Processes running at once (default: one per shard, at most one per CPU).
+        args (tuple): Extra (picklable) arguments of worker.
+
+    Returns:
+        dict: shard -> what worker returned.
+
+    Raises:
+        RuntimeError: Once all shards have finished, if any of them failed. The shards
+                      that completed keep their outputs, so only the failed ones need re-running.
+    """
+    workers = workers or min(num_shards, os.cpu_count() or 1)
+    outcomes, failures = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_run_logged, worker, shard, num_shards, output_dir, args): shard
+                   for shard in range(num_shards)}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                outcomes[shard] = future.result()
+            except Exception as e:
+                failures[shard] = e
+                print(f"Shard {shard} failed: {e!r}")
+                continue
+            print(f"Shard {shard} completed: {outcomes[shard]}")
+    if failures:
+        raise RuntimeError(f"Shards {sorted(failures)} failed, see their run.log in '{output_dir}'; "
+                           f"re-run them with --shard and --resume, then --merge")
+    return outcomes
+
+def merge_shards(output_dir, num_shards, tag_list=(), journal_name="results.jsonl", export_json=False):
+    """
+    Combines the outputs of all shards of a run into `output_dir`:
+    - the journals into one journal, exported to a results store over the `tag_list`
+      vocabulary and errors.json, ordered by idx, exactly as one run over the whole
+      test set would have (see runner.export_results);
+    - metrics_evaluator.json and metrics_chatbot.json, computed from the merged results in
+      idx order, so they are bit for bit those of the single run (merging the shards'
+      metric accumulators would sum the scores in another order);
+    - the usage logs into usage.json and run_report.json (with the wall time of the slowest shard).
+
+    Raises:
+        FileNotFoundError: If a shard has no journal yet.
+
+    Returns:
+        tuple: (number of results, number of errors, evaluator metrics, chatbot metrics, run report)
+    """
+    directories = [shard_dir(output_dir, shard, num_shards) for shard in range(num_shards)]
+    missing = [d for d in directories if not os.path.exists(os.path.join(d, journal_name))]
+    if missing:
+        raise FileNotFoundError(f"No journal in {missing}, run these shards first")
+
+    # Shards hold disjoint idx, so their journals can simply be concatenated
+    journal = ResultJournal(os.path.join(output_dir, journal_name))
+    with open(journal.path, "wb") as merged:
+        for directory in directories:
+            with open(os.path.join(directory, journal_name), "rb") as f:
+                shutil.copyfileobj(f, merged)
+                # Terminate a line truncated by a crash so the next shard starts on its own line
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        merged.write(b"\n")
+    _, n_results, n_errors = export_results(journal, tag_list, output_dir, export_json)
+
+    evaluator_metrics, chatbot_metrics = run_metrics(output_dir)
+    calls, wall_time = [], 0.0
+    for directory in directories:
+        if os.path.exists(os.path.join(directory, "usage.json")):
+            calls.extend(read_from_json(os.path.join(directory, "usage.json"))["calls"])
+            wall_time = max(wall_time, read_from_json(os.path.join(directory, "run_report.json"))["total"]["wall_time_s"])
+
+    report = build_run_report(calls, wall_time)
+    report["shards"] = num_shards
+    save_to_json(os.path.join(output_dir, "usage.json"), {"calls": calls})
+    save_run_report(report, os.path.join(output_dir, "run_report.json"))
+    return n_results, n_errors, evaluator_metrics, chatbot_metrics, report
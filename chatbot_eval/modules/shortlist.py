@@ -0,0 +1,156 @@
+import math
+import argparse
+import threading
+from collections import Counter, defaultdict
+
+from modules.sampling import tokenize
+
+class TagShortlister:
+    """
+    Narrows the hashtag options of a tagging prompt to the top-N candidates for one
+    conversation, without calling the model.
+
+    Candidates are scored from tag-demonstration co-occurrence: for every token of the
+    demonstrations, P(hashtag | token) is the share of the demonstrations containing
+    the token that carry the hashtag. A conversation's score for a hashtag is the sum
+    of P(hashtag | token) over its distinct tokens, weighted by the tokens' IDF so that
+    tokens found everywhere count for little. Only the hashtags a token co-occurred with
+    are touched per token (an inverted index of token -> hashtags), so scoring costs the
+    conversation's postings rather than tokens x hashtags. Ties, and hashtags the
+    conversation shares no token with, are ranked by how often they occur on the
+    demonstrations, then in tag_list order.
+
+    Parameters:
+        demos (list): Demonstrations (ConvoItem) with pass_fail and expected hashtags.
+        tag_list (list): The full list of valid hashtags.
+        top_n (int): Number of hashtags kept per conversation.
+    """
+    def __init__(self, demos, tag_list, top_n=20):
+        self.tag_list = list(tag_list)
+        self.top_n = top_n
+        valid = set(self.tag_list)
+
+        df = Counter()
+        tag_counts = Counter()
+        token_tag_counts = defaultdict(Counter)
+        n = 0
+        for demo in demos:
+            n += 1
+            tokens = set(tokenize(demo.text))
+            df.update(tokens)
+            if demo.pass_fail != "Fail" or not demo.expected:
+                continue
+            for tag in set(demo.expected) & valid:
+                tag_counts[tag] += 1
+                for token in tokens:
+                    token_tag_counts[token][tag] += 1
+
+        # token -> [(hashtag, idf(token) * P(hashtag | token))]
+        self.index = {}
+        for token, counts in token_tag_counts.items():
+            idf = math.log(n / df[token])
+            if idf > 0:
+                self.index[token] = [(tag, idf * count / df[token]) for tag, count in counts.items()]
+        # Fallback order: most frequent hashtags first, then the rest in tag_list order
+        self.ranking = sorted(self.tag_list, key=lambda tag: -tag_counts[tag])
+
+    def scores(self, text):
+        """
+        Returns {hashtag: score} for the hashtags sharing at least one token with `text`.
+        """
+        scores = defaultdict(float)
+        for token in set(tokenize(text)):
+            for tag, weight in self.index.get(token, ()):
+                scores[tag] += weight
+        return scores
+
+    def shortlist(self, item):
+        """
+        Returns the top_n hashtags for one conversation (ConvoItem), most likely first.
+        """
+        scores = self.scores(item.text)
+        # sorted() is stable, so ties keep the fallback order
+        return sorted(self.ranking, key=lambda tag: -scores.get(tag, 0.0))[:self.top_n]
+
+    __call__ = shortlist
+
+class ShortlistRecall:
+    """
+    Thread-safe tally of how many true hashtags of failed conversations made their shortlist.
+    """
+    def __init__(self):
+        self.examples = 0
+        self.true_tags = 0
+        self.covered = 0
+        self.options = 0
+        self._lock = threading.Lock()
+
+    def add(self, item, shortlist):
+        if item.pass_fail != "Fail" or not item.expected:
+            return
+        with self._lock:
+            self.examples += 1
+            self.true_tags += len(set(item.expected))
+            self.covered += len(set(item.expected) & set(shortlist))
+            self.options += len(shortlist)
+
+    def summary(self):
+        """
+        Returns the recall of the shortlists (share of true hashtags they contained) and
+        their mean length, over the labelled failed conversations seen.
+        """
+        return {
+            "examples": self.examples,
+            "true_tags": self.true_tags,
+            "covered": self.covered,
+            "recall": self.covered / self.true_tags if self.true_tags else None,
+            "mean_options": self.options / self.examples if self.examples else None,
+        }
+
+def print_shortlist_recall(summary, top_n=None):
+    """
+    Nicely prints a ShortlistRecall summary.
+    """
+    label = f"Tag shortlist (top {top_n})" if top_n else "Tag shortlist"
+    if summary["recall"] is None:
+        print(f"{label}: no labelled failed conversations to measure recall on")
+        return
+    print(f"{label}: recall {summary['recall']:.1%} ({summary['covered']}/{summary['true_tags']} true hashtags "
+          f"over {summary['examples']} failed conversations), {summary['mean_options']:.1f} options per prompt")
+
+def recall_at(demos, items, tag_list, top_ns):
+    """
+    Measures the shortlist recall for several values of N in one pass over `items`,
+    to tune N before a run.
+
+    Returns:
+        dict: N -> ShortlistRecall summary.
+    """
+    shortlister = TagShortlister(demos, tag_list, top_n=max(top_ns))
+    tallies = {n: ShortlistRecall() for n in top_ns}
+    for item in items:
+        ranked = shortlister(item)
+        for n, tally in tallies.items():
+            tally.add(item, ranked[:n])
+    return {n: tally.summary() for n, tally in tallies.items()}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure the recall of the tag shortlist on labelled conversations.")
+    parser.add_argument("--top-n", type=int, nargs="+", default=[5, 10, 20, 40],
+                        help="Shortlist sizes to evaluate (default: 5 10 20 40)")
+    parser.add_argument("--demos", default="demo.csv", help="Demonstrations the shortlist is fitted on")
+    parser.add_argument("--test", default="test.csv", help="Labelled conversations to measure recall on")
+    parser.add_argument("--limit", type=int, default=0, help="Number of test conversations, 0 for all (default: 0)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    from modules.data import get_tags
+    from modules.loaders.csv_loader import CSVConvoLoader
+
+    args = parse_args()
+    loader = CSVConvoLoader()
+    tags = get_tags()
+    results = recall_at(loader.load(args.demos), loader.stream(args.test, limit=args.limit or None), tags, args.top_n)
+    print(f"{len(tags)} valid hashtags")
+    for n, summary in results.items():
+        print_shortlist_recall(summary, n)
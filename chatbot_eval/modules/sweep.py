@@ -0,0 +1,237 @@
+import time
+import asyncio
+import argparse
+import statistics
+
+from modules.io import save_to_json
+from modules.data import get_tags
+from modules.loaders.csv_loader import CSVConvoLoader
+from modules.sampling import SAMPLING_STRATEGIES, demonstration_setup
+from modules.metrics import evaluator_metrics
+from modules.clients.registry import BACKENDS, set_backend, backend_stats
+from modules.clients.cache import print_cache_stats
+from modules.clients.usage import usage_log
+from modules.report import build_run_report, print_run_report
+from modules.progress import RunProgress, format_duration
+from modules.runner import run_async, pipeline_args, PIPELINES, DEFAULT_CONCURRENCY
+from modules.prompting import process_example_async, process_example_structured_async
+
+# Strategies whose demonstrations do not depend on the seed; they run once per k
+SEED_INDEPENDENT = {"knn"}
+
+def plan_sweep(pool, ks, seeds, strategies, knn_index=None):
+    """
+    Expands the grid into configurations and groups the ones that would send exactly
+    the same prompts (same demonstrations, or a seed-independent strategy), so each
+    group is evaluated once.
+
+    Returns:
+        tuple: (configs, setups) where configs is a list of {"strategy", "k", "seed", "setup"}
+               and setups maps a setup key to its (demos, selector) pair.
+    """
+    configs, setups = [], {}
+    for strategy in strategies:
+        for k in ks:
+            for seed in seeds:
+                if strategy in SEED_INDEPENDENT:
+                    key = (strategy, k)
+                    if key not in setups:
+                        setups[key] = demonstration_setup(strategy, pool, k, seed, knn_index)
+                else:
+                    demos, selector = demonstration_setup(strategy, pool, k, seed, knn_index)
+                    # A shared sample is identified by its demonstrations (the pool objects themselves)
+                    key = (strategy, k, seed) if selector else ("demos", tuple(map(id, demos)))
+                    setups.setdefault(key, (demos, selector))
+                configs.append({"strategy": strategy, "k": k, "seed": seed, "setup": key})
+    return configs, setups
+
+def run_sweep(data_test, pool, tags, ks=(8, 16, 24, 32), seeds=(0, 1, 2), strategies=("random",),
+              pipeline="two_step", concurrency=DEFAULT_CONCURRENCY, knn_index=None, filename="sweep.json",
+              progress_every=10.0, stop_ci_width=None):
+    """
+    Evaluates every (strategy, k, seed) configuration on the same test set and
+    compares their metrics.
+
+    All configurations share one async scheduler (runner.run_async, at most
+    `concurrency` examples in flight across the whole sweep) and the response cache.
+    Identical prompts are sent once: configurations with the same demonstrations are
+    merged by plan_sweep, and duplicate requests that are in flight at the same time
+    are shared by the client (see cache.acached_call). Each test example is sent for
+    all configurations before the next one, so duplicates meet while still in flight.
+
+    Parameters:
+        data_test (iterable): ConvoItem test examples (read once into memory).
+        pool (list): The demonstration pool.
+        tags (list): The full list of valid hashtags.
+        ks (list): Numbers of demonstrations to compare.
+        seeds (list): Seeds of the demonstration sampling, one run per seed.
+        strategies (list): Sampling strategies (see sampling.SAMPLING_STRATEGIES).
+        pipeline (str): "two_step" or "structured".
+        concurrency (int): Max examples in flight over all configurations.
+        knn_index: retrieval.KNNIndex over `pool`, needed for the "knn" strategy.
+        filename (str): Where to save per-configuration metrics and the comparison.
+        progress_every (float): Seconds between progress lines, None for none.
+        stop_ci_width (float): Stop evaluating a configuration once the 95% interval of its
+                               running F-beta is at most this wide; its metrics then cover
+                               the examples evaluated so far (see progress.RunProgress).
+
+    Returns:
+        list: One row per (strategy, k) with the mean/std of the metrics over seeds
+              (see summarize_sweep).
+    """
+    data_test = list(data_test)
+    configs, setups = plan_sweep(pool, ks, seeds, strategies, knn_index)
+    aprocess = process_example_structured_async if pipeline == "structured" else process_example_async
+
+    shared_args = {}
+    for key, (demos, selector) in setups.items():
+        if selector is None:
+            shared_args[key] = pipeline_args(pipeline, demos, tags)
+
+    async def process(job, test_data):
+        key, idx = job
+        demos, selector = setups[key]
+        args = shared_args[key] if selector is None else pipeline_args(pipeline, selector(test_data), tags)
+        return await aprocess(idx, test_data, *args)
+
+    results = {key: {} for key in setups}
+    errors = {key: 0 for key in setups}
+    # Named after the first configuration sharing each setup
+    labels = {}
+    for config in configs:
+        labels.setdefault(config["setup"], f"Sweep {config['strategy']} k={config['k']} seed={config['seed']}")
+    progresses = {key: RunProgress(len(data_test), None, stop_ci_width, label=labels[key]) for key in setups}
+    total_jobs = len(data_test) * len(setups)
+    last_line = [time.perf_counter()]
+
+    def record(job, res, err):
+        key, idx = job
+        if res is not None:
+            results[key][idx] = res
+        else:
+            errors[key] += 1
+        progresses[key].update(res, err)
+        now = time.perf_counter()
+        if progress_every is not None and now - last_line[0] >= progress_every:
+            last_line[0] = now
+            print(_sweep_line(progresses, total_jobs, now - start))
+
+    def pending_jobs():
+        pairs = enumerate(data_test)
+        for demos, selector in setups.values():
+            if hasattr(selector, "prefetch"):
+                pairs = selector.prefetch(pairs)
+        for idx, test_data in pairs:
+            for key in setups:
+                # Configurations that stopped get no new examples
+                if progresses[key].stopped:
+                    progresses[key].skip()
+                    continue
+                yield (key, idx), test_data
+    pending = pending_jobs()
+    print(f"Sweep: {len(configs)} configurations, {len(setups)} distinct, {len(data_test)} test examples each.")
+    usage_log.reset()
+    start = time.perf_counter()
+    asyncio.run(run_async(process, pending, (), concurrency, record))
+    print(_sweep_line(progresses, total_jobs, time.perf_counter() - start))
+    report = build_run_report(usage_log.snapshot(), time.perf_counter() - start, endpoint_health=backend_stats())
+
+    for config in configs:
+        key = config["setup"]
+        config_results = [results[key][idx] for idx in sorted(results[key])]
+        config["metrics"] = evaluator_metrics(config_results, filename=None)
+        config["errors"] = errors[key]
+        config["examples"] = len(config_results)
+        config["stopped_early"] = progresses[key].stopped_early
+
+    table = summarize_sweep(configs)
+    if filename:
+        save_to_json(filename, {
+            "configs": [{name: value for name, value in c.items() if name != "setup"} for c in configs],
+            "summary": table,
+            "run_report": report,
+        })
+    print_cache_stats()
+    print_run_report(report)
+    print()
+    print_sweep_table(table)
+    return table
+
+def _sweep_line(progresses, total_jobs, elapsed):
+    done = sum(p.processed for p in progresses.values())
+    # Jobs of the configurations that stopped early are never sent
+    remaining = sum(p.total - p.processed for p in progresses.values() if not p.stopped)
+    rate = done / elapsed if elapsed > 0 else 0.0
+    stopped = sum(p.stopped_early for p in progresses.values())
+    return (f"Sweep: {done}/{total_jobs} examples, {rate:.1f} examples/s, "
+            f"ETA {format_duration(remaining / rate if rate else None)}, "
+            f"{stopped}/{len(progresses)} configurations stopped early")
+
+def summarize_sweep(configs, keys=("precision", "recall", "f_beta", "fail_f_beta")):
+    """
+    Groups configurations by (strategy, k) and returns the mean and (sample) standard
+    deviation of each metric over their seeds.
+
+    Configurations that plan_sweep merged into one evaluation (a seed-independent
+    strategy, or seeds drawing the same demonstrations) count as a single run: their
+    errors are counted once, and the std is None when a group has only one run.
+    """
+    groups = {}
+    for config in configs:
+        runs = groups.setdefault((config["strategy"], config["k"]), {})
+        # Configurations without a setup key (e.g. read back from sweep.json) are runs of their own
+        runs.setdefault(config.get("setup", id(config)), config)
+
+    table = []
+    for (strategy, k), runs in groups.items():
+        group = list(runs.values())
+        row = {"strategy": strategy, "k": k, "runs": len(group), "errors": sum(c["errors"] for c in group)}
+        for key in keys:
+            values = [c["metrics"][key] for c in group]
+            row[f"{key}_mean"] = statistics.mean(values)
+            row[f"{key}_std"] = statistics.stdev(values) if len(values) > 1 else None
+        table.append(row)
+    return table
+
+def print_sweep_table(table):
+    """
+    Prints the comparison table, one line per (strategy, k).
+    """
+    def cell(row, key):
+        std = row[f"{key}_std"]
+        return f"{row[f'{key}_mean']:.3f}±{'n/a' if std is None else f'{std:.3f}':<5}"
+
+    print(f"{'strategy':<22} |  k  | runs |  precision  |   recall    |   f_beta    | fail_f_beta | errors")
+    for row in table:
+        cells = " | ".join(cell(row, key) for key in ("precision", "recall", "f_beta", "fail_f_beta"))
+        print(f"{row['strategy']:<22} | {row['k']:>3} | {row['runs']:>4} | {cells} | {row['errors']:>6}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare demonstration counts, seeds and sampling strategies in one sweep.")
+    parser.add_argument("--k", type=int, nargs="+", default=[8, 16, 24, 32], help="Numbers of demonstrations (default: 8 16 24 32)")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2], help="Sampling seeds (default: 0 1 2)")
+    parser.add_argument("--strategies", choices=SAMPLING_STRATEGIES, nargs="+", default=["random"],
+                        help="Sampling strategies (default: random)")
+    parser.add_argument("--pipeline", choices=PIPELINES, default="two_step")
+    parser.add_argument("--backend", choices=tuple(BACKENDS), help="LLM backend, overriding [llm] backend in config.ini")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Max examples in flight across all configurations (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--limit", type=int, default=100, help="Number of test examples, 0 for all (default: 100)")
+    parser.add_argument("--stop-ci-width", type=float,
+                        help="Stop a configuration once the 95%% interval of its running F-beta is at most this wide")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.backend:
+        set_backend(args.backend)
+    loader = CSVConvoLoader()
+    pool = loader.load("demo.csv")
+    test_data = loader.load("test.csv", limit=args.limit or None)
+    knn_index = None
+    if "knn" in args.strategies:
+        from modules.retrieval import KNNIndex
+        knn_index = KNNIndex.from_loader(loader, "demo.csv")
+    run_sweep(test_data, pool, get_tags(), args.k, args.seeds, args.strategies,
+              pipeline=args.pipeline, concurrency=args.concurrency, knn_index=knn_index,
+              stop_ci_width=args.stop_ci_width)
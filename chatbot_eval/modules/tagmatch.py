@@ -0,0 +1,213 @@
+import re
+import time
+import random
+import argparse
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+
+# "match" values of [tags]: "exact" reads "#word" hashtags spelled exactly as listed,
+# "fuzzy" also accepts near-misses (see TagMatcher)
+MATCH_MODES = ("exact", "fuzzy")
+# Hashtags as exact matching reads them
+HASHTAG = re.compile(r"#\w+")
+# Words of a response or hashtag; the optional "#" is kept to tell hashtags from plain words
+WORD = re.compile(r"(#?)([^\W_]+)")
+# What may separate the words of one multi-word hashtag ("#late_delivery", "late delivery", "late-delivery")
+JOINERS = {"_", "-", " "}
+
+# Tag lists whose matcher is looked up by identity (per-example shortlists are short-lived)
+MAX_REMEMBERED_LISTS = 64
+_matchers = OrderedDict()  # id(tag list) -> (tag list, TagMatcher)
+_matchers_lock = threading.Lock()
+
+class TagMatcher:
+    """
+    Extracts the valid hashtags from a model's answer.
+
+    By default only "#word" hashtags written exactly as in tag_list (or as an alias) are
+    returned, as many times as they occur. With `fuzzy`, near-misses are accepted too.
+    The matcher is then built once per tag vocabulary: every hashtag (and alias) is normalized into a tuple
+    of words, "#Late_Delivery" -> ("late", "delivery"), and stored in a dict. Matching
+    scans the answer's words once and looks up the longest run of words starting at
+    each position (at most the length of the longest hashtag), so its cost depends on
+    the answer and not on the vocabulary size. Case differences, a missing "#",
+    punctuation around the tag and "_", "-" or " " between its words all still match;
+    a word starting with "#" always starts a new hashtag. Note that plain words of the
+    answer that spell a one-word hashtag ("refund" for "#refund") then count as that tag,
+    unless `require_hash` is set.
+
+    Parameters:
+        tag_list (list): The valid hashtags, in their canonical spelling.
+        aliases (dict): Alternative spelling -> canonical hashtag (e.g. {"#late": "#late_delivery"}).
+        fuzzy (bool): Accept near-misses, see above.
+        case_sensitive (bool): With `fuzzy`, require the hashtag's exact case.
+        require_hash (bool): With `fuzzy`, only match words written with a leading "#".
+        dedupe (bool): Return each hashtag once, at its first occurrence.
+
+    If two hashtags normalize to the same words, the first one in tag_list is returned for both.
+    """
+    def __init__(self, tag_list, aliases=None, fuzzy=False, case_sensitive=False, require_hash=False, dedupe=False):
+        self.fuzzy = fuzzy
+        self.case_sensitive = case_sensitive
+        self.require_hash = require_hash
+        self.dedupe = dedupe
+        self.table = {}
+        for tag in tag_list:
+            self.table.setdefault(self.normalize(tag), tag)
+        for alias, tag in (aliases or {}).items():
+            canonical = self.table.get(self.normalize(tag))
+            if canonical is None:
+                raise ValueError(f"Alias '{alias}' maps to '{tag}', which is not a valid hashtag")
+            self.table.setdefault(self.normalize(alias), canonical)
+        # Exact spelling -> canonical hashtag, for exact matching
+        self.exact = {tag: tag for tag in tag_list}
+        for alias, tag in (aliases or {}).items():
+            self.exact.setdefault(alias, self.table[self.normalize(tag)])
+        self.max_words = max((len(key) for key in self.table), default=0)
+
+    def normalize(self, tag):
+        """
+        The words of a hashtag as they are matched, e.g. "#Late_Delivery" -> ("late", "delivery").
+        """
+        words = tuple(word for _, word in WORD.findall(tag))
+        return words if self.case_sensitive else tuple(word.lower() for word in words)
+
+    def _words(self, text):
+        # [(has "#", word, joins the previous word)]
+        words = []
+        end = None
+        for match in WORD.finditer(text):
+            joined = end is not None and not match.group(1) and text[end:match.start()] in JOINERS
+            word = match.group(2) if self.case_sensitive else match.group(2).lower()
+            words.append((bool(match.group(1)), word, joined))
+            end = match.end()
+        return words
+
+    def extract(self, text):
+        """
+        Returns the valid hashtags found in `text`, in order of appearance.
+        """
+        if not self.fuzzy:
+            found = [self.exact[tag] for tag in HASHTAG.findall(text) if tag in self.exact]
+            return list(dict.fromkeys(found)) if self.dedupe else found
+        words = self._words(text)
+        found = []
+        i = 0
+        while i < len(words):
+            if self.require_hash and not words[i][0]:
+                i += 1
+                continue
+            # Longest run of joined words starting at i that is a hashtag
+            length = 1
+            while length < self.max_words and i + length < len(words) and words[i + length][2]:
+                length += 1
+            for n in range(length, 0, -1):
+                tag = self.table.get(tuple(word for _, word, _ in words[i:i + n]))
+                if tag is not None:
+                    found.append(tag)
+                    i += n
+                    break
+            else:
+                i += 1
+        return list(dict.fromkeys(found)) if self.dedupe else found
+
+    __call__ = extract
+
+@lru_cache(maxsize=None)
+def _match_settings():
+    # ([tags] aliases, fuzzy, case_sensitive, require_hash, dedupe) from config.ini, read once
+    from modules.data import get_tag_aliases
+    from modules.clients.registry import load_config
+    config = load_config()
+    section = config["tags"] if config.has_section("tags") else {}
+
+    def flag(key, default):
+        return str(section.get(key, default)).strip().lower() in ("true", "yes", "on", "1")
+    mode = section.get("match", "exact").strip().lower()
+    if mode not in MATCH_MODES:
+        raise ValueError(f"Unknown [tags] match '{mode}', expected one of {MATCH_MODES}")
+    aliases = get_tag_aliases(section.get("aliases", "tag_aliases.csv"))
+    return (tuple(aliases.items()), mode == "fuzzy", flag("case_sensitive", False), flag("require_hash", False),
+            flag("dedupe", False))
+
+@lru_cache(maxsize=64)
+def _cached_matcher(tags, aliases, fuzzy, case_sensitive, require_hash, dedupe):
+    return TagMatcher(tags, dict(aliases), fuzzy, case_sensitive, require_hash, dedupe)
+
+def matcher_for(tag_list):
+    """
+    The TagMatcher of a tag vocabulary, configured by the [tags] section of config.ini.
+    Matchers are cached per vocabulary, so each is only built once per run, and the
+    lists they were requested for are remembered so that repeated calls with the same
+    list (the usual case) skip even hashing it. Tag lists must not be modified in place.
+    """
+    entry = _matchers.get(id(tag_list))
+    if entry is not None and entry[0] is tag_list:
+        return entry[1]
+    matcher = _cached_matcher(tuple(tag_list), *_match_settings())
+    with _matchers_lock:
+        # Keeping the list alive also keeps its id from being reused
+        _matchers[id(tag_list)] = (tag_list, matcher)
+        if len(_matchers) > MAX_REMEMBERED_LISTS:
+            _matchers.popitem(last=False)
+    return matcher
+
+def _exact_matches(text, tag_list):
+    # The previous extraction: exact "#word" matches checked against the list
+    return [tag for tag in re.findall(r"#\w+", text) if tag in tag_list]
+
+def benchmark_matcher(n_tags=1000, n_answers=2000, seed=0):
+    """
+    Micro-benchmark of fuzzy hashtag extraction over a synthetic vocabulary of `n_tags`
+    multi-word hashtags and model answers with 1-3 hashtags, some misspelled the way
+    models do (case, missing "#", spaces, trailing punctuation).
+
+    Returns:
+        dict: Build time, µs per answer and recall for the fuzzy TagMatcher and the exact matching.
+    """
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(200)]
+    tags = list(dict.fromkeys(f"#{rng.choice(words)}_{rng.choice(words)}" for _ in range(n_tags * 2)))[:n_tags]
+
+    def variant(tag):
+        style = rng.randrange(5)
+        if style == 0:
+            return tag
+        if style == 1:
+            return tag.upper()
+        if style == 2:
+            return tag[1:]
+        if style == 3:
+            return tag.replace("_", " ")
+        return f"{tag}."
+
+    answers = []
+    for _ in range(n_answers):
+        chosen = rng.sample(tags, rng.randint(1, 3))
+        answers.append((", ".join(variant(tag) for tag in chosen), chosen))
+
+    start = time.perf_counter()
+    matcher = TagMatcher(tags, fuzzy=True)
+    build = time.perf_counter() - start
+
+    results = {"tags": len(tags), "answers": n_answers, "matcher_build_ms": build * 1000}
+    for name, extract in (("matcher", matcher.extract), ("exact", lambda text: _exact_matches(text, tags))):
+        start = time.perf_counter()
+        extracted = [extract(text) for text, _ in answers]
+        elapsed = time.perf_counter() - start
+        hits = sum(len(set(found) & set(chosen)) for found, (_, chosen) in zip(extracted, answers))
+        results[f"{name}_us_per_answer"] = elapsed / n_answers * 1e6
+        results[f"{name}_recall"] = hits / sum(len(chosen) for _, chosen in answers)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark fuzzy hashtag extraction on a synthetic vocabulary.")
+    parser.add_argument("--tags", type=int, nargs="+", default=[100, 1000, 5000], help="Vocabulary sizes")
+    parser.add_argument("--answers", type=int, default=2000, help="Synthetic answers per size")
+    args = parser.parse_args()
+    for n in args.tags:
+        r = benchmark_matcher(n, args.answers)
+        print(f"{r['tags']:>6} tags: matcher {r['matcher_us_per_answer']:.1f}µs/answer (built in {r['matcher_build_ms']:.1f}ms, "
+              f"recall {r['matcher_recall']:.1%}), exact list lookup {r['exact_us_per_answer']:.1f}µs/answer "
+              f"(recall {r['exact_recall']:.1%})")